@@ -0,0 +1,239 @@
+"""
+Phase T: Structured Logging
+Level-gated, structured logging in place of unconditional print("[DEBUG] ...").
+
+- Levels: LOG_LEVEL (default INFO). Fields are only formatted when the level
+  is enabled, so debug output costs one isEnabledFor() check in production.
+- Correlation: run_id / session_id / job_id and the current pipeline phase are
+  carried in context variables (copied into phase_executor tasks) and added
+  to every record, so log lines join with the telemetry spans stored in
+  reasoning_logs["telemetry"] on (run_id, phase).
+- Sampling: LOG_SAMPLE_RATE (default 1.0) keeps that fraction of DEBUG / INFO
+  records, decided per run_id so a sampled run is logged completely. WARNING
+  and above are never dropped.
+- Non-blocking: records go through a QueueHandler; a QueueListener thread
+  writes them to stderr (and LOG_FILE when set) as text or JSON lines
+  (LOG_FORMAT=text | json).
+
+⚠️ Like logic.py, this module must not import streamlit.
+
+Usage:
+    log = get_logger(__name__)
+    log.debug("question classified", domain=..., complexity=...)
+    with log_context(run_id=run_id):
+        ...
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import zlib
+import functools
+import threading
+import contextvars
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Callable
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+ROOT_LOGGER = "gws"
+
+# Correlation fields added to every record
+CONTEXT_FIELDS = ("run_id", "session_id", "job_id", "phase")
+_context = {name: contextvars.ContextVar(f"log_{name}", default=None) for name in CONTEXT_FIELDS}
+
+
+def current_context() -> Dict[str, Any]:
+    """Correlation ids bound in the current context (unset ones omitted)."""
+    values = {name: var.get() for name, var in _context.items()}
+    return {name: value for name, value in values.items() if value is not None}
+
+
+def bind_context(**ids) -> Dict[str, contextvars.Token]:
+    """Set correlation ids (run_id / session_id / job_id / phase) until reset_context() or the next bind."""
+    return {name: _context[name].set(value) for name, value in ids.items() if name in _context}
+
+
+def reset_context(tokens: Dict[str, contextvars.Token]) -> None:
+    for name, token in tokens.items():
+        _context[name].reset(token)
+
+
+@contextmanager
+def log_context(**ids):
+    """Bind correlation ids for a block."""
+    tokens = bind_context(**ids)
+    try:
+        yield
+    finally:
+        reset_context(tokens)
+
+
+def with_log_context(*names: str) -> Callable:
+    """
+    Decorator: bind the named keyword arguments of each call (e.g. run_id, session_id)
+    as correlation ids; the call starts without a phase, and the caller's ids are
+    restored when it returns.
+    """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            ids = {name: kwargs[name] for name in names if kwargs.get(name) is not None}
+            with log_context(phase=None, **ids):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _ContextFilter(logging.Filter):
+    """Attach the correlation ids, then apply DEBUG / INFO sampling."""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = current_context()
+        if self.sample_rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        run_id = record.context.get("run_id")
+        if run_id:
+            # Same decision for every record of a run
+            return (zlib.crc32(run_id.encode("utf-8")) % 10000) / 10000 < self.sample_rate
+        return random.random() < self.sample_rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueue the record with its message and stack trace rendered, keeping the structured fields."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {**getattr(record, "context", {}), **getattr(record, "fields", {})}
+        line = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class StructuredLogger:
+    """
+    logging.Logger with keyword fields: log.info("message", key=value, ...).
+
+    Fields are only evaluated into the record when the level is enabled.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def is_enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug_enabled(self) -> bool:
+        """For costly extras such as stack traces of handled errors: exc_info=log.debug_enabled()."""
+        return self._logger.isEnabledFor(logging.DEBUG)
+
+    def _log(self, level: int, message: str, exc_info=None, **fields) -> None:
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, message, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
+
+    def debug(self, message: str, **fields) -> None:
+        self._log(logging.DEBUG, message, **fields)
+
+    def info(self, message: str, **fields) -> None:
+        self._log(logging.INFO, message, **fields)
+
+    def warning(self, message: str, exc_info=None, **fields) -> None:
+        self._log(logging.WARNING, message, exc_info=exc_info, **fields)
+
+    def error(self, message: str, exc_info=None, **fields) -> None:
+        self._log(logging.ERROR, message, exc_info=exc_info, **fields)
+
+    def exception(self, message: str, **fields) -> None:
+        """ERROR with the current exception's stack trace."""
+        self._log(logging.ERROR, message, exc_info=True, **fields)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_configure_lock = threading.Lock()
+
+
+def configure_logging(
+    level: str = LOG_LEVEL,
+    fmt: str = LOG_FORMAT,
+    log_file: str = LOG_FILE,
+    sample_rate: float = LOG_SAMPLE_RATE
+) -> None:
+    """
+    Install the queue handler on the "gws" logger (once per process; get_logger() calls it).
+
+    Args:
+        level: Minimum level (DEBUG / INFO / WARNING / ERROR)
+        fmt: "text" or "json"
+        log_file: Also append to this file ("" = stderr only)
+        sample_rate: Fraction of DEBUG / INFO records kept (per run_id)
+    """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        formatter = _JsonFormatter() if fmt == "json" else _TextFormatter()
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if log_file:
+            handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        # Callers only enqueue; formatting and I/O happen on the listener thread
+        records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        queue_handler = _QueueHandler(records)
+        queue_handler.addFilter(_ContextFilter(sample_rate))
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(getattr(logging, level.upper(), logging.INFO))
+        root.addHandler(queue_handler)
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    """Logger under "gws" (module name without the package path, e.g. get_logger(__name__))."""
+    configure_logging()
+    return StructuredLogger(logging.getLogger(f"{ROOT_LOGGER}.{name.rsplit('.', 1)[-1]}"))
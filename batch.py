@@ -0,0 +1,485 @@
+"""
+Phase M: Batch Runner
+Runs a JSONL file of questions through the headless pipeline overnight:
+configurable concurrency, a total-cost cap, one output JSONL record per
+question (answer, per-phase usage and timings), and resume after
+interruption.
+
+Usage:
+    python batch.py questions.jsonl --mode "熟考 (本気MAX)ms/Az" --concurrency 4 --max-cost 20
+
+Input lines are {"id": ..., "question": ..., "mode": ...} ("id" / "mode" optional;
+a bare JSON string is also accepted). Re-running the same command skips ids
+already answered in the output file and continues interrupted runs from their
+last completed phase (checkpoints in pipeline_checkpoints/).
+
+With --vertex-batch every pending question is answered by one grounded call
+submitted as a single Vertex batch prediction job (see vertex_batch.py)
+instead of the multi-phase pipeline; the job name is stored next to the
+output file so an interrupted run re-attaches to the submitted job.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List
+
+from logic import get_client, calculate_cost, record_usage
+from checkpoints import load_checkpoint, start_run, finish_run, mark_failed
+from pipeline import (
+    BASE_SYSTEM_INSTRUCTION, DEFAULT_MODEL_ID, MULTILAYER_CATEGORY,
+    PipelineCallbacks, run_pipeline_from_checkpoint
+)
+from vertex_batch import build_request, get_batch_backend, run_batch
+from single_call import Usage
+
+
+DEFAULT_BATCH_MODE = "熟考 (本気MAX)ms/Az"
+DEFAULT_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# Total cost cap in USD (0 = no cap)
+DEFAULT_MAX_COST = float(os.getenv("BATCH_MAX_COST_USD", "0"))
+
+# Cost reserved for a question before any question of the batch has finished
+INITIAL_COST_ESTIMATE = 0.05
+
+# Output tokens assumed per answer when capping a batch prediction job
+BATCH_OUTPUT_TOKEN_ESTIMATE = 2000
+
+
+def load_questions(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the input JSONL.
+
+    Returns:
+        [{"id", "question", "mode"?}] with ids defaulting to the line number
+
+    Raises:
+        ValueError: if two questions share an id (they would share one checkpoint and output record)
+    """
+    questions = []
+    seen_lines: Dict[str, int] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            question = item.get("question") or item.get("prompt")
+            if not question:
+                print(f"[WARNING] {path}:{line_no}: no question, skipped")
+                continue
+            item_id = str(item.get("id", line_no))
+            if item_id in seen_lines:
+                raise ValueError(f"{path}:{line_no}: duplicate id {item_id!r} (first used on line {seen_lines[item_id]})")
+            seen_lines[item_id] = line_no
+            questions.append({**item, "id": item_id, "question": question})
+    return questions
+
+
+def load_finished_ids(output_path: str) -> set:
+    """Ids with a successful record in an existing output file (skipped on resume)."""
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # last line cut off by the interruption
+            if record.get("status") == "ok":
+                finished.add(str(record["id"]))
+    return finished
+
+
+def batch_run_id(input_path: str, item_id: str) -> str:
+    """Stable checkpoint run id, so an interrupted question resumes from its last phase."""
+    digest = hashlib.sha1(f"{os.path.abspath(input_path)}\0{item_id}".encode("utf-8")).hexdigest()
+    return f"batch_{digest[:12]}"
+
+
+class BatchCallbacks(PipelineCallbacks):
+    """Records per-phase wall-clock timings and token usage of one question."""
+
+    def __init__(self, item_id: str, restored_phases: set, verbose: bool = False):
+        self.item_id = item_id
+        self.restored_phases = restored_phases
+        self.verbose = verbose
+        self.started = time.monotonic()
+        self._last_mark = self.started
+        self.phase_timings: Dict[str, float] = {}
+        self.usage_records: List[Dict[str, Any]] = []
+
+    def status(self, text: str) -> None:
+        if self.verbose:
+            print(f"  [{self.item_id}] {text}")
+
+    def warning(self, text: str) -> None:
+        print(f"  [{self.item_id}] ⚠️ {text}")
+
+    def error(self, text: str) -> None:
+        print(f"  [{self.item_id}] ❌ {text}")
+
+    def phase_done(self, phase: str, output: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        if phase not in self.restored_phases:
+            self.phase_timings[phase] = round(now - self._last_mark, 3)
+        self._last_mark = now
+
+    def usage(self, phase: str, model: str, input_tokens: int, output_tokens: int, cost: float) -> None:
+        self.usage_records.append({
+            "phase": phase, "model": model,
+            "input_tokens": input_tokens, "output_tokens": output_tokens, "cost": cost,
+        })
+
+    def elapsed(self) -> float:
+        return round(time.monotonic() - self.started, 3)
+
+
+class BatchRunner:
+    """
+    Runs questions concurrently and streams one JSON line per question.
+
+    The cost cap is enforced when a question is started: spent cost plus an
+    estimate for every in-flight question (mean cost of finished questions)
+    must stay under the cap. A run on the wire is never interrupted, so the
+    total can exceed the cap by at most the in-flight questions' overshoot.
+    """
+
+    def __init__(
+        self,
+        input_path: str,
+        output_path: str,
+        mode: str = DEFAULT_BATCH_MODE,
+        model_id: str = DEFAULT_MODEL_ID,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_cost: float = DEFAULT_MAX_COST,
+        use_search: bool = True,
+        verbose: bool = False,
+        client=None
+    ):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.mode = mode
+        self.model_id = model_id
+        self.concurrency = max(1, concurrency)
+        self.max_cost = max_cost
+        self.use_search = use_search
+        self.verbose = verbose
+        self.client = client
+
+        self._lock = threading.Lock()
+        self._settled = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self.usage = Usage()
+        self.spent = 0.0
+        self.finished_costs: List[float] = []
+        self.in_flight = 0
+        self.counts = {"ok": 0, "error": 0, "skipped_budget": 0}
+
+    def _estimate(self) -> float:
+        if self.finished_costs:
+            return sum(self.finished_costs) / len(self.finished_costs)
+        return INITIAL_COST_ESTIMATE
+
+    def _reserve(self) -> bool:
+        """
+        Count a question as in flight once it fits under the cost cap.
+
+        Waits while other questions are in flight (their actual cost decides
+        whether this one fits) and gives up only when nothing is running.
+        """
+        with self._lock:
+            while self.max_cost and self.spent + (self.in_flight + 1) * self._estimate() > self.max_cost:
+                if self.in_flight == 0:
+                    return False
+                self._settled.wait()
+            self.in_flight += 1
+            return True
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        with self._write_lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                f.flush()
+
+    def _account(self, records: List[Dict[str, Any]]) -> float:
+        cost = sum(record["cost"] for record in records)
+        with self._lock:
+            self.in_flight -= 1
+            self.spent += cost
+            self.finished_costs.append(cost)
+            for record in records:
+                self.usage.prompt_tokens += record["input_tokens"] or 0
+                self.usage.output_tokens += record["output_tokens"] or 0
+            self._settled.notify_all()
+        return cost
+
+    def run_one(self, item: Dict[str, Any]) -> None:
+        item_id = item["id"]
+        mode = item.get("mode") or self.mode
+        model_id = item.get("model") or self.model_id
+
+        if not self._reserve():
+            with self._lock:
+                self.counts["skipped_budget"] += 1
+            print(f"⏭️ [{item_id}] skipped: cost cap ${self.max_cost:.2f} reached")
+            return
+
+        run_id = batch_run_id(self.input_path, item_id)
+        callbacks = BatchCallbacks(item_id, set(), verbose=self.verbose)
+        started_at = datetime.datetime.now().isoformat()
+        record = {"id": item_id, "question": item["question"], "mode": mode, "started_at": started_at}
+        # Everything after _reserve() is inside the try: _account() must run, or capped workers wait forever
+        try:
+            checkpoint = load_checkpoint(run_id)
+            if checkpoint is None:
+                start_run(run_id, "batch", item["question"], mode, model_id, settings={
+                    "mode_category": MULTILAYER_CATEGORY,
+                    "use_search": self.use_search,
+                    "candidate_count": 1,
+                })
+            else:
+                callbacks.restored_phases = set(checkpoint.get("phases", {}))
+                print(f"▶️ [{item_id}] resuming ({len(callbacks.restored_phases)} phases restored)")
+
+            result = run_pipeline_from_checkpoint(
+                item["question"],
+                mode,
+                run_id,
+                callbacks=callbacks,
+                client=self.client,
+                model_id=model_id,
+                use_search=self.use_search,
+                session_id="batch",
+            )
+            cost = self._account(result["usage"])
+            record.update({
+                "status": "ok",
+                "answer": result["final_answer"],
+                "model_id": result["model_id"],
+                "final_mode": result["mode"],
+                "sources": [source["uri"] for source in result["grounding_sources"]],
+                "usage": result["usage"],
+                "cost": round(cost, 6),
+                "phase_timings": callbacks.phase_timings,
+                "elapsed_seconds": callbacks.elapsed(),
+            })
+            if result["phase2_quota_aborted"]:
+                # Draft-only answer: keep the checkpoint so the next resume re-runs Phase 2
+                record["status"] = "error"
+                record["error"] = "Phase 2: quota exhausted"
+                mark_failed(run_id, record["error"])
+            else:
+                finish_run(run_id)
+        except Exception as e:
+            cost = self._account(callbacks.usage_records)
+            mark_failed(run_id, str(e))
+            record.update({
+                "status": "error",
+                "error": str(e)[:500],
+                "usage": callbacks.usage_records,
+                "cost": round(cost, 6),
+                "phase_timings": callbacks.phase_timings,
+                "elapsed_seconds": callbacks.elapsed(),
+            })
+
+        record["finished_at"] = datetime.datetime.now().isoformat()
+        self._write(record)
+        with self._lock:
+            self.counts[record["status"]] += 1
+            spent = self.spent
+        icon = "✅" if record["status"] == "ok" else "❌"
+        print(f"{icon} [{item_id}] {record['elapsed_seconds']:.1f}s ${cost:.4f} (total ${spent:.4f})"
+              + (f" {record['error']}" if record["status"] == "error" else ""))
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run every question not yet answered in the output file.
+
+        Returns:
+            Summary dict (counts, total cost / tokens, elapsed seconds)
+        """
+        questions = load_questions(self.input_path)
+        finished = load_finished_ids(self.output_path)
+        pending = [item for item in questions if item["id"] not in finished]
+        print(f"{len(questions)} questions, {len(finished)} already answered, {len(pending)} to run "
+              f"(concurrency {self.concurrency}" + (f", cap ${self.max_cost:.2f}" if self.max_cost else "") + ")")
+
+        if self.client is None:
+            self.client = get_client()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as pool:
+            for future in [pool.submit(self.run_one, item) for item in pending]:
+                future.result()
+
+        return {
+            **self.counts,
+            "already_answered": len(finished),
+            "input_tokens": self.usage.prompt_tokens,
+            "output_tokens": self.usage.output_tokens,
+            "cost": round(self.spent, 6),
+            "elapsed_seconds": round(time.monotonic() - started, 3),
+        }
+
+    def run_vertex_batch(self, backend=None) -> Dict[str, Any]:
+        """
+        Answer every pending question with one batch prediction job.
+
+        Each question becomes a single grounded call with the pipeline's base
+        system instruction (per-question "mode" is ignored). The cost cap limits
+        how many questions are submitted, using an estimate per question.
+
+        Returns:
+            Summary dict (same keys as run())
+        """
+        backend = backend or get_batch_backend(self.client)
+        questions = load_questions(self.input_path)
+        finished = load_finished_ids(self.output_path)
+        pending = [item for item in questions if item["id"] not in finished]
+
+        job_path = f"{self.output_path}.batchjob"
+        job_name = None
+        if os.path.exists(job_path):
+            with open(job_path, "r", encoding="utf-8") as f:
+                stored_job = json.load(f)
+            job_name = stored_job["job_name"]
+            print(f"▶️ re-attaching to batch job {job_name}")
+            # Only the questions actually submitted (the cost cap may have left some out)
+            if "ids" in stored_job:
+                submitted = set(stored_job["ids"])
+                submitted_pending = [item for item in pending if item["id"] in submitted]
+                self.counts["skipped_budget"] = len(pending) - len(submitted_pending)
+                pending = submitted_pending
+        elif self.max_cost:
+            budget = self.max_cost
+            capped = []
+            for item in pending:
+                estimate = calculate_cost(
+                    self.model_id,
+                    (len(BASE_SYSTEM_INSTRUCTION) + len(item["question"])) // 2,
+                    BATCH_OUTPUT_TOKEN_ESTIMATE,
+                ) * backend.price_factor
+                if estimate > budget:
+                    break
+                budget -= estimate
+                capped.append(item)
+            self.counts["skipped_budget"] = len(pending) - len(capped)
+            pending = capped
+
+        print(f"{len(questions)} questions, {len(finished)} already answered, {len(pending)} submitted as one batch job")
+        started = time.monotonic()
+        started_at = datetime.datetime.now().isoformat()
+        if not pending:
+            return {**self.counts, "already_answered": len(finished), "input_tokens": 0, "output_tokens": 0, "cost": 0.0, "elapsed_seconds": 0.0}
+
+        def remember_job(name: str) -> None:
+            with open(job_path, "w", encoding="utf-8") as f:
+                json.dump({"job_name": name, "submitted_at": started_at, "ids": [item["id"] for item in pending]}, f)
+
+        requests = {
+            item["id"]: build_request(item["question"], system_instruction=BASE_SYSTEM_INSTRUCTION, use_search=self.use_search)
+            for item in pending
+        }
+        results = run_batch(
+            requests,
+            self.model_id,
+            backend=backend,
+            display_name="batch-answers",
+            job_name=job_name,
+            on_submit=remember_job,
+        )
+        elapsed = round(time.monotonic() - started, 3)
+
+        usage_records = []
+        for item in pending:
+            result = results[item["id"]]
+            usage = {
+                "phase": "batch", "model": self.model_id,
+                "input_tokens": result["input_tokens"], "output_tokens": result["output_tokens"],
+                "thinking_tokens": result["thinking_tokens"], "cached_tokens": result["cached_tokens"], "cost": result["cost"],
+            }
+            usage_records.append(usage)
+            self.usage.prompt_tokens += result["input_tokens"]
+            self.usage.output_tokens += result["output_tokens"]
+            self.spent += result["cost"]
+            status = "error" if result["error"] else "ok"
+            self.counts[status] += 1
+            record = {
+                "id": item["id"], "question": item["question"], "mode": "vertex-batch", "started_at": started_at,
+                "status": status, "answer": result["text"], "model_id": self.model_id,
+                "usage": [usage], "cost": round(result["cost"], 6),
+                "phase_timings": {"batch": elapsed}, "elapsed_seconds": elapsed,
+                "finished_at": datetime.datetime.now().isoformat(),
+            }
+            if result["error"]:
+                record["error"] = result["error"]
+            self._write(record)
+        record_usage(usage_records, session_id="batch")
+        os.remove(job_path)
+
+        return {
+            **self.counts,
+            "already_answered": len(finished),
+            "input_tokens": self.usage.prompt_tokens,
+            "output_tokens": self.usage.output_tokens,
+            "cost": round(self.spent, 6),
+            "elapsed_seconds": elapsed,
+        }
+
+
+def default_output_path(input_path: str) -> str:
+    root, _ = os.path.splitext(input_path)
+    return f"{root}.out.jsonl"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a JSONL file of questions through the pipeline")
+    parser.add_argument("input", help="Input JSONL ({\"id\", \"question\", \"mode\"} per line)")
+    parser.add_argument("-o", "--output", help="Output JSONL (default: <input>.out.jsonl)")
+    parser.add_argument("--mode", default=DEFAULT_BATCH_MODE, help="Default response mode label")
+    parser.add_argument("--model", default=DEFAULT_MODEL_ID, help="Gemini model ID")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--max-cost", type=float, default=DEFAULT_MAX_COST, help="Total cost cap in USD (0 = no cap)")
+    parser.add_argument("--no-search", action="store_true", help="Disable Google Search grounding")
+    parser.add_argument("--restart", action="store_true", help="Discard the existing output file instead of resuming")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print pipeline progress")
+    parser.add_argument("--vertex-batch", action="store_true", help="Answer with one Vertex batch prediction job (single call per question)")
+    args = parser.parse_args()
+
+    # Fail before any question runs on unreadable input / duplicate ids
+    try:
+        load_questions(args.input)
+    except ValueError as e:
+        parser.error(str(e))
+
+    output_path = args.output or default_output_path(args.input)
+    if args.restart and os.path.exists(output_path):
+        os.remove(output_path)
+
+    runner = BatchRunner(
+        args.input,
+        output_path,
+        mode=args.mode,
+        model_id=args.model,
+        concurrency=args.concurrency,
+        max_cost=args.max_cost,
+        use_search=not args.no_search,
+        verbose=args.verbose,
+    )
+    summary = runner.run_vertex_batch() if args.vertex_batch else runner.run()
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    sys.exit(1 if summary["error"] else 0)
@@ -0,0 +1,84 @@
+"""
+Phase F: Confidence-driven Model Cascade
+Runs research + synthesis on a fast model first and escalates to the strong
+model (and the multi-model fan-out) only when the answer's self-reported
+confidence is Medium or below, or the question is high risk.
+"""
+
+import re
+from typing import Dict, Any, Optional, Tuple
+
+
+# Fast first pass / escalation target
+CASCADE_FAST_MODEL = "gemini-2.5-flash"
+CASCADE_STRONG_MODEL = "gemini-3-pro-preview"
+
+# Response mode used for the escalated run (pro + meta + fan-out + strict review)
+CASCADE_ESCALATION_MODE = "熟考 (本気MAX)ms/Az"
+
+# Confidence levels accepted without escalation
+ACCEPTED_CONFIDENCE = {"very_high", "high"}
+
+# Appended to the fast model's synthesis instruction so parse_confidence() has a line to read
+CASCADE_CONFIDENCE_INSTRUCTION = """
+
+【自信度の記載（必須）】
+回答の最後に、この回答の自信度を**次のいずれかの形式で1行だけ**必ず書いてください:
+* 自信度: High
+* 自信度: Medium
+* 自信度: Low
+"""
+
+_CONFIDENCE_PATTERN = re.compile(
+    r"(?:自信度|確信度)\s*[:：]\s*\**\s*(Very\s*High|Very\s*Low|High|Medium|Low)",
+    re.IGNORECASE,
+)
+
+
+def parse_confidence(text: str) -> Optional[str]:
+    """
+    Parse the last `自信度: X` / `確信度: X` line of an answer.
+
+    Args:
+        text: Synthesis or review output
+
+    Returns:
+        "very_high" | "high" | "medium" | "low" | "very_low", or None if absent
+    """
+    matches = _CONFIDENCE_PATTERN.findall(text or "")
+    if not matches:
+        return None
+    level = re.sub(r"\s+", "_", matches[-1].strip().lower())
+    return level
+
+
+def should_escalate(confidence: Optional[str], risk_level: Optional[str] = None) -> Tuple[bool, str]:
+    """
+    Decide whether the fast-model answer needs the strong model.
+
+    Args:
+        confidence: Output of parse_confidence()
+        risk_level: Router risk level ("low" | "medium" | "high"), if known
+
+    Returns:
+        Tuple of (escalate, reason)
+    """
+    if risk_level == "high":
+        return True, "高リスク質問"
+    if confidence is None:
+        return True, "自信度の記載なし"
+    if confidence not in ACCEPTED_CONFIDENCE:
+        return True, f"自信度 {confidence}"
+    return False, f"自信度 {confidence}"
+
+
+def build_cascade_info(confidence: Optional[str], risk_level: Optional[str], escalated: bool, reason: str) -> Dict[str, Any]:
+    """Summary stored in the Deep Log (reasoning_logs["cascade"])."""
+    return {
+        "fast_model": CASCADE_FAST_MODEL,
+        "strong_model": CASCADE_STRONG_MODEL,
+        "confidence": confidence,
+        "risk_level": risk_level,
+        "escalated": escalated,
+        "reason": reason,
+    }
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+Phase V: Provider Record & Replay
+Records every outbound model call — Vertex generate_content, OpenRouter /
+GitHub Models chat completions (requests.post) and Bedrock converse — into a
+cassette file, and replays a cassette deterministically with no network
+access, so pipeline performance and output formatting can be regression-tested
+offline against real traffic shapes.
+
+Cassette: JSON lines, one per model call ({"type": "interaction", "provider",
+"key", "request", "response" | "error", "started", "seconds"}) or per recorded
+pipeline run ({"type": "run", "question", "mode", "options", "final_answer",
+"phases", "seconds", "cost"}). Attachments are stored as a hash and a size;
+API keys and headers are never recorded.
+
+Replay matches a request on its key (provider + model + request body, with
+dates and timestamps normalized so a cassette recorded yesterday still
+matches); identical requests are served in recorded order. Without --strict,
+a request that has no exact match takes the next unused call recorded for the
+same provider and model. Each call sleeps for its recorded duration ×
+time_scale (1.0 = original timing, 0 = no waiting).
+
+⚠️ Like logic.py, this module must not import streamlit.
+
+Usage:
+    PROVIDER_CASSETTE_RECORD=traffic.jsonl streamlit run app.py     # record app traffic
+    python cassette.py record traffic.jsonl "質問" [--mode "熟考 (本気MAX)ms/Az"]
+    python cassette.py replay traffic.jsonl [--time-scale 0] [--strict] [--json report.json]
+"""
+
+import argparse
+import copy
+import difflib
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Iterable, Tuple
+
+import requests
+from google.genai import errors as genai_errors
+from google.genai import models as genai_models
+from google.genai import types
+
+import checkpoints
+import providers
+import quota
+import usage_ledger
+from applog import get_logger
+from pipeline import run_pipeline
+from pricing import VERTEX, BEDROCK, OPENROUTER, GITHUB_MODELS
+from telemetry import phase_totals
+
+log = get_logger(__name__)
+
+
+# Set to a cassette path to record every model call of this process (app / job workers)
+PROVIDER_CASSETTE_RECORD = os.getenv("PROVIDER_CASSETTE_RECORD", "")
+
+# OpenAI-compatible model endpoints called through requests.post
+MODEL_HOSTS = {
+    "openrouter.ai": OPENROUTER,
+    "models.inference.ai.azure.com": GITHUB_MODELS,
+}
+
+# Quota limits for offline runs (scaled time would otherwise hit the per-minute windows)
+UNLIMITED_QUOTA = {"rpm": 10 ** 9, "tpm": 10 ** 12}
+
+# Dates and timestamps that change between recording and replay (prompt dates, created_at)
+_VOLATILE_PATTERNS = [
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?"), "<timestamp>"),
+    (re.compile(r"\d{4}年\d{1,2}月\d{1,2}日"), "<date>"),
+    (re.compile(r"\d{4}-\d{2}-\d{2}"), "<date>"),
+]
+
+# Replay: how far the answer may drift before the run is reported as changed
+ANSWER_MATCH_RATIO = 0.98
+
+
+class CassetteMiss(RuntimeError):
+    """A request with no recorded response (replay)."""
+
+
+def model_host_provider(url: str) -> Optional[str]:
+    """Provider of an OpenAI-compatible model endpoint URL (None for other URLs)."""
+    return next((provider for host, provider in MODEL_HOSTS.items() if host in url), None)
+
+
+def _jsonable(value: Any) -> Any:
+    """SDK objects / dicts / lists as JSON values, with inline attachment bytes replaced by a digest."""
+    if hasattr(value, "model_dump"):
+        value = value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, dict):
+        if "data" in value and "mime_type" in value:
+            data = value["data"]
+            data = data.encode("utf-8") if isinstance(data, str) else bytes(data or b"")
+            return {"mime_type": value["mime_type"], "sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, bytes):
+        return {"sha256": hashlib.sha256(value).hexdigest(), "size": len(value)}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _normalize(text: str) -> str:
+    for pattern, placeholder in _VOLATILE_PATTERNS:
+        text = pattern.sub(placeholder, text)
+    return text
+
+
+def request_key(provider: str, request: Dict[str, Any]) -> str:
+    """Match key of a recorded request (volatile dates normalized)."""
+    canonical = json.dumps({"provider": provider, **request}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(_normalize(canonical).encode("utf-8")).hexdigest()[:24]
+
+
+def _model_of(request: Dict[str, Any]) -> str:
+    return request.get("model") or request.get("modelId") or (request.get("json") or {}).get("model") or ""
+
+
+def load_cassette(path: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Read a cassette file.
+
+    Returns:
+        (interactions, runs) in recorded order
+    """
+    interactions, runs = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            (runs if entry.get("type") == "run" else interactions).append(entry)
+    return interactions, runs
+
+
+class Recorder:
+    """
+    Appends model calls to a cassette while installed.
+
+    install() wraps google.genai Models.generate_content (every client,
+    including QuotaLimitedClient's), requests.post for the model endpoints and
+    providers.boto3 for Bedrock; uninstall() restores them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._saved: Optional[Dict[str, Any]] = None
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def _record(self, provider: str, request: Dict[str, Any], started: float, response=None, error=None) -> None:
+        entry = {
+            "type": "interaction",
+            "provider": provider,
+            "key": request_key(provider, request),
+            "request": request,
+            "started": round(started - self._started, 3),
+            "seconds": round(time.time() - started, 3),
+        }
+        if error is not None:
+            entry["error"] = error
+        else:
+            entry["response"] = response
+        try:
+            self.append(entry)
+        except Exception as e:
+            # A failed write must not fail the model call
+            log.warning("cassette write failed", path=self.path, error=str(e))
+
+    def install(self) -> None:
+        if self._saved is not None:
+            return
+        recorder = self
+        self._saved = {
+            "generate_content": genai_models.Models.generate_content,
+            "post": requests.post,
+            "boto3": getattr(providers, "boto3", None),
+        }
+        real_generate, real_post = self._saved["generate_content"], self._saved["post"]
+
+        def generate_content(models_self, *, model: str, contents, config=None, **kwargs):
+            request = {"model": model, "contents": _jsonable(contents), "config": _jsonable(config)}
+            started = time.time()
+            try:
+                response = real_generate(models_self, model=model, contents=contents, config=config, **kwargs)
+            except genai_errors.APIError as e:
+                recorder._record(VERTEX, request, started, error={"kind": "api", "code": e.code, "details": _jsonable(e.details)})
+                raise
+            except Exception as e:
+                recorder._record(VERTEX, request, started, error={"kind": type(e).__name__, "message": str(e)})
+                raise
+            recorder._record(VERTEX, request, started, response=_jsonable(response))
+            return response
+
+        def post(url, *args, **kwargs):
+            provider = model_host_provider(url)
+            if provider is None:
+                return real_post(url, *args, **kwargs)
+            # Headers carry the API key and are not recorded
+            request = {"url": url, "json": _jsonable(kwargs.get("json")), "timeout": kwargs.get("timeout")}
+            started = time.time()
+            try:
+                response = real_post(url, *args, **kwargs)
+            except Exception as e:
+                recorder._record(provider, request, started, error={"kind": type(e).__name__, "message": str(e)})
+                raise
+            recorder._record(provider, request, started, response={"status_code": response.status_code, "text": response.text})
+            return response
+
+        genai_models.Models.generate_content = generate_content
+        requests.post = post
+        if self._saved["boto3"] is not None:
+            providers.boto3 = _RecordingBoto3(self._saved["boto3"], self)
+
+    def uninstall(self) -> None:
+        if self._saved is None:
+            return
+        genai_models.Models.generate_content = self._saved["generate_content"]
+        requests.post = self._saved["post"]
+        if self._saved["boto3"] is not None:
+            providers.boto3 = self._saved["boto3"]
+        self._saved = None
+
+
+class _RecordingBoto3:
+    """providers.boto3 proxy whose bedrock-runtime clients record converse()."""
+
+    def __init__(self, boto3_module, recorder: Recorder):
+        self._boto3 = boto3_module
+        self._recorder = recorder
+
+    def client(self, *args, **kwargs):
+        return _RecordingBedrockClient(self._boto3.client(*args, **kwargs), self._recorder)
+
+    def __getattr__(self, name):
+        return getattr(self._boto3, name)
+
+
+class _RecordingBedrockClient:
+    def __init__(self, client, recorder: Recorder):
+        self._client = client
+        self._recorder = recorder
+
+    def converse(self, **kwargs):
+        request = _jsonable(kwargs)
+        started = time.time()
+        try:
+            response = self._client.converse(**kwargs)
+        except Exception as e:
+            self._recorder._record(BEDROCK, request, started, error={"kind": type(e).__name__, "message": str(e)})
+            raise
+        self._recorder._record(BEDROCK, request, started, response=_jsonable(response))
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+@contextmanager
+def record_providers(path: str):
+    """Record every model call made inside the block to the cassette at path (appended)."""
+    recorder = Recorder(path)
+    recorder.install()
+    try:
+        yield recorder
+    finally:
+        recorder.uninstall()
+
+
+_process_recorder: Optional[Recorder] = None
+
+
+def start_recording_from_env() -> None:
+    """Record the whole process's model calls when PROVIDER_CASSETTE_RECORD is set (once per process)."""
+    global _process_recorder
+    if PROVIDER_CASSETTE_RECORD and _process_recorder is None:
+        _process_recorder = Recorder(PROVIDER_CASSETTE_RECORD)
+        _process_recorder.install()
+        log.info("recording model calls", path=PROVIDER_CASSETTE_RECORD)
+
+
+class Player:
+    """Serves recorded responses: exact key in recorded order, then (unless strict) the next call of the same provider / model."""
+
+    def __init__(self, interactions: Iterable[Dict[str, Any]], time_scale: float = 1.0, strict: bool = False):
+        self.time_scale = time_scale
+        self.strict = strict
+        self._lock = threading.Lock()
+        self._entries = list(interactions)
+        self._by_key: Dict[str, deque] = {}
+        self._by_model: Dict[Tuple[str, str], deque] = {}
+        for index, entry in enumerate(self._entries):
+            self._by_key.setdefault(entry["key"], deque()).append(index)
+            self._by_model.setdefault((entry["provider"], _model_of(entry["request"])), deque()).append(index)
+        self._used = set()
+        self.exact = 0
+        self.fallbacks = 0
+        self.misses: List[Dict[str, Any]] = []
+
+    @property
+    def providers(self) -> set:
+        return {entry["provider"] for entry in self._entries}
+
+    @staticmethod
+    def _next_unused(queue: deque, used: set) -> Optional[int]:
+        while queue and queue[0] in used:
+            queue.popleft()
+        return queue.popleft() if queue else None
+
+    def play(self, provider: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Recorded interaction for a request (after sleeping for its scaled duration)."""
+        key = request_key(provider, request)
+        model = _model_of(request)
+        with self._lock:
+            index = self._next_unused(self._by_key.get(key, deque()), self._used)
+            if index is not None:
+                self.exact += 1
+            elif not self.strict:
+                index = self._next_unused(self._by_model.get((provider, model), deque()), self._used)
+                if index is not None:
+                    self.fallbacks += 1
+            if index is None:
+                self.misses.append({"provider": provider, "model": model, "key": key})
+                raise CassetteMiss(f"No recorded {provider} response for {model or 'request'} (key {key})")
+            self._used.add(index)
+            entry = self._entries[index]
+        if self.time_scale > 0:
+            time.sleep(entry["seconds"] * self.time_scale)
+        return entry
+
+    def unused(self) -> int:
+        with self._lock:
+            return len(self._entries) - len(self._used)
+
+
+def _raise_recorded(error: Dict[str, Any]) -> None:
+    if error["kind"] == "api":
+        genai_errors.APIError.raise_error(error["code"], error["details"], None)
+    if error["kind"] in ("Timeout", "ReadTimeout", "ConnectTimeout"):
+        raise requests.Timeout(error["message"])
+    if error["kind"] == "ConnectionError":
+        raise requests.ConnectionError(error["message"])
+    raise RuntimeError(error.get("message", error["kind"]))
+
+
+class ReplayClient:
+    """genai.Client stand-in serving generate_content from a cassette (wrap it in QuotaLimitedClient for the pipeline)."""
+
+    def __init__(self, player: Player):
+        self._player = player
+        self.models = self
+
+    def generate_content(self, *, model: str, contents, config=None, **kwargs):
+        entry = self._player.play(VERTEX, {"model": model, "contents": _jsonable(contents), "config": _jsonable(config)})
+        if "error" in entry:
+            _raise_recorded(entry["error"])
+        return types.GenerateContentResponse.model_validate(copy.deepcopy(entry["response"]))
+
+
+class _ReplayBoto3:
+    def __init__(self, player: Player):
+        self._player = player
+
+    def client(self, *args, **kwargs) -> "_ReplayBoto3":
+        return self
+
+    def converse(self, **kwargs):
+        entry = self._player.play(BEDROCK, _jsonable(kwargs))
+        if "error" in entry:
+            _raise_recorded(entry["error"])
+        return copy.deepcopy(entry["response"])
+
+
+def _replay_post(player: Player):
+    def post(url, *args, **kwargs):
+        provider = model_host_provider(url)
+        if provider is None:
+            raise CassetteMiss(f"Replay does not serve {url}")
+        entry = player.play(provider, {"url": url, "json": _jsonable(kwargs.get("json")), "timeout": kwargs.get("timeout")})
+        if "error" in entry:
+            _raise_recorded(entry["error"])
+        response = requests.Response()
+        response.status_code = entry["response"]["status_code"]
+        response._content = entry["response"]["text"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = url
+        return response
+    return post
+
+
+@contextmanager
+def isolated_pipeline_state(enabled_providers: Iterable[str] = (OPENROUTER, BEDROCK, GITHUB_MODELS), real_quotas: bool = False):
+    """
+    Offline pipeline runs (benchmarks, replay) without touching the real ledger, checkpoints or quota windows.
+
+    Sets placeholder credentials for enabled_providers (the others are
+    disabled), records usage in a temporary ledger and checkpoints in a
+    temporary directory, and lifts the per-minute quotas unless real_quotas.
+
+    Yields:
+        The temporary directory
+    """
+    enabled = set(enabled_providers)
+    saved_credentials = {
+        "openrouter_api_key": providers.OPENROUTER_API_KEY,
+        "aws_access_key_id": providers.AWS_ACCESS_KEY_ID,
+        "aws_secret_access_key": providers.AWS_SECRET_ACCESS_KEY,
+        "github_token": providers.GITHUB_TOKEN,
+    }
+    saved_ledger = usage_ledger._usage_ledger
+    saved_checkpoint_dir = checkpoints.CHECKPOINT_DIR
+    saved_quotas = (quota.MODEL_QUOTAS, quota.DEFAULT_QUOTA)
+
+    with tempfile.TemporaryDirectory(prefix="offline_pipeline_") as workdir:
+        try:
+            providers.configure_credentials(
+                openrouter_api_key="offline" if OPENROUTER in enabled else "",
+                aws_access_key_id="offline" if BEDROCK in enabled else "",
+                aws_secret_access_key="offline" if BEDROCK in enabled else "",
+                github_token="offline" if GITHUB_MODELS in enabled else "",
+            )
+            usage_ledger._usage_ledger = usage_ledger.UsageLedger(os.path.join(workdir, "usage_ledger.db"), legacy_file=None)
+            checkpoints.CHECKPOINT_DIR = os.path.join(workdir, "checkpoints")
+            if not real_quotas:
+                quota.MODEL_QUOTAS, quota.DEFAULT_QUOTA = {}, UNLIMITED_QUOTA
+            yield workdir
+        finally:
+            quota.MODEL_QUOTAS, quota.DEFAULT_QUOTA = saved_quotas
+            checkpoints.CHECKPOINT_DIR = saved_checkpoint_dir
+            usage_ledger._usage_ledger = saved_ledger
+            providers.configure_credentials(**saved_credentials)
+
+
+@contextmanager
+def replay_providers(path: str, time_scale: float = 1.0, strict: bool = False, real_quotas: bool = False):
+    """
+    Serve every model call made inside the block from the cassette at path.
+
+    Only the fan-out providers present in the cassette are enabled, so the
+    pipeline takes the same branches as when it was recorded.
+
+    Yields:
+        {"client": Gemini client for run_pipeline, "player": Player, "runs": recorded runs}
+    """
+    interactions, runs = load_cassette(path)
+    player = Player(interactions, time_scale, strict)
+    saved_post = requests.post
+    saved_boto3 = (getattr(providers, "boto3", None), providers.HAS_BOTO3)
+
+    with isolated_pipeline_state(player.providers, real_quotas):
+        try:
+            requests.post = _replay_post(player)
+            providers.boto3, providers.HAS_BOTO3 = _ReplayBoto3(player), True
+            yield {"client": quota.QuotaLimitedClient(ReplayClient(player), quota.QuotaLedger()), "player": player, "runs": runs}
+        finally:
+            requests.post = saved_post
+            providers.boto3, providers.HAS_BOTO3 = saved_boto3
+
+
+# Pipeline options stored with a recorded run and passed back on replay
+RUN_OPTIONS = ("model_id", "mode_category", "use_search", "review_patch_mode", "skip_phases")
+
+
+def record_run(path: str, question: str, mode: str, client=None, **options) -> Dict[str, Any]:
+    """
+    Run the pipeline once against the real providers and record its calls and result.
+
+    Args:
+        path: Cassette file (appended)
+        question / mode: As run_pipeline()
+        client: Gemini client (defaults to logic.get_client())
+        options: RUN_OPTIONS passed to run_pipeline()
+
+    Returns:
+        The run_pipeline() result
+    """
+    unknown = set(options) - set(RUN_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unsupported run options: {', '.join(sorted(unknown))}")
+    with record_providers(path) as recorder:
+        started = time.perf_counter()
+        result = run_pipeline(question, mode, history=[], sessions=[], client=client, **options)
+        seconds = time.perf_counter() - started
+    recorder.append({
+        "type": "run",
+        "question": question,
+        "mode": mode,
+        "options": options,
+        "final_answer": result["final_answer"],
+        "phases": phase_totals(result["reasoning_logs"].get("telemetry")),
+        "seconds": round(seconds, 3),
+        "cost": result["cost"],
+    })
+    return result
+
+
+def replay_runs(path: str, time_scale: float = 1.0, strict: bool = False) -> Dict[str, Any]:
+    """
+    Re-run every recorded run against the cassette and compare with the recording.
+
+    Returns:
+        {"runs": [{question, mode, answer_match, answer_ratio, seconds, recorded_seconds,
+                   phases: {phase: {"recorded", "replayed"}}, error?}],
+         "exact", "fallbacks", "misses", "unused"}
+    """
+    report = {"time_scale": time_scale, "strict": strict, "runs": []}
+    with replay_providers(path, time_scale, strict) as replay:
+        for run in replay["runs"]:
+            entry = {"question": run["question"], "mode": run["mode"], "recorded_seconds": run["seconds"]}
+            started = time.perf_counter()
+            try:
+                result = run_pipeline(run["question"], run["mode"], history=[], sessions=[], client=replay["client"], **run["options"])
+            except Exception as e:
+                entry["error"] = f"{type(e).__name__}: {e}"[:300]
+                report["runs"].append(entry)
+                continue
+            entry["seconds"] = round(time.perf_counter() - started, 3)
+            ratio = difflib.SequenceMatcher(None, run["final_answer"], result["final_answer"]).ratio()
+            entry["answer_ratio"] = round(ratio, 4)
+            entry["answer_match"] = ratio >= ANSWER_MATCH_RATIO
+            replayed = phase_totals(result["reasoning_logs"].get("telemetry"))
+            entry["phases"] = {
+                phase: {"recorded": run["phases"].get(phase), "replayed": replayed.get(phase)}
+                for phase in dict.fromkeys([*run["phases"], *replayed])
+            }
+            report["runs"].append(entry)
+        player = replay["player"]
+        report.update({"exact": player.exact, "fallbacks": player.fallbacks, "misses": player.misses, "unused": player.unused()})
+    return report
+
+
+def format_replay_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"Replay: {len(report['runs'])} runs, time scale {report['time_scale']}, "
+        f"{report['exact']} exact / {report['fallbacks']} fallback matches, {len(report['misses'])} misses, {report['unused']} unused",
+        "",
+    ]
+    for run in report["runs"]:
+        lines.append(f"■ {run['mode']}: {run['question'][:60]}")
+        if "error" in run:
+            lines.append(f"  ❌ {run['error']}")
+            continue
+        mark = "✅" if run["answer_match"] else "❌"
+        lines.append(f"  {mark} answer similarity {run['answer_ratio']:.2%}  time {run['seconds']:.2f}s (recorded {run['recorded_seconds']:.2f}s)")
+        for phase, seconds in run["phases"].items():
+            recorded = "-" if seconds["recorded"] is None else f"{seconds['recorded']:.2f}s"
+            replayed = "-" if seconds["replayed"] is None else f"{seconds['replayed']:.2f}s"
+            lines.append(f"    {phase:<22} recorded {recorded:>8}  replayed {replayed:>8}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record / replay model calls of the pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="Run the pipeline against the real providers and record it")
+    record.add_argument("cassette", help="Cassette file (JSON lines, appended)")
+    record.add_argument("question", nargs="+", help="Question(s) to run")
+    record.add_argument("--mode", default="熟考 (本気MAX)ms/Az", help="Response mode label as shown in the UI")
+    record.add_argument("--model", help="Gemini model ID")
+
+    replay = commands.add_parser("replay", help="Re-run the recorded runs offline and compare")
+    replay.add_argument("cassette", help="Cassette file")
+    replay.add_argument("--time-scale", type=float, default=1.0, help="Multiplier for the recorded call durations (0 = no waiting)")
+    replay.add_argument("--strict", action="store_true", help="Only exact request matches (fail on any prompt change)")
+    replay.add_argument("--json", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        options = {"model_id": args.model} if args.model else {}
+        for question in args.question:
+            result = record_run(args.cassette, question, args.mode, **options)
+            print(f"✅ {question[:60]} (${result['cost']:.4f}) → {args.cassette}")
+        return
+
+    report = replay_runs(args.cassette, args.time_scale, args.strict)
+    print(format_replay_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    failed = report["misses"] or any("error" in run or not run["answer_match"] for run in report["runs"])
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Pipeline Checkpoints - Resumable runs
+Persists each phase's output keyed by run id as soon as the phase completes,
+so a Streamlit rerun, a dropped websocket or a Phase 2 quota failure does not
+throw away the (already paid for) Phase 1 / 1.5 work.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import json
+import uuid
+import datetime
+import threading
+from typing import Dict, Any, Optional, List
+
+import metrics
+
+CHECKPOINT_DIR = "pipeline_checkpoints"
+metrics.watch_file("checkpoints", CHECKPOINT_DIR)
+
+# A "running" checkpoint untouched for this long belongs to a run that died (offered for resume)
+STALE_RUN_SECONDS = int(os.getenv("CHECKPOINT_STALE_SECONDS", "600"))
+
+# Per-run locks: phases finishing on different threads must not lose each other's load-modify-write
+_run_locks: Dict[str, threading.Lock] = {}
+_run_locks_lock = threading.Lock()
+
+# Phase order used to find the first missing phase on resume
+PHASE_ORDER = ["phase1", "phase1_3", "phase1_5a", "phase1_5", "phase2", "phase3"]
+
+PHASE_LABELS = {
+    "phase1": "Phase 1 (リサーチ)",
+    "phase1_3": "Phase 1.3 (JSON IR)",
+    "phase1_5a": "Phase 1.5a (メタ質問)",
+    "phase1_5": "Phase 1.5 (マルチモデル思考)",
+    "phase2": "Phase 2 (統合)",
+    "phase3": "Phase 3 (レビュー)",
+}
+
+
+def _checkpoint_path(run_id: str) -> str:
+    return os.path.join(CHECKPOINT_DIR, f"{run_id}.json")
+
+
+def _run_lock(run_id: str) -> threading.Lock:
+    with _run_locks_lock:
+        return _run_locks.setdefault(run_id, threading.Lock())
+
+
+def _write_checkpoint(checkpoint: Dict[str, Any]) -> None:
+    """Atomic write (tmp file + rename) so a killed rerun never leaves half a file."""
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    path = _checkpoint_path(checkpoint["run_id"])
+    # Unique per writer: a second process (worker / batch) must not share the tmp file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex[:8]}.tmp"
+    with metrics.timed("store_write_seconds", {"store": "checkpoints"}, metrics.WRITE_BUCKETS):
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(checkpoint, f, indent=2, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def new_run_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def start_run(
+    run_id: str,
+    session_id: str,
+    prompt: str,
+    response_mode: str,
+    model_id: str,
+    settings: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Create the checkpoint file for a new pipeline run.
+
+    Args:
+        run_id: Run id from new_run_id()
+        session_id: Chat session the run belongs to
+        prompt: User question
+        response_mode: Selected response mode label
+        model_id: Gemini model id
+        settings: Other inputs needed to rebuild the run (mode_category, use_search, ...)
+
+    Returns:
+        The checkpoint dict
+    """
+    now = datetime.datetime.now().isoformat()
+    checkpoint = {
+        "run_id": run_id,
+        "session_id": session_id,
+        "prompt": prompt,
+        "response_mode": response_mode,
+        "model_id": model_id,
+        "settings": settings or {},
+        "status": "running",
+        "error": None,
+        "phases": {},
+        "created_at": now,
+        "updated_at": now,
+    }
+    with _run_lock(run_id):
+        _write_checkpoint(checkpoint)
+    return checkpoint
+
+
+def load_checkpoint(run_id: str) -> Optional[Dict[str, Any]]:
+    path = _checkpoint_path(run_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return None
+
+
+def save_phase(run_id: str, phase: str, data: Dict[str, Any]) -> None:
+    """
+    Persist one phase's output. Missing checkpoints are ignored (run already finished).
+    """
+    with _run_lock(run_id):
+        checkpoint = load_checkpoint(run_id)
+        if checkpoint is None:
+            return
+        checkpoint["phases"][phase] = data
+        checkpoint["updated_at"] = datetime.datetime.now().isoformat()
+        _write_checkpoint(checkpoint)
+
+
+def update_run(run_id: str, drop_phases: Optional[List[str]] = None, **fields) -> None:
+    """
+    Change run-level fields (response_mode, model_id, settings, ...) before a resume.
+
+    Args:
+        run_id: Run id
+        drop_phases: Phase outputs to discard so they are re-run
+        **fields: Top-level checkpoint fields to overwrite
+    """
+    with _run_lock(run_id):
+        checkpoint = load_checkpoint(run_id)
+        if checkpoint is None:
+            return
+        checkpoint.update(fields)
+        for phase in drop_phases or []:
+            checkpoint["phases"].pop(phase, None)
+        checkpoint["updated_at"] = datetime.datetime.now().isoformat()
+        _write_checkpoint(checkpoint)
+
+
+def mark_failed(run_id: str, error: str) -> None:
+    """Keep the checkpoint for resume and record why the run stopped."""
+    with _run_lock(run_id):
+        checkpoint = load_checkpoint(run_id)
+        if checkpoint is None:
+            return
+        checkpoint["status"] = "failed"
+        checkpoint["error"] = error[:500]
+        checkpoint["updated_at"] = datetime.datetime.now().isoformat()
+        _write_checkpoint(checkpoint)
+
+
+def finish_run(run_id: str) -> None:
+    """The answer is stored in the session, so the checkpoint is no longer needed."""
+    path = _checkpoint_path(run_id)
+    with _run_lock(run_id):
+        if os.path.exists(path):
+            os.remove(path)
+    with _run_locks_lock:
+        _run_locks.pop(run_id, None)
+
+
+def first_missing_phase(checkpoint: Dict[str, Any]) -> Optional[str]:
+    """Return the first phase (in PHASE_ORDER) without a stored output, or None."""
+    phases = checkpoint.get("phases", {})
+    for phase in PHASE_ORDER:
+        if phase not in phases:
+            return phase
+    return None
+
+
+def is_stale(checkpoint: Dict[str, Any], stale_seconds: float = STALE_RUN_SECONDS) -> bool:
+    """True if the checkpoint has not been written for stale_seconds (or has no usable updated_at)."""
+    try:
+        updated_at = datetime.datetime.fromisoformat(checkpoint.get("updated_at") or "")
+    except ValueError:
+        return True
+    return (datetime.datetime.now() - updated_at).total_seconds() >= stale_seconds
+
+
+def find_incomplete_runs(session_id: str) -> List[Dict[str, Any]]:
+    """
+    List unfinished runs of a session, newest first.
+
+    Failed runs are always listed; "running" ones only once they are stale
+    (STALE_RUN_SECONDS), so a run still in progress elsewhere is not resumed twice.
+
+    Args:
+        session_id: Chat session id
+
+    Returns:
+        List of checkpoint dicts
+    """
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return []
+
+    runs = []
+    for name in os.listdir(CHECKPOINT_DIR):
+        if not name.endswith(".json"):
+            continue
+        checkpoint = load_checkpoint(name[:-len(".json")])
+        if not checkpoint or checkpoint.get("session_id") != session_id:
+            continue
+        if checkpoint.get("status") == "running" and not is_stale(checkpoint):
+            continue
+        runs.append(checkpoint)
+
+    runs.sort(key=lambda c: c.get("updated_at", ""), reverse=True)
+    return runs
@@ -0,0 +1,315 @@
+"""
+Phase Q: Pre-run Estimator
+Projects the tokens, cost and wall time of one turn in a given mode before it
+runs, from the per-phase averages in the usage ledger (falling back to typical
+values for phases without enough history) and the pricing registry. plan_within_budget()
+drops the expensive optional phases (Claude, final review, ...) one at a time
+when the projection would exceed the per-turn cap or the remaining monthly
+budget, so the hard MAX_BUDGET_USD stop is not hit in the middle of a run.
+
+⚠️ Like logic.py, this module must not import streamlit.
+
+Usage:
+    python estimator.py ["熟考 (本気MAX)ms/Az"] [--model gemini-3-pro-preview]
+"""
+
+import os
+import time
+from typing import Dict, Any, Optional, List, Iterable
+
+from logic import MAX_BUDGET_USD, MAX_TURN_COST_USD
+from pricing import token_usage, usage_cost
+from usage_ledger import get_usage_ledger
+from cascade import CASCADE_FAST_MODEL, CASCADE_STRONG_MODEL, CASCADE_ESCALATION_MODE
+from providers import CLAUDE_MODEL_ID, SECONDARY_MODEL_ID, has_openrouter, has_bedrock, has_github_models
+from pipeline import MULTILAYER_CATEGORY, DEFAULT_MODEL_ID
+from router_benchmark import PHASE_ESTIMATES
+
+
+# Ledger history used for the averages
+ESTIMATE_HISTORY_DAYS = int(os.getenv("ESTIMATE_HISTORY_DAYS", "30"))
+
+# Recorded calls needed before a (phase, model) average replaces the typical values
+MIN_HISTORY_CALLS = 3
+
+# Typical tokens / latency (seconds) per billed phase (ledger phase names)
+PHASE_DEFAULTS = {
+    **PHASE_ESTIMATES,
+    "light_review": {"input": 2500,  "output": 1500, "latency": 12.0},
+    "phase1_5b":    {"input": 3000,  "output": 1500, "latency": 30.0},
+    "phase1_5d":    {"input": 5000,  "output": 2000, "latency": 30.0},
+    "phase1_5e":    {"input": 1200,  "output": 1500, "latency": 20.0},
+    "phase3_patch": {"input": 11000, "output": 800,  "latency": 20.0},
+    "phase3b":      {"input": 6000,  "output": 1000, "latency": 25.0},
+}
+
+# Share of diff reviews that fall back to a full Phase 3 rewrite when the ledger has no history
+REVIEW_FALLBACK_RATE = 0.3
+
+# "オート" picks its pipeline at run time; the estimate assumes the heaviest one
+AUTO_UPPER_BOUND_MODE = "熟考 (本気MAX)ms/Az"
+
+# Single-call mode used when even the reduced pipeline does not fit
+LIGHT_MODE = "β1高速 (通常)"
+
+# Optional phases dropped in this order (run_pipeline skip_phases names)
+DOWNGRADE_LADDER = [
+    ("phase1_5d", "Claude 4.5 (Phase 1.5d) を省略"),
+    ("phase3b", "最終レビュー (Phase 3b) を省略"),
+    ("phase3", "鬼軍曹レビュー (Phase 3) を省略"),
+    ("phase1_5", "メタ質問・多モデル思考 (Phase 1.5) を省略"),
+]
+
+
+def load_phase_stats() -> Dict[tuple, Dict[str, Any]]:
+    """Per (phase, model) averages over the last ESTIMATE_HISTORY_DAYS of the usage ledger."""
+    return get_usage_ledger().phase_stats(since=time.time() - ESTIMATE_HISTORY_DAYS * 86400)
+
+
+def _price_call(model: str, input_tokens: float, output_tokens: float) -> float:
+    # OpenRouter / GitHub Models free tiers price at zero in the registry
+    return usage_cost(model, token_usage(input_tokens, output_tokens))
+
+
+def plan_steps(
+    response_mode: str,
+    mode_category: str = MULTILAYER_CATEGORY,
+    model_id: str = DEFAULT_MODEL_ID,
+    review_patch_mode: bool = True,
+    skip_phases: Iterable[str] = (),
+    reused_phases: Iterable[str] = ()
+) -> List[Dict[str, Any]]:
+    """
+    Billed steps run_pipeline() will take for a mode (same flags as run_pipeline).
+
+    Args:
+        response_mode: Response mode label
+        mode_category: "🎯 回答モード(多層)" or "🎯 回答モード(通常)"
+        model_id: Gemini model for the Gemini phases
+        review_patch_mode: Phase 3 asks for edit operations first
+        skip_phases: run_pipeline skip_phases
+        reused_phases: Phases not re-run (a cascade escalation reuses phase1 / phase1_3)
+
+    Returns:
+        [{"phase", "model", "weight", "parallel"}] in run order; parallel steps overlap
+    """
+    skip_phases = set(skip_phases)
+    reused_phases = set(reused_phases)
+    enable_research = "β1" not in response_mode
+    enable_meta = ("メタ" in response_mode or "MAX" in response_mode or "grok" in response_mode) and "phase1_5" not in skip_phases
+    enable_strict = ("鬼軍曹" in response_mode or "MAX" in response_mode) and "phase3" not in skip_phases
+    is_ms_az_mode = "ms/Az" in response_mode
+    fan_out = "phase1_5" not in skip_phases
+
+    steps = []
+
+    def add(phase, model, weight=1.0, parallel=False):
+        if phase not in reused_phases:
+            steps.append({"phase": phase, "model": model, "weight": weight, "parallel": parallel})
+
+    if not enable_research:
+        add("light", model_id)
+        if enable_strict:
+            add("light_review", model_id)
+        return steps
+
+    add("phase1", model_id)
+    if is_ms_az_mode:
+        add("phase1_3", model_id)
+    if enable_meta:
+        add("phase1_5a", model_id)
+        if has_openrouter():
+            add("phase1_5b", SECONDARY_MODEL_ID, parallel=True)
+    if fan_out and "Az" in response_mode and has_bedrock() and "phase1_5d" not in skip_phases:
+        add("phase1_5d", CLAUDE_MODEL_ID, parallel=True)
+    if fan_out and is_ms_az_mode and has_github_models():
+        add("phase1_5e", "o4-mini", parallel=True)
+    add("phase2", model_id)
+    if enable_strict:
+        if review_patch_mode:
+            add("phase3_patch", model_id)
+            add("phase3", model_id, weight=REVIEW_FALLBACK_RATE)
+        else:
+            add("phase3", model_id)
+        if mode_category == MULTILAYER_CATEGORY and has_openrouter() and "phase3b" not in skip_phases:
+            add("phase3b", SECONDARY_MODEL_ID)
+    return steps
+
+
+def _estimate_steps(steps: List[Dict[str, Any]], stats: Dict[tuple, Dict[str, Any]]) -> Dict[str, Any]:
+    estimated = []
+    input_tokens = output_tokens = cost = seconds = 0.0
+    parallel_seconds = 0.0
+    for step in steps:
+        history = stats.get((step["phase"], step["model"]))
+        default = PHASE_DEFAULTS[step["phase"]]
+        weight = step["weight"]
+        if step["phase"] == "phase3" and weight < 1.0:
+            # Diff-review fallback rate from the ledger when both calls have history
+            patches = stats.get(("phase3_patch", step["model"]), {}).get("calls", 0)
+            if patches >= MIN_HISTORY_CALLS:
+                weight = min(1.0, (history or {}).get("calls", 0) / patches)
+        if history and history["calls"] >= MIN_HISTORY_CALLS:
+            step_in, step_out = history["input_tokens"], history["output_tokens"]
+            step_seconds = history["latency"] or default["latency"]
+            source = "history"
+        else:
+            step_in, step_out, step_seconds = default["input"], default["output"], default["latency"]
+            source = "default"
+        step_cost = _price_call(step["model"], step_in, step_out) * weight
+        estimated.append({**step, "weight": weight, "input_tokens": int(step_in * weight), "output_tokens": int(step_out * weight),
+                          "cost": step_cost, "seconds": step_seconds * weight, "source": source})
+        input_tokens += step_in * weight
+        output_tokens += step_out * weight
+        cost += step_cost
+        if step["parallel"]:
+            parallel_seconds = max(parallel_seconds, step_seconds)
+        else:
+            seconds += parallel_seconds + step_seconds * weight
+            parallel_seconds = 0.0
+    seconds += parallel_seconds
+    return {
+        "steps": estimated,
+        "input_tokens": int(input_tokens),
+        "output_tokens": int(output_tokens),
+        "cost": cost,
+        "seconds": seconds,
+    }
+
+
+def estimate_run(
+    response_mode: str,
+    mode_category: str = MULTILAYER_CATEGORY,
+    model_id: str = DEFAULT_MODEL_ID,
+    review_patch_mode: bool = True,
+    skip_phases: Iterable[str] = (),
+    stats: Optional[Dict[tuple, Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """
+    Projected tokens, cost and wall time of one turn.
+
+    Args:
+        response_mode / mode_category / model_id / review_patch_mode / skip_phases: As run_pipeline()
+        stats: load_phase_stats() result (loaded when None)
+
+    Returns:
+        {"mode", "steps", "input_tokens", "output_tokens", "cost", "seconds",
+         "max_cost", "max_seconds", "history_steps"}; max_* include a cascade
+        escalation / the heaviest オート route
+    """
+    stats = load_phase_stats() if stats is None else stats
+    skip_phases = list(skip_phases)
+    if "オート" in response_mode:
+        estimate = _estimate_steps(plan_steps(AUTO_UPPER_BOUND_MODE, mode_category, model_id, review_patch_mode, skip_phases), stats)
+        max_cost, max_seconds = estimate["cost"], estimate["seconds"]
+    elif "カスケード" in response_mode:
+        estimate = _estimate_steps(plan_steps(response_mode, mode_category, CASCADE_FAST_MODEL, review_patch_mode, skip_phases), stats)
+        escalation = _estimate_steps(plan_steps(
+            CASCADE_ESCALATION_MODE, mode_category, CASCADE_STRONG_MODEL, review_patch_mode, skip_phases,
+            reused_phases=("phase1", "phase1_3"),
+        ), stats)
+        max_cost = estimate["cost"] + escalation["cost"]
+        max_seconds = estimate["seconds"] + escalation["seconds"]
+    else:
+        estimate = _estimate_steps(plan_steps(response_mode, mode_category, model_id, review_patch_mode, skip_phases), stats)
+        max_cost, max_seconds = estimate["cost"], estimate["seconds"]
+
+    estimate.update({
+        "mode": response_mode,
+        "max_cost": max_cost,
+        "max_seconds": max_seconds,
+        "history_steps": sum(1 for step in estimate["steps"] if step["source"] == "history"),
+    })
+    return estimate
+
+
+def plan_within_budget(
+    response_mode: str,
+    spent_usd: float,
+    mode_category: str = MULTILAYER_CATEGORY,
+    model_id: str = DEFAULT_MODEL_ID,
+    review_patch_mode: bool = True,
+    budget_usd: float = MAX_BUDGET_USD,
+    turn_cap_usd: float = MAX_TURN_COST_USD,
+    stats: Optional[Dict[tuple, Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """
+    Pick the mode / skipped phases whose projected worst-case cost fits the budget.
+
+    Args:
+        response_mode: Mode selected by the user
+        spent_usd: Cost so far (usage_stats["total_cost_usd"])
+        mode_category / model_id / review_patch_mode: As run_pipeline()
+        budget_usd: Monthly budget (MAX_BUDGET_USD)
+        turn_cap_usd: Per-turn cap (MAX_TURN_COST_USD; 0 disables it)
+        stats: load_phase_stats() result (loaded when None)
+
+    Returns:
+        {"mode", "skip_phases", "estimate", "downgrades": [labels], "limit", "fits"}
+    """
+    stats = load_phase_stats() if stats is None else stats
+    limit = budget_usd - spent_usd
+    if turn_cap_usd > 0:
+        limit = min(limit, turn_cap_usd)
+
+    mode = response_mode
+    skip_phases: List[str] = []
+    downgrades: List[str] = []
+    estimate = estimate_run(mode, mode_category, model_id, review_patch_mode, skip_phases, stats)
+
+    for phase, label in DOWNGRADE_LADDER:
+        if estimate["max_cost"] <= limit:
+            break
+        reduced = estimate_run(mode, mode_category, model_id, review_patch_mode, skip_phases + [phase], stats)
+        if reduced["max_cost"] < estimate["max_cost"]:
+            skip_phases.append(phase)
+            downgrades.append(label)
+            estimate = reduced
+
+    if estimate["max_cost"] > limit and "β1" not in mode:
+        light = estimate_run(LIGHT_MODE, mode_category, model_id, review_patch_mode, (), stats)
+        if light["max_cost"] < estimate["max_cost"]:
+            mode, skip_phases, estimate = LIGHT_MODE, [], light
+            downgrades = [f"{LIGHT_MODE} に切り替え"]
+
+    return {
+        "mode": mode,
+        "skip_phases": skip_phases,
+        "estimate": estimate,
+        "downgrades": downgrades,
+        "limit": limit,
+        "fits": estimate["max_cost"] <= limit,
+    }
+
+
+def format_estimate(estimate: Dict[str, Any]) -> str:
+    """One-line summary, e.g. "約 $0.12 / 約 2分10秒 / 48k tokens"."""
+    def duration(seconds):
+        minutes, seconds = divmod(int(round(seconds)), 60)
+        return f"{minutes}分{seconds:02d}秒" if minutes else f"{seconds}秒"
+
+    text = f"約 ${estimate['cost']:.3f} / 約 {duration(estimate['seconds'])}"
+    if estimate["max_cost"] > estimate["cost"] + 1e-9:
+        text += f" (最大 ${estimate['max_cost']:.3f} / {duration(estimate['max_seconds'])})"
+    tokens = estimate["input_tokens"] + estimate["output_tokens"]
+    return text + f" / {tokens / 1000:.0f}k tokens"
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Estimate the cost and wall time of one turn per mode")
+    parser.add_argument("mode", nargs="?", default="熟考 (本気MAX)ms/Az", help="Response mode label as shown in the UI")
+    parser.add_argument("--model", default=DEFAULT_MODEL_ID, help="Gemini model ID")
+    parser.add_argument("--spent", type=float, default=None, help="Cost so far in USD (default: usage ledger total)")
+    args = parser.parse_args()
+
+    spent = args.spent if args.spent is not None else get_usage_ledger().totals()["cost"]
+    plan = plan_within_budget(args.mode, spent, model_id=args.model)
+    print(f"{args.mode}: {format_estimate(estimate_run(args.mode, model_id=args.model))}")
+    for step in plan["estimate"]["steps"]:
+        print(f"  {step['phase']:<13} {step['model']:<45} ${step['cost']:.4f} {step['seconds']:6.1f}s ({step['source']})")
+    if plan["downgrades"]:
+        print(f"budget ${plan['limit']:.2f} → {plan['mode']}: " + ", ".join(plan["downgrades"]))
+    print(json.dumps({"skip_phases": plan["skip_phases"], "fits": plan["fits"]}, ensure_ascii=False))
@@ -0,0 +1,202 @@
+"""
+Phase D: Follow-up Detection & Incremental Research
+Detects follow-up turns cheaply and reuses the previous turn's research memo / IR.
+"""
+
+import re
+from typing import Dict, Any, Optional, List
+
+
+# Phrases that point back at the previous answer (regexes). A short question with one of
+# these is a follow-up even when it shares no words with the previous question ("それって何？").
+# Anchored so that words merely containing them (名前の, それぞれ, 手続き, 時間があれば) do not count.
+REFERENTIAL_MARKERS = [
+    r"それ(?!ぞれ)", r"その", r"あれ(?!ば)",
+    r"(?<![一-龥々])前の", r"(?<![一-龥々])続き",
+    r"さっき", r"先ほど", r"上記",
+]
+
+# Phrases that ask to go deeper; they only mark a follow-up together with shared content
+# ("具体的にRustの所有権について" after a CPI question is a new topic)
+ELABORATION_MARKERS = [
+    r"(?:^|[。！？!?\n])\s*(?:じゃあ|では|つまり|例えば|他には|もっと)",
+    r"どういう意味", r"詳しく", r"具体的に", r"補足",
+]
+FOLLOWUP_MARKERS = REFERENTIAL_MARKERS + ELABORATION_MARKERS
+_REFERENTIAL_PATTERN = re.compile("|".join(REFERENTIAL_MARKERS))
+_FOLLOWUP_PATTERN = re.compile("|".join(FOLLOWUP_MARKERS))
+
+# Similarity at which a turn is treated as a follow-up on its own
+SIMILARITY_THRESHOLD = 0.35
+
+# Short questions with a referential marker are follow-ups at a lower similarity
+SHORT_FOLLOWUP_CHARS = 80
+
+# Content tokens: Latin words, katakana words and kanji compounds. Hiragana (particles,
+# です/ます, について教えてください) is question boilerplate and never counts as overlap.
+_CONTENT_TOKEN = re.compile(r"[a-z0-9][a-z0-9+#]*|[ァ-ヴー]{2,}|[一-龥々]+")
+
+# Single kanji that come from question phrasing rather than the topic (教えて, 違い, 何)
+_STOP_KANJI = {"何", "教", "違", "使", "知", "思", "言", "書", "方", "今", "次"}
+
+
+def _char_bigrams(text: str) -> set:
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def content_tokens(text: str) -> set:
+    """
+    Topic tokens of a question: Latin / katakana words as-is, kanji compounds as
+    character bigrams (so 金融政策 and 政策金利 share 政策). Marker phrases are removed first.
+    """
+    text = _FOLLOWUP_PATTERN.sub(" ", (text or "").lower())
+    tokens = set()
+    for token in _CONTENT_TOKEN.findall(text):
+        if re.fullmatch(r"[一-龥々]+", token):
+            if len(token) == 1:
+                if token not in _STOP_KANJI:
+                    tokens.add(token)
+            else:
+                tokens |= _char_bigrams(token)
+        else:
+            tokens.add(token)
+    return tokens
+
+
+def text_similarity(a: str, b: str) -> float:
+    """
+    Jaccard similarity of content_tokens() (works for Japanese without a tokenizer).
+
+    Returns:
+        Similarity in [0.0, 1.0]
+    """
+    tokens_a = content_tokens(a)
+    tokens_b = content_tokens(b)
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+def _topic_domain(classification: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Domain of a router classification, or None when unknown / unspecific ("general")."""
+    domain = (classification or {}).get("domain")
+    return None if domain in (None, "general") else domain
+
+
+def find_previous_research(messages: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Find the most recent model turn that stored Phase 1 research.
+
+    Args:
+        messages: Session messages (excluding the current user prompt)
+
+    Returns:
+        Dict with question / research_text / ir / classification, or None
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        msg = messages[i]
+        if msg.get("role") != "model" or msg.get("error"):
+            continue
+        logs = msg.get("reasoning_logs") or {}
+        if not logs.get("phase1_research"):
+            continue
+
+        # The user turn that produced this answer
+        question = ""
+        for j in range(i - 1, -1, -1):
+            if messages[j].get("role") == "user":
+                question = messages[j].get("content", "")
+                break
+
+        return {
+            "question": question,
+            "research_text": logs["phase1_research"],
+            "ir": logs.get("phase1_3_ir"),
+            "classification": logs.get("question_classification") or logs.get("routing_classification"),
+        }
+    return None
+
+
+def detect_followup(
+    prompt: str,
+    previous_question: Optional[str],
+    classification: Optional[Dict[str, Any]] = None,
+    previous_classification: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Decide whether the prompt is a follow-up of the previous turn (no LLM call).
+
+    Args:
+        prompt: Current user question
+        previous_question: User question of the previous researched turn
+        classification: Router classification of the current prompt (optional)
+        previous_classification: Router classification of the previous turn (optional)
+
+    Returns:
+        Dict with is_followup, similarity and reason
+    """
+    if not previous_question or not prompt:
+        return {"is_followup": False, "similarity": 0.0, "reason": "前ターンなし"}
+
+    similarity = text_similarity(prompt, previous_question)
+    has_marker = _FOLLOWUP_PATTERN.search(prompt) is not None
+    is_referential = _REFERENTIAL_PATTERN.search(prompt) is not None
+    is_short = len(prompt) <= SHORT_FOLLOWUP_CHARS
+
+    # Router says the topic changed → treat as a new question ("general" means unknown, not a topic)
+    domain, previous_domain = _topic_domain(classification), _topic_domain(previous_classification)
+    if domain and previous_domain and domain != previous_domain:
+        return {
+            "is_followup": False,
+            "similarity": similarity,
+            "reason": f"ドメイン変化 ({previous_domain} → {domain})",
+        }
+    if classification and previous_classification:
+        if classification.get("risk_level") == "high" and previous_classification.get("risk_level") != "high":
+            return {"is_followup": False, "similarity": similarity, "reason": "リスク上昇のため再調査"}
+
+    if similarity >= SIMILARITY_THRESHOLD:
+        return {"is_followup": True, "similarity": similarity, "reason": f"類似度 {similarity:.2f}"}
+
+    if is_short and (is_referential or (has_marker and similarity > 0)):
+        return {"is_followup": True, "similarity": similarity, "reason": "指示語を含む短い追質問"}
+
+    if has_marker and similarity >= SIMILARITY_THRESHOLD / 2:
+        return {"is_followup": True, "similarity": similarity, "reason": f"指示語 + 類似度 {similarity:.2f}"}
+
+    return {"is_followup": False, "similarity": similarity, "reason": f"類似度 {similarity:.2f} (新規質問)"}
+
+
+def build_incremental_research_prompt(prompt: str, previous_question: str, previous_research: str, max_chars: int = 6000) -> str:
+    """
+    Build the Phase 1 prompt for a delta-only research pass.
+
+    Args:
+        prompt: Current follow-up question
+        previous_question: Question the stored memo was written for
+        previous_research: Stored research memo of the previous turn
+        max_chars: Truncation limit for the stored memo
+
+    Returns:
+        Prompt text for the incremental research call
+    """
+    memo = previous_research[:max_chars]
+    return (
+        f"前回の質問: {previous_question[:500]}\n\n"
+        f"==== 前回の調査メモ (調査済み) ====\n{memo}\n==== 前回の調査メモここまで ====\n\n"
+        f"追加の質問: {prompt}\n\n"
+        "指示:\n"
+        "- 前回の調査メモに既に含まれている事実は繰り返さないでください。\n"
+        "- 追加の質問に答えるために**不足している情報だけ**を検索し、差分の調査メモとして書いてください。\n"
+        "- 前回の調査メモで十分な場合は「追加調査不要」とだけ書いてください。"
+    )
+
+
+def merge_research_text(previous_research: str, delta_research: str) -> str:
+    """Append the delta memo to the stored memo so later phases see both."""
+    delta = (delta_research or "").strip()
+    if not delta or ("追加調査不要" in delta and len(delta) < 40):
+        return previous_research
+    return f"{previous_research}\n\n---\n\n### 追加調査 (フォローアップ)\n{delta}"
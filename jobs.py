@@ -0,0 +1,489 @@
+"""
+Phase L: Background Job Queue
+Long pipeline runs (本気MAX / 鬼軍曹) are enqueued into a local SQLite queue
+and executed by a pool of worker threads instead of the Streamlit script
+thread, so navigating away, switching sessions or a sleeping tab no longer
+ties the run to one rerun. Every progress callback is persisted as an event,
+the UI polls the events, and the finished result is delivered exactly once to
+the session that submitted it.
+
+Usage:
+    python jobs.py --workers 2        # standalone worker process
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import json
+import time
+import uuid
+import base64
+import sqlite3
+import datetime
+import threading
+from typing import Dict, Any, Optional, List, Callable
+
+import metrics
+from applog import get_logger, bind_context, reset_context
+from cassette import start_recording_from_env
+from logic import get_client, load_sessions
+from checkpoints import mark_failed
+from pipeline import PipelineCallbacks, run_pipeline_from_checkpoint
+
+log = get_logger(__name__)
+
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "pipeline_jobs.db")
+
+# Worker threads per process (each runs one pipeline at a time)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# A running job whose worker has not reported for this long is requeued
+# (the run resumes from its checkpoint)
+STALE_JOB_SECONDS = float(os.getenv("STALE_JOB_SECONDS", "600"))
+
+# Worker pools refresh the heartbeat of their running jobs at this interval, so a single
+# long model call (quota backoff, long Phase 2/3) never looks stale to another process
+HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+
+# Idle workers poll the queue at this interval
+POLL_INTERVAL = 1.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    question TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    params TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, created_at);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when the user cancelled the job."""
+
+
+def _encode_attachments(attachments: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Attachments carry raw bytes; store them base64-encoded in the params JSON."""
+    encoded = []
+    for attachment in attachments or []:
+        item = dict(attachment)
+        if isinstance(item.get("data"), (bytes, bytearray)):
+            item["data"] = base64.b64encode(item["data"]).decode("ascii")
+            item["encoding"] = "base64"
+        encoded.append(item)
+    return encoded
+
+
+def _decode_attachments(attachments: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    decoded = []
+    for attachment in attachments:
+        item = dict(attachment)
+        if item.pop("encoding", None) == "base64":
+            item["data"] = base64.b64decode(item["data"])
+        decoded.append(item)
+    return decoded
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue shared by every process that opens the same file.
+
+    Claims use BEGIN IMMEDIATE, so several worker pools (Streamlit workers,
+    `python jobs.py`) can poll one database without running a job twice.
+    """
+
+    def __init__(self, db_path: str = JOBS_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        metrics.watch_file("jobs_db", db_path)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(
+        self,
+        session_id: str,
+        run_id: str,
+        question: str,
+        mode: str,
+        history: Optional[List[Dict[str, Any]]] = None,
+        attachments: Optional[List[Dict[str, Any]]] = None,
+        **params
+    ) -> str:
+        """
+        Add a pipeline run to the queue.
+
+        Args:
+            session_id: Chat session the answer belongs to
+            run_id: Checkpoint run id (start_run() must already have been called)
+            question: User question
+            mode: Response mode label
+            history: Messages before the question
+            attachments: Same format as run_pipeline()
+            **params: Other run_pipeline keyword arguments (model_id, use_search, ...)
+
+        Returns:
+            Job id
+        """
+        job_id = uuid.uuid4().hex[:12]
+        params = dict(params)
+        params["history"] = history or []
+        params["attachments"] = _encode_attachments(attachments)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, session_id, run_id, status, question, mode, params, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, run_id, QUEUED, question, mode,
+                 json.dumps(params, ensure_ascii=False, default=str), time.time()),
+            )
+        self.add_event(job_id, "status", {"text": "キューに追加しました"})
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """Atomically move the oldest queued job to running. Returns None if the queue is empty."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND cancel_requested = 0 ORDER BY created_at LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = COALESCE(started_at, ?), heartbeat = ? WHERE id = ?",
+                (RUNNING, worker, now, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(row["id"])
+
+    def add_event(self, job_id: str, kind: str, payload: Dict[str, Any]) -> None:
+        """Persist one progress event and refresh the job's heartbeat."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO job_events (job_id, seq, ts, kind, payload) VALUES (?, ?, ?, ?, ?)",
+                (job_id, seq, now, kind, json.dumps(payload, ensure_ascii=False, default=str)),
+            )
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (now, job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def events(self, job_id: str, after_seq: int = 0) -> List[Dict[str, Any]]:
+        """Events of a job with seq > after_seq, oldest first."""
+        rows = self._connect().execute(
+            "SELECT seq, ts, kind, payload FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+            (job_id, after_seq),
+        ).fetchall()
+        return [
+            {"seq": row["seq"], "ts": row["ts"], "kind": row["kind"], "payload": json.loads(row["payload"])}
+            for row in rows
+        ]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def list_jobs(self, session_id: Optional[str] = None, statuses: Optional[tuple] = None) -> List[Dict[str, Any]]:
+        """Jobs (optionally of one session / in some statuses), oldest first."""
+        query = "SELECT * FROM jobs WHERE 1 = 1"
+        args: List[Any] = []
+        if session_id is not None:
+            query += " AND session_id = ?"
+            args.append(session_id)
+        if statuses:
+            query += f" AND status IN ({', '.join('?' for _ in statuses)})"
+            args.extend(statuses)
+        rows = self._connect().execute(query + " ORDER BY created_at", args).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def active_run_ids(self) -> set:
+        """Checkpoint run ids owned by queued / running jobs (not resumable from the UI)."""
+        rows = self._connect().execute(
+            f"SELECT run_id FROM jobs WHERE status IN ({', '.join('?' for _ in ACTIVE_STATUSES)})",
+            ACTIVE_STATUSES,
+        ).fetchall()
+        return {row["run_id"] for row in rows}
+
+    def complete(self, job_id: str, result: Dict[str, Any]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                (DONE, json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str, status: str = FAILED) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, error[:2000], time.time(), job_id),
+            )
+
+    def cancel(self, job_id: str) -> None:
+        """
+        Cancel a job. Queued jobs stop immediately; running jobs stop at the
+        next progress event (the model call on the wire still completes).
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (CANCELLED, "キャンセルされました", time.time(), job_id, QUEUED),
+            )
+
+    def cancel_requested(self, job_id: str) -> bool:
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def undelivered(self, session_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Finished jobs (done / failed / cancelled) whose result has not been written to a session yet."""
+        jobs = [
+            job for job in self.list_jobs(statuses=(DONE, FAILED, CANCELLED))
+            if not job["delivered"]
+        ]
+        if session_ids is not None:
+            wanted = set(session_ids)
+            jobs = [job for job in jobs if job["session_id"] in wanted]
+        return jobs
+
+    def mark_delivered(self, job_id: str) -> bool:
+        """
+        Claim delivery of a finished job.
+
+        Returns:
+            True for exactly one caller; False if another session/process delivered it first
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET delivered = 1 WHERE id = ? AND delivered = 0", (job_id,))
+            return cursor.rowcount == 1
+
+    def heartbeat(self, worker_prefix: str) -> int:
+        """Refresh the heartbeat of every running job claimed by workers named worker_prefix-*."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE status = ? AND worker LIKE ?",
+                (time.time(), RUNNING, f"{worker_prefix}-%"),
+            )
+            return cursor.rowcount
+
+    def requeue_stale(self, max_age: float = STALE_JOB_SECONDS) -> int:
+        """Requeue running jobs whose worker stopped reporting (e.g. the process was restarted)."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ?",
+                (QUEUED, RUNNING, time.time() - max_age),
+            )
+            return cursor.rowcount
+
+
+class JobCallbacks(PipelineCallbacks):
+    """
+    Persists every pipeline progress callback as a job event and honours cancellation.
+
+    Token usage is not handled here: run_pipeline() records each call in the usage ledger.
+    """
+
+    def __init__(self, queue: JobQueue, job_id: str):
+        self.queue = queue
+        self.job_id = job_id
+
+    def _emit(self, kind: str, payload: Dict[str, Any]) -> None:
+        self.queue.add_event(self.job_id, kind, payload)
+        if self.queue.cancel_requested(self.job_id):
+            raise JobCancelled("キャンセルされました")
+
+    def status(self, text: str) -> None:
+        self._emit("status", {"text": text})
+
+    def warning(self, text: str) -> None:
+        self._emit("warning", {"text": text})
+
+    def error(self, text: str) -> None:
+        self._emit("error", {"text": text})
+
+    def phase(self, label: str) -> None:
+        self._emit("phase", {"label": label})
+
+    def detail(self, title: str, markdown: str, data: Any = None, raw: Optional[str] = None, note: Optional[str] = None) -> None:
+        # Full Deep Log content ends up in the result; events only carry the title
+        self._emit("detail", {"title": title})
+
+    def draft(self, text: str, note: str) -> None:
+        self._emit("draft", {"text": text, "note": note})
+
+
+class JobWorkerPool:
+    """
+    Worker threads that claim jobs from a JobQueue and run them through run_pipeline().
+
+    Each job resumes from its checkpoint (run_id), so a requeued stale job or a
+    cascade escalation continues from the last completed phase.
+    """
+
+    def __init__(
+        self,
+        queue: Optional[JobQueue] = None,
+        workers: int = JOB_WORKERS,
+        client_factory: Callable[[], Any] = get_client
+    ):
+        self.queue = queue or JobQueue()
+        self.workers = workers
+        self.client_factory = client_factory
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._name = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+    def start(self) -> "JobWorkerPool":
+        self.queue.requeue_stale()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, args=(f"{self._name}-{i}",), daemon=True, name=f"job-worker-{i}")
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True, name="job-heartbeat")
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _heartbeat_loop(self) -> None:
+        # Independent of progress events: a job is alive as long as this process is
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.queue.heartbeat(self._name)
+            except sqlite3.Error as e:
+                log.warning("job heartbeat failed", pool=self._name, error=str(e))
+
+    def _loop(self, worker: str) -> None:
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(worker)
+            except sqlite3.Error as e:
+                log.warning("job queue claim failed", worker=worker, error=str(e))
+                job = None
+            if job is None:
+                self._stop.wait(POLL_INTERVAL)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job: Dict[str, Any]) -> None:
+        """Execute one claimed job and store its result / error."""
+        job_id = job["id"]
+        run_id = job["run_id"]
+        callbacks = JobCallbacks(self.queue, job_id)
+        params = dict(job["params"])
+        history = params.pop("history", [])
+        attachments = _decode_attachments(params.pop("attachments", []))
+
+        job_context = bind_context(job_id=job_id, run_id=run_id, session_id=job["session_id"])
+        try:
+            # Completed phases (and a cascade escalation's upgraded mode) come from the checkpoint
+            result = run_pipeline_from_checkpoint(
+                job["question"],
+                job["mode"],
+                run_id,
+                history=history,
+                attachments=attachments,
+                callbacks=callbacks,
+                client=self.client_factory(),
+                sessions=load_sessions(),
+                session_id=job["session_id"],
+                **params,
+            )
+            self.queue.add_event(job_id, "done", {"cost": result["cost"]})
+            self.queue.complete(job_id, result)
+        except JobCancelled:
+            mark_failed(run_id, "キャンセルされました")
+            self.queue.fail(job_id, "キャンセルされました", status=CANCELLED)
+        except Exception as e:
+            log.exception("job failed", error=str(e))
+            # Completed phases stay in the checkpoint, so the run can be resumed from the UI
+            mark_failed(run_id, str(e))
+            self.queue.add_event(job_id, "error", {"text": str(e)[:500]})
+            self.queue.fail(job_id, str(e))
+        finally:
+            reset_context(job_context)
+
+
+def format_job_time(ts: Optional[float]) -> str:
+    return datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S") if ts else "-"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run background pipeline jobs from the SQLite job queue")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--db", default=JOBS_DB_PATH)
+    args = parser.parse_args()
+
+    metrics.start_exporters()
+    start_recording_from_env()
+    pool = JobWorkerPool(JobQueue(args.db), workers=args.workers).start()
+    print(f"{args.workers} workers polling {args.db} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop(timeout=5)
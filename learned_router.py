@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Phase G: Learned Local Router
+A small logistic-regression classifier over hashed character n-grams, trained
+on past prompts labelled with the pipeline that answered them (corrected by the
+👍/👎 ratings). Weights are stored as NumPy arrays, so a prediction is a few
+array lookups and runs in well under a millisecond on CPU. The Gemini
+classifier is only consulted when this model is missing or not confident.
+
+⚠️ Like logic.py, this module must not import streamlit.
+
+Usage:
+    python learned_router.py [--sessions chat_sessions.json]   # retrain
+"""
+
+import os
+import re
+import uuid
+import zlib
+import datetime
+import threading
+from typing import Dict, Any, Optional, List, Tuple
+
+import numpy as np
+
+from applog import get_logger
+
+log = get_logger(__name__)
+
+
+MODEL_FILE = "router_model.npz"
+
+# Pipelines (route_question_to_pipeline mode names) from cheapest to heaviest
+PIPELINE_CLASSES = ["light", "research", "research_meta", "full_verify"]
+
+# Hashed feature space for character 1-3 grams
+N_FEATURES = 2 ** 14
+NGRAM_RANGE = (1, 3)
+
+# Training
+MIN_TRAINING_SAMPLES = 30
+EPOCHS = 200
+LEARNING_RATE = 2.0
+L2_PENALTY = 1e-4
+
+# Predictions below this probability fall back to the Gemini classifier
+CONFIDENCE_THRESHOLD = 0.6
+
+# When the top two classes are this close, prefer the cheaper pipeline
+COST_TIE_MARGIN = 0.1
+
+# Sample weights by rating (👎 answers are relabelled one pipeline heavier)
+RATING_WEIGHTS = {1: 2.0, None: 1.0, -1: 1.5}
+
+
+def _normalize(text: str) -> str:
+    text = (text or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def extract_features(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hash character n-grams into a sparse, L2-normalized feature vector.
+
+    Args:
+        text: Question text
+
+    Returns:
+        Tuple of (indices, values) arrays
+    """
+    text = _normalize(text)
+    counts: Dict[int, float] = {}
+    for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+        for i in range(len(text) - n + 1):
+            # crc32 instead of hash(): Python's str hash is salted per process
+            index = zlib.crc32(text[i:i + n].encode("utf-8")) % N_FEATURES
+            counts[index] = counts.get(index, 0.0) + 1.0
+
+    if not counts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    values /= np.linalg.norm(values)
+    return indices, values
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def build_training_set(turns: List[Dict[str, Any]]) -> List[Tuple[str, str, float]]:
+    """
+    Turn benchmark turns into (prompt, label, weight) samples.
+
+    A 👎 answer means the pipeline was not enough, so the label moves one
+    pipeline heavier; 👍 answers count double.
+    """
+    samples = []
+    for turn in turns:
+        label = turn["actual_pipeline"]
+        if label not in PIPELINE_CLASSES or not turn.get("prompt"):
+            continue
+        rating = turn.get("rating")
+        if rating == -1:
+            label = PIPELINE_CLASSES[min(PIPELINE_CLASSES.index(label) + 1, len(PIPELINE_CLASSES) - 1)]
+        samples.append((turn["prompt"], label, RATING_WEIGHTS.get(rating, 1.0)))
+    return samples
+
+
+def train(samples: List[Tuple[str, str, float]], class_cost: Optional[Dict[str, float]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Fit a multinomial logistic regression with full-batch gradient descent.
+
+    Args:
+        samples: (prompt, label, weight) tuples from build_training_set()
+        class_cost: Average USD cost per pipeline, used to break near-ties
+
+    Returns:
+        Model dict (weights, bias, classes, ...), or None with too few samples
+    """
+    if len(samples) < MIN_TRAINING_SAMPLES:
+        return None
+
+    n_classes = len(PIPELINE_CLASSES)
+    rows, cols, vals = [], [], []
+    for row, (prompt, _, _) in enumerate(samples):
+        indices, values = extract_features(prompt)
+        rows.append(np.full(len(indices), row, dtype=np.int64))
+        cols.append(indices)
+        vals.append(values)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    vals = np.concatenate(vals)
+
+    labels = np.array([PIPELINE_CLASSES.index(label) for _, label, _ in samples])
+    sample_weight = np.array([weight for _, _, weight in samples], dtype=np.float32)
+    sample_weight /= sample_weight.sum()
+    targets = np.eye(n_classes, dtype=np.float32)[labels]
+
+    weights = np.zeros((N_FEATURES, n_classes), dtype=np.float32)
+    bias = np.zeros(n_classes, dtype=np.float32)
+    for _ in range(EPOCHS):
+        logits = np.zeros((len(samples), n_classes), dtype=np.float32)
+        np.add.at(logits, rows, weights[cols] * vals[:, None])
+        logits += bias
+        error = (_softmax(logits) - targets) * sample_weight[:, None]
+
+        grad_weights = np.zeros_like(weights)
+        np.add.at(grad_weights, cols, error[rows] * vals[:, None])
+        grad_weights += L2_PENALTY * weights
+        weights -= LEARNING_RATE * grad_weights
+        bias -= LEARNING_RATE * error.sum(axis=0)
+
+    costs = class_cost or {}
+    return {
+        "weights": weights,
+        "bias": bias,
+        "classes": np.array(PIPELINE_CLASSES),
+        "class_cost": np.array([costs.get(c, 0.0) for c in PIPELINE_CLASSES], dtype=np.float32),
+        "n_samples": np.array(len(samples)),
+        "trained_at": np.array(datetime.datetime.now().isoformat()),
+    }
+
+
+def save_model(model: Dict[str, Any], path: str = MODEL_FILE) -> None:
+    """Atomic write (tmp file + rename) so a concurrent reader never sees half a model."""
+    # Unique per writer (retrains run per browser session / process); must end in .npz or numpy appends it
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex[:8]}.tmp.npz"
+    try:
+        np.savez_compressed(tmp_path, **model)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+_model_lock = threading.Lock()
+_loaded_model: Dict[str, Any] = {"mtime": None, "model": None}
+
+
+def load_model(path: str = MODEL_FILE) -> Optional[Dict[str, Any]]:
+    """Load the model, re-reading it only when the file changed (retrained)."""
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    with _model_lock:
+        if _loaded_model["mtime"] != mtime:
+            try:
+                with np.load(path) as data:
+                    _loaded_model["model"] = {key: data[key] for key in data.files}
+                _loaded_model["mtime"] = mtime
+            except (OSError, ValueError) as e:
+                log.warning("learned router model could not be loaded", path=path, error=str(e))
+                return None
+        return _loaded_model["model"]
+
+
+def predict_pipeline(user_question: str, model: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Predict the pipeline for a question.
+
+    Args:
+        user_question: User's question text
+        model: Model dict (defaults to the saved model)
+
+    Returns:
+        Dict with pipeline, confidence and probabilities, or None without a model
+    """
+    model = model or load_model()
+    if model is None:
+        return None
+
+    indices, values = extract_features(user_question)
+    logits = model["bias"] + values @ model["weights"][indices]
+    probabilities = _softmax(logits)
+    classes = [str(c) for c in model["classes"]]
+
+    order = np.argsort(-probabilities)
+    best, runner_up = int(order[0]), int(order[1])
+    # Near-tie: take the cheaper pipeline when the costs are known
+    class_cost = model["class_cost"]
+    if probabilities[best] - probabilities[runner_up] < COST_TIE_MARGIN and class_cost[runner_up] < class_cost[best]:
+        best = runner_up
+
+    return {
+        "pipeline": classes[best],
+        "confidence": float(probabilities[best]),
+        "probabilities": {c: round(float(p), 3) for c, p in zip(classes, probabilities)},
+    }
+
+
+def pipeline_to_classification(prediction: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Express a predicted pipeline as a classification that route_question_to_pipeline
+    maps back to the same pipeline.
+    """
+    pipeline = prediction["pipeline"]
+    complexity, risk_level = {
+        "light": ("low", "low"),
+        "research": ("medium", "low"),
+        "research_meta": ("high", "medium"),
+        "full_verify": ("high", "high"),
+    }[pipeline]
+    return {
+        "domain": "general",
+        "complexity": complexity,
+        "risk_level": risk_level,
+        "needs_research": pipeline != "light",
+        "needs_cross_check": pipeline in ("research_meta", "full_verify"),
+        "needs_x_search": False,
+        "notes": f"learned: {pipeline} (p={prediction['confidence']:.2f})",
+    }
+
+
+def train_from_sessions(sessions_path: str, model_path: str = MODEL_FILE) -> Optional[Dict[str, Any]]:
+    """
+    Retrain from chat_sessions.json and save the model.
+
+    Returns:
+        The trained model, or None when there is not enough history yet
+    """
+    import json
+    import statistics
+    # Imported here: router_benchmark imports router, which imports this module
+    from router_benchmark import extract_turns
+
+    with open(sessions_path, "r", encoding="utf-8") as f:
+        sessions = json.load(f).get("sessions", [])
+    turns, _ = extract_turns(sessions)
+
+    costs: Dict[str, List[float]] = {}
+    for turn in turns:
+        if turn["actual_cost"]:
+            costs.setdefault(turn["actual_pipeline"], []).append(turn["actual_cost"])
+    class_cost = {pipeline: statistics.mean(values) for pipeline, values in costs.items()}
+
+    model = train(build_training_set(turns), class_cost)
+    if model is not None:
+        save_model(model, model_path)
+    return model
+
+
+def retrain_if_stale(sessions_path: str, model_path: str = MODEL_FILE) -> bool:
+    """
+    Retrain when the session history is newer than the saved model.
+
+    Returns:
+        True if a new model was saved
+    """
+    if not os.path.exists(sessions_path):
+        return False
+    if os.path.exists(model_path) and os.path.getmtime(model_path) >= os.path.getmtime(sessions_path):
+        return False
+    try:
+        return train_from_sessions(sessions_path, model_path) is not None
+    except Exception as e:
+        log.warning("learned router retrain failed", error=str(e), exc_info=log.debug_enabled())
+        return False
+
+
+if __name__ == "__main__":
+    import argparse
+    from logic import SESSIONS_FILE
+
+    parser = argparse.ArgumentParser(description="Train the learned local router from chat history")
+    parser.add_argument("--sessions", default=SESSIONS_FILE, help="Path to chat_sessions.json")
+    parser.add_argument("--model", default=MODEL_FILE, help="Output .npz path")
+    args = parser.parse_args()
+
+    trained = train_from_sessions(args.sessions, args.model)
+    if trained is None:
+        print(f"Not enough history yet (need {MIN_TRAINING_SAMPLES} answered turns with a Deep Log)")
+    else:
+        print(f"✅ Trained on {int(trained['n_samples'])} turns → {args.model}")
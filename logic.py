@@ -17,52 +17,76 @@ from google.genai import types
 from youtube_transcript_api import YouTubeTranscriptApi
 import io
 from PIL import Image
+import metrics
+from applog import get_logger
+from quota import QuotaLimitedClient
+from usage_ledger import get_usage_ledger
+from pricing import MODEL_PRICES, calculate_cost, gemini_usage
 
 load_dotenv()
 
+log = get_logger(__name__)
+
 USAGE_FILE = "usage_stats.json"
 SESSIONS_FILE = "chat_sessions.json"
 MANUAL_COST_FILE = "manual_cost.json"
 USER_PROFILE_FILE = "user_profile.json"
+
+# メトリクスにファイルサイズを出す
+metrics.watch_file("sessions", SESSIONS_FILE)
+metrics.watch_file("user_profile", USER_PROFILE_FILE)
+
 USD_TO_JPY = float(os.getenv("USD_TO_JPY", "150.0"))
 
 # Budget limit: Gemini $300 (¥45,000) + AWS $100 (¥15,000) = $400 (¥60,000)
 MAX_BUDGET_USD = float(os.getenv("MAX_BUDGET_USD", "400.0"))
 MAX_BUDGET_JPY = MAX_BUDGET_USD * USD_TO_JPY
 
+# Per-turn cap: the pre-run estimate downgrades the mode (drop Claude, reviews, ...) above this
+MAX_TURN_COST_USD = float(os.getenv("MAX_TURN_COST_USD", "1.0"))
+
 TRIAL_LIMIT_USD = float(os.getenv("TRIAL_LIMIT_USD", "300.0"))
 TRIAL_LIMIT_JPY = TRIAL_LIMIT_USD * USD_TO_JPY
 TRIAL_EXPIRY = os.getenv("TRIAL_EXPIRY", "2026-02-28")
 
-PRICING = {
-    "gemini-3-pro-preview":   {"input": 2.0,   "output": 12.0},
-    "gemini-2.5-pro":         {"input": 1.25,  "output": 10.0},
-    "gemini-2.5-flash":       {"input": 0.30,  "output": 2.50},
-    "gemini-2.5-flash-lite":  {"input": 0.10,  "output": 0.40},
-    "gemini-2.0-flash":       {"input": 0.10,  "output": 0.40},
-}
+# 料金表は pricing.py に一元化（PRICING / calculate_cost は互換のため再公開）
+PRICING = MODEL_PRICES
 
 VERTEX_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")
 VERTEX_LOCATION = "global"
 
 def load_usage():
-    if os.path.exists(USAGE_FILE):
-        with open(USAGE_FILE, "r") as f:
-            return json.load(f)
-    return {"total_input_tokens": 0, "total_output_tokens": 0, "total_cost_usd": 0.0}
-
-def save_usage(stats):
-    with open(USAGE_FILE, "w") as f:
-        json.dump(stats, f, indent=4)
-
-def calculate_cost(model_id, input_tok, output_tok):
-    # None チェック：トークン数がNoneの場合は0として扱う
-    input_tok = input_tok or 0
-    output_tok = output_tok or 0
-    
-    price = PRICING.get(model_id, {"input": 0.0, "output": 0.0})
-    cost = (input_tok / 1_000_000 * price["input"]) + (output_tok / 1_000_000 * price["output"])
-    return cost
+    """
+    累計使用量（usage_ledger の集計行を読むだけなので O(1)、書き込みは get_usage_ledger().record() で1コールずつ追記）
+    """
+    totals = get_usage_ledger().totals()
+    return {
+        "total_input_tokens": totals["input_tokens"],
+        "total_output_tokens": totals["output_tokens"],
+        "total_cost_usd": totals["cost"],
+    }
+
+def record_usage(records, session_id=None, run_id=None):
+    """
+    まとめて取得した使用量（バッチ予測など）を usage_ledger に1件ずつ追記
+
+    Args:
+        records: {phase?, model?, input_tokens, output_tokens, thinking_tokens?, cached_tokens?, cost} のリスト
+        session_id / run_id: 集計用の紐付け（任意）
+    """
+    ledger = get_usage_ledger()
+    for record in records or []:
+        ledger.record(
+            record.get("phase", "batch"),
+            record.get("model", ""),
+            record["input_tokens"],
+            record["output_tokens"],
+            record["cost"],
+            session_id=session_id,
+            run_id=run_id,
+            thinking_tokens=record.get("thinking_tokens"),
+            cached_tokens=record.get("cached_tokens"),
+        )
 
 def load_manual_cost():
     if os.path.exists(MANUAL_COST_FILE):
@@ -154,6 +178,18 @@ def extract_text_from_response(response):
     parts = response.candidates[0].content.parts or []
     return "".join(p.text or "" for p in parts)
 
+def extract_grounding_sources(grounding_metadata):
+    """grounding_metadata から情報源 [{"uri", "title"}] を重複なしで抽出（JSON保存可能な形）"""
+    sources = []
+    seen = set()
+    for chunk in getattr(grounding_metadata, "grounding_chunks", None) or []:
+        web = getattr(chunk, "web", None)
+        uri = getattr(web, "uri", None) if web else None
+        if uri and uri not in seen:
+            seen.add(uri)
+            sources.append({"uri": uri, "title": getattr(web, "title", None) or "情報源"})
+    return sources
+
 def load_sessions():
     if os.path.exists(SESSIONS_FILE):
         with open(SESSIONS_FILE, "r") as f:
@@ -165,8 +201,9 @@ def load_sessions():
     return []
 
 def save_sessions(sessions):
-    with open(SESSIONS_FILE, "w") as f:
-        json.dump({"sessions": sessions}, f, indent=4, ensure_ascii=False)
+    with metrics.timed("store_write_seconds", {"store": "sessions"}, metrics.WRITE_BUCKETS):
+        with open(SESSIONS_FILE, "w") as f:
+            json.dump({"sessions": sessions}, f, indent=4, ensure_ascii=False)
 
 def get_client():
     """
@@ -179,16 +216,14 @@ def get_client():
     """
     try:
         # Application Default Credentials (works for local dev and Cloud)
-        return genai.Client(
+        return QuotaLimitedClient(genai.Client(
             vertexai=True,
             project=VERTEX_PROJECT,
             location=VERTEX_LOCATION,
-        )
+        ))
     except Exception as e:
         # エラー時はNoneを返す（アプリを止めない）
-        print(f"❌ Vertex AI初期化エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Vertex AI client initialization failed", error=str(e))
         return None
 
 # =========================
@@ -228,8 +263,9 @@ def save_user_profile(profile):
         profile (dict): 保存するプロファイル情報
     """
     profile["last_updated"] = datetime.datetime.now().isoformat()
-    with open(USER_PROFILE_FILE, "w", encoding="utf-8") as f:
-        json.dump(profile, f, indent=4, ensure_ascii=False)
+    with metrics.timed("store_write_seconds", {"store": "user_profile"}, metrics.WRITE_BUCKETS):
+        with open(USER_PROFILE_FILE, "w", encoding="utf-8") as f:
+            json.dump(profile, f, indent=4, ensure_ascii=False)
 
 def update_user_profile_from_conversation(client, question, answer, current_profile=None):
     """
@@ -294,12 +330,8 @@ AIの回答: {answer[:800]}...
             )
         )
         
-        # 使用量情報の取得
-        usage_metadata = response.usage_metadata
-        usage_dict = {
-            "input_tokens": usage_metadata.prompt_token_count if usage_metadata else 0,
-            "output_tokens": usage_metadata.candidates_token_count if usage_metadata else 0,
-        }
+        # 使用量情報の取得（思考トークン・キャッシュヒットを含む。pricing.usage_cost で課金）
+        usage_dict = gemini_usage(response)
         
         # レスポンスからJSON抽出
         result_text = extract_text_from_response(response)
@@ -340,7 +372,7 @@ AIの回答: {answer[:800]}...
         
     except Exception as e:
         # エラー時は元のプロファイルをそのまま返す
-        print(f"Profile update error: {e}")
+        log.warning("profile update failed", error=str(e))
         return (current_profile, {"input_tokens": 0, "output_tokens": 0})
         return (current_profile, {"input_tokens": 0, "output_tokens": 0})
 
@@ -0,0 +1,354 @@
+"""
+Phase S: Metrics
+Process-wide counters, latency histograms and file-size gauges in the
+Prometheus text exposition format, so a running app can be scraped instead
+of read from stdout. Served by a small sidecar HTTP server (METRICS_PORT) or
+written periodically to a node_exporter textfile collector (METRICS_TEXTFILE);
+both are off by default.
+
+Recorded series (prefix gws_):
+    requests_total{mode}                      Pipeline runs started per response mode
+    phase_seconds{phase}                      Wall time per pipeline phase (histogram)
+    model_call_seconds{provider}              Latency per model call (histogram)
+    model_calls_total{provider, outcome}      ok / error / timeout / quota per provider
+    fanout_timeouts_total{provider}           Phase 1.5 tasks still running at the fan-out timeout
+    quota_retries_total{phase}                Retries after a quota error (Phase 2 / 3)
+    quota_aborts_total{phase}                 Phases given up after the last quota retry
+    quota_exhausted_total{model}              429s reported to the quota ledger
+    cache_requests_total{cache, result}       hit / miss per cache (classification, followup)
+    tokens_total{provider, kind}              input / cached / output / thinking tokens billed
+    store_write_seconds{store}                Session / profile / checkpoint write latency (histogram)
+    file_size_bytes{store}                    Size of the JSON stores and SQLite databases (gauge)
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import time
+import atexit
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, List, Callable, Tuple
+
+from applog import get_logger
+
+log = get_logger(__name__)
+
+
+# Sidecar HTTP server port (0 = disabled) and bind address
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Textfile collector output ("" = disabled), rewritten every METRICS_TEXTFILE_INTERVAL seconds
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
+METRICS_TEXTFILE_INTERVAL = float(os.getenv("METRICS_TEXTFILE_INTERVAL", "15"))
+
+PREFIX = "gws_"
+
+# Seconds; phases and model calls range from sub-second to several minutes
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+# Seconds; local file writes
+WRITE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+_HELP = {
+    "requests_total": "Pipeline runs started per response mode",
+    "phase_seconds": "Wall time of a pipeline phase in seconds",
+    "model_call_seconds": "Latency of one model call in seconds",
+    "model_calls_total": "Model calls per provider and outcome",
+    "fanout_timeouts_total": "Phase 1.5 tasks still running at the fan-out timeout",
+    "quota_retries_total": "Retries after a quota error",
+    "quota_aborts_total": "Phases given up after the last quota retry",
+    "quota_exhausted_total": "Quota errors reported to the quota ledger",
+    "cache_requests_total": "Cache lookups per cache and result",
+    "tokens_total": "Billed tokens per provider and kind",
+    "store_write_seconds": "Latency of a local store write in seconds",
+    "file_size_bytes": "Size of a local store in bytes",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Optional[Dict[str, Any]]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process metric store.
+
+    Usage:
+        get_registry().inc("requests_total", {"mode": mode})
+        get_registry().observe("phase_seconds", 12.3, {"phase": "phase2"})
+        get_registry().watch_file("sessions", SESSIONS_FILE)
+        text = get_registry().render()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Dict[str, Any]]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._files: Dict[str, str] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, Dict[str, Any], float]]]] = []
+
+    def inc(self, name: str, labels: Optional[Dict[str, Any]] = None, value: float = 1.0) -> None:
+        """Add value to a counter."""
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        labels: Optional[Dict[str, Any]] = None,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        """Record one sample in a histogram (the first call fixes the buckets of the metric)."""
+        key = _labels(labels)
+        with self._lock:
+            bounds = self._buckets.setdefault(name, tuple(buckets))
+            series = self._histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = {"buckets": [0] * len(bounds), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(bounds):
+                if value <= bound:
+                    state["buckets"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def watch_file(self, store: str, path: str) -> None:
+        """Report the size of a file (or the total of a directory) as file_size_bytes{store}."""
+        with self._lock:
+            self._files[store] = path
+
+    def add_collector(self, collector: Callable[[], List[Tuple[str, Dict[str, Any], float]]]) -> None:
+        """Gauges computed at scrape time: collector() -> [(name, labels, value)]."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def counter_value(self, name: str, labels: Optional[Dict[str, Any]] = None) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels(labels), 0.0)
+
+    def _file_gauges(self) -> List[Tuple[str, Dict[str, Any], float]]:
+        gauges = []
+        for store, path in self._files.items():
+            if os.path.isdir(path):
+                size = 0
+                for name in os.listdir(path):
+                    try:
+                        size += os.path.getsize(os.path.join(path, name))
+                    except OSError:
+                        pass  # Removed while listing
+            elif os.path.exists(path):
+                size = os.path.getsize(path)
+            else:
+                continue
+            gauges.append(("file_size_bytes", {"store": store}, size))
+        return gauges
+
+    def render(self) -> str:
+        """All series in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {key: {**state, "buckets": list(state["buckets"])} for key, state in series.items()}
+                for name, series in self._histograms.items()
+            }
+            buckets = dict(self._buckets)
+            collectors = list(self._collectors)
+
+        gauges: Dict[str, Dict[Labels, float]] = {}
+        for name, labels, value in self._file_gauges() + [row for collector in collectors for row in collector()]:
+            gauges.setdefault(name, {})[_labels(labels)] = value
+
+        lines = []
+        for kind, metrics in (("counter", counters), ("gauge", gauges)):
+            for name in sorted(metrics):
+                full_name = PREFIX + name
+                lines.append(f"# HELP {full_name} {_HELP.get(name, name)}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                for key, value in sorted(metrics[name].items()):
+                    lines.append(f"{full_name}{_format_labels(key)} {_format_value(value)}")
+        for name in sorted(histograms):
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {_HELP.get(name, name)}")
+            lines.append(f"# TYPE {full_name} histogram")
+            for key, state in sorted(histograms[name].items()):
+                for bound, count in zip(buckets[name], state["buckets"]):
+                    lines.append(f"{full_name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {count}")
+                lines.append(f"{full_name}_bucket{_format_labels(key, ('le', '+Inf'))} {state['count']}")
+                lines.append(f"{full_name}_sum{_format_labels(key)} {_format_value(round(state['sum'], 6))}")
+                lines.append(f"{full_name}_count{_format_labels(key)} {state['count']}")
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+
+def inc(name: str, labels: Optional[Dict[str, Any]] = None, value: float = 1.0) -> None:
+    _registry.inc(name, labels, value)
+
+
+def observe(name: str, value: float, labels: Optional[Dict[str, Any]] = None, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+    _registry.observe(name, value, labels, buckets)
+
+
+def watch_file(store: str, path: str) -> None:
+    _registry.watch_file(store, path)
+
+
+@contextmanager
+def timed(name: str, labels: Optional[Dict[str, Any]] = None, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+    """Observe the wall time of a block (also when it raises)."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _registry.observe(name, time.monotonic() - started, labels, buckets)
+
+
+def error_outcome(error) -> str:
+    """Outcome label of a failed call (an exception or a returned "Error ..." string): quota / timeout / error."""
+    message = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+    # Same heuristic as quota.is_quota_error
+    if "RESOURCE_EXHAUSTED" in message or "429" in message or "quota" in message.lower():
+        return "quota"
+    if "timeout" in message.lower() or "timed out" in message.lower() or "DEADLINE_EXCEEDED" in message:
+        return "timeout"
+    return "error"
+
+
+def record_call(provider: str, seconds: float, outcome: str = "ok") -> None:
+    """One model call: latency histogram and outcome counter per provider."""
+    _registry.observe("model_call_seconds", seconds, {"provider": provider})
+    _registry.inc("model_calls_total", {"provider": provider, "outcome": outcome})
+
+
+def instrument_call(provider: str) -> Callable:
+    """
+    Decorator for provider functions: records latency and outcome of every call.
+
+    Raised exceptions and returned "Error ..." texts (plain or first tuple item) count as failures.
+    """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                record_call(provider, time.monotonic() - started, error_outcome(e))
+                raise
+            text = result[0] if isinstance(result, tuple) else result
+            failed = isinstance(text, str) and text.startswith("Error")
+            record_call(provider, time.monotonic() - started, error_outcome(text) if failed else "ok")
+            return result
+        return wrapper
+    return decorator
+
+
+# =========================
+# Exporters
+# =========================
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = _registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood stdout
+
+
+def write_textfile(path: str) -> None:
+    """Write the current metrics atomically (the textfile collector may read at any time)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(_registry.render())
+    os.replace(tmp_path, path)
+
+
+def _textfile_loop(path: str, interval: float) -> None:
+    while True:
+        try:
+            write_textfile(path)
+        except OSError as e:
+            log.warning("metrics textfile write failed", path=path, error=str(e))
+        time.sleep(interval)
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_exporters(
+    port: Optional[int] = None,
+    textfile: Optional[str] = None,
+    interval: float = METRICS_TEXTFILE_INTERVAL
+) -> Dict[str, Any]:
+    """
+    Start the configured exporters once per process (safe to call on every Streamlit rerun).
+
+    Args:
+        port: HTTP port for /metrics (default: METRICS_PORT; 0 = no server)
+        textfile: Textfile collector path (default: METRICS_TEXTFILE; "" = none)
+        interval: Seconds between textfile rewrites
+
+    Returns:
+        {"port", "textfile"} actually started (None when disabled or already running)
+    """
+    global _exporters_started
+    port = METRICS_PORT if port is None else port
+    textfile = METRICS_TEXTFILE if textfile is None else textfile
+    with _exporters_lock:
+        if _exporters_started:
+            return {"port": None, "textfile": None}
+        _exporters_started = True
+
+    started: Dict[str, Any] = {"port": None, "textfile": None}
+    if port:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsHandler)
+        except OSError as e:
+            # Another process (e.g. a second Streamlit worker) already serves this port
+            log.warning("metrics server not started", host=METRICS_HOST, port=port, error=str(e))
+        else:
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            started["port"] = server.server_address[1]
+    if textfile:
+        threading.Thread(target=_textfile_loop, args=(textfile, interval), name="metrics-textfile", daemon=True).start()
+        atexit.register(write_textfile, textfile)
+        started["textfile"] = textfile
+    return started
@@ -0,0 +1,150 @@
+"""
+Phase J: Global Bounded Executor
+One long-lived thread pool for the whole process instead of a fresh
+ThreadPoolExecutor per turn. Each provider has its own concurrency limit, so N
+concurrent 熟考 turns queue up for the free-tier providers instead of firing 3N
+outbound calls at once. Queued tasks wait in a per-provider FIFO without
+occupying a worker thread.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Any, Optional
+
+
+OPENROUTER = "openrouter"
+GITHUB_MODELS = "github_models"
+BEDROCK = "bedrock"
+GEMINI = "gemini"
+LOCAL = "local"
+
+# Concurrent in-flight calls per provider (free tiers return 429s quickly)
+PROVIDER_LIMITS = {
+    OPENROUTER: int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "2")),
+    GITHUB_MODELS: int(os.getenv("GITHUB_MODELS_MAX_CONCURRENCY", "2")),
+    BEDROCK: int(os.getenv("BEDROCK_MAX_CONCURRENCY", "4")),
+    # Gemini calls are additionally bounded by the scheduler / quota ledger
+    GEMINI: int(os.getenv("GEMINI_TASK_MAX_CONCURRENCY", "8")),
+    LOCAL: 4,
+}
+
+MAX_WORKERS = int(os.getenv("PHASE_EXECUTOR_WORKERS", "16"))
+
+
+class _ProviderQueue:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.pending: deque = deque()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+
+class PhaseExecutor:
+    """
+    Process-wide executor with per-provider concurrency limits and queue metrics.
+
+    Usage:
+        future = get_executor().submit(OPENROUTER, think_with_grok, prompt, text)
+        result = future.result(timeout=60)
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, limits: Optional[Dict[str, int]] = None):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="phase")
+        self._lock = threading.Lock()
+        self._limits = dict(limits or PROVIDER_LIMITS)
+        self._queues: Dict[str, _ProviderQueue] = {}
+
+    def _queue(self, provider: str) -> _ProviderQueue:
+        if provider not in self._queues:
+            self._queues[provider] = _ProviderQueue(self._limits.get(provider, self._limits[LOCAL]))
+        return self._queues[provider]
+
+    def submit(self, provider: str, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Queue a task for a provider.
+
+        The caller's context variables (e.g. the scheduler priority) are carried
+        into the worker thread.
+
+        Returns:
+            Future resolved with fn's result (or exception)
+        """
+        future: Future = Future()
+        context = contextvars.copy_context()
+        with self._lock:
+            queue = self._queue(provider)
+            queue.pending.append((future, context, fn, args, kwargs, time.monotonic()))
+            queue.max_depth = max(queue.max_depth, len(queue.pending))
+            self._dispatch(provider)
+        return future
+
+    def run(self, provider: str, fn: Callable, *args, **kwargs) -> Any:
+        """Synchronous call that still respects the provider limit."""
+        return self.submit(provider, fn, *args, **kwargs).result()
+
+    def _dispatch(self, provider: str) -> None:
+        """Start queued tasks while the provider has free capacity (caller holds the lock)."""
+        queue = self._queues[provider]
+        while queue.pending and queue.in_flight < queue.limit:
+            future, context, fn, args, kwargs, enqueued_at = queue.pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            queue.in_flight += 1
+            queue.total_wait += time.monotonic() - enqueued_at
+            self._pool.submit(self._run_task, provider, future, context, fn, args, kwargs)
+
+    def _run_task(self, provider, future, context, fn, args, kwargs) -> None:
+        failed = False
+        try:
+            result = context.run(fn, *args, **kwargs)
+        except BaseException as e:
+            failed = True
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                queue = self._queues[provider]
+                queue.in_flight -= 1
+                queue.completed += 1
+                queue.failed += int(failed)
+                self._dispatch(provider)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Per-provider limit / in_flight / queued / max_queue_depth / completed / failed / mean_wait_seconds."""
+        with self._lock:
+            return {
+                provider: {
+                    "limit": queue.limit,
+                    "in_flight": queue.in_flight,
+                    "queued": len(queue.pending),
+                    "max_queue_depth": queue.max_depth,
+                    "completed": queue.completed,
+                    "failed": queue.failed,
+                    "mean_wait_seconds": queue.total_wait / (queue.completed + queue.in_flight)
+                    if (queue.completed + queue.in_flight) else 0.0,
+                }
+                for provider, queue in self._queues.items()
+            }
+
+
+_executor: Optional[PhaseExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> PhaseExecutor:
+    """Process-wide executor shared by every browser session."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = PhaseExecutor()
+        return _executor
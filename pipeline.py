@@ -0,0 +1,2121 @@
+"""
+Phase K: Headless Pipeline
+The research → fan-out → synthesis → review pipeline as a plain function.
+run_pipeline() reports progress through PipelineCallbacks instead of writing
+to the Streamlit status box, returns usage instead of touching
+st.session_state, and signals a cascade escalation in its result instead of
+calling st.rerun(), so workers, benchmarks and CLIs can run the same engine.
+
+⚠️ Like logic.py, this module must not import streamlit.
+
+Usage:
+    python pipeline.py "質問" [--mode "熟考 (本気MAX)ms/Az"] [--json]
+"""
+
+import time
+import datetime
+from concurrent.futures import as_completed, TimeoutError as FuturesTimeoutError
+from typing import Dict, Any, Optional, List
+
+from google.genai import types
+
+from logic import (
+    extract_text_from_response, extract_grounding_sources,
+    get_client, get_relevant_context, load_user_profile
+)
+from checkpoints import load_checkpoint, save_phase, update_run
+from cascade import (
+    CASCADE_FAST_MODEL, CASCADE_STRONG_MODEL, CASCADE_ESCALATION_MODE, CASCADE_CONFIDENCE_INSTRUCTION,
+    parse_confidence, should_escalate, build_cascade_info
+)
+from router import ROUTING_MODEL_ID, SAFE_DEFAULT_CLASSIFICATION, analyze_question_for_routing, classify_question, classify_question_fast, route_question_to_pipeline
+from scheduler import INTERACTIVE, SYNTHESIS, set_priority, reset_priority
+from quota import last_call_window
+import metrics
+from usage_ledger import get_usage_ledger
+from pricing import empty_usage, gemini_usage, bedrock_usage, openai_usage, usage_cost
+from telemetry import Trace, CALL
+from phase_executor import OPENROUTER, GITHUB_MODELS, BEDROCK, GEMINI, get_executor
+from providers import (
+    CLAUDE_MODEL_ID, GITHUB_MODEL_ID, SECONDARY_MODEL_ID, SECONDARY_MODEL_NAME, has_openrouter, has_bedrock, has_github_models,
+    think_with_grok, review_with_grok, think_with_claude45_bedrock, think_with_o4_mini
+)
+from applog import get_logger, with_log_context
+from followup import (
+    find_previous_research, detect_followup,
+    build_incremental_research_prompt, merge_research_text
+)
+from research_ir import merge_research_ir
+from review_patch import REVIEW_PATCH_OUTPUT_INSTRUCTION, parse_review_edits, apply_review_edits
+
+log = get_logger(__name__)
+
+
+# =========================
+# Phase 1.3: Fact / Risk Extraction
+# =========================
+
+def extract_facts_and_risks(client, model_id: str, research_text: str) -> tuple[str, str, dict]:
+    """
+    Phase B以前の後方互換用（v1）：事実とリスクをMarkdown形式で抽出
+    
+    ⚠️ このv1関数は、以下の場合のみ使用されます：
+    - Phase B IR抽出（extract_facts_and_risks_v2）が失敗した場合のフォールバック
+    - 古いセッションとの互換性維持
+    
+    Phase B実装後は、extract_facts_and_risks_v2() がメインパスです。
+    
+    Args:
+        client: Gemini client
+        model_id: 使用するモデル
+        research_text: 調査テキスト
+    
+    Returns:
+        Tuple of (fact_summary, risk_summary, usage_dict)
+    """
+    extraction_prompt = f"""以下の調査結果から、事実とリスクを分離してください。
+
+【調査結果】
+{research_text[:8000]}
+
+【出力形式（厳守）】
+以下のJSON形式で出力してください：
+{{
+  "facts": [
+    "確認された事実1（日付・数値・引用元を含む）",
+    "確認された事実2",
+    ...（5-10項目）
+  ],
+  "risks": [
+    "リスク・不確実性1（簡潔に）",
+    "リスク・不確実性2",
+    ...（3-7項目）
+  ],
+  "unknowns": [
+    "情報が不足している点（ある場合のみ）"
+  ]
+}}
+
+JSONのみを出力し、マークダウンや説明文を含めないでください。"""
+    
+    config = types.GenerateContentConfig(
+        temperature=0.2,
+        system_instruction="事実とリスクを正確に分離し、JSON形式で出力する専門家として振る舞ってください。"
+    )
+    
+    try:
+        response = client.models.generate_content(
+            model=model_id,
+            contents=extraction_prompt,
+            config=config
+        )
+        text = extract_text_from_response(response).strip()
+        
+        # usage情報を取得
+        usage_dict = gemini_usage(response)
+        
+        # JSONパースを試みる
+        import json
+        import re
+        
+        # コードブロックを除去（```json ... ```）
+        json_text = re.sub(r'```json\s*|\s*```', '', text)
+        
+        try:
+            data = json.loads(json_text)
+            facts = data.get("facts", [])
+            risks = data.get("risks", [])
+            unknowns = data.get("unknowns", [])
+            
+            # 事実の整形
+            fact_summary = "## 📊 事実\n" + "\n".join([f"- {f}" for f in facts])
+            if unknowns:
+                fact_summary += "\n\n### 不明点\n" + "\n".join([f"- {u}" for u in unknowns])
+            
+            # リスクの整形
+            risk_summary = "## ⚠️ リスク・不確実性\n" + "\n".join([f"- {r}" for r in risks])
+            
+            return fact_summary, risk_summary, usage_dict
+            
+        except json.JSONDecodeError:
+            # JSONパース失敗時はMarkdownフォールバック
+            if "##" in text:
+                parts = text.split("##")
+                fact_summary = parts[1] if len(parts) > 1 else text[:len(text)//2]
+                risk_summary = parts[2] if len(parts) > 2 else text[len(text)//2:]
+            else:
+                mid = len(text) // 2
+                fact_summary = text[:len(text)//2]
+            risk_summary = text[len(text)//2:]
+            return fact_summary, risk_summary, usage_dict
+            
+    except Exception as e:
+        # エラー時は空の結果を返す
+        return "事実抽出エラー", "リスク抽出エラー", empty_usage()
+
+
+# ========================================
+# Phase B: JSON IR Extraction (v2)
+# ========================================
+
+def build_ir_extraction_prompt(model_id: str, user_question: str, research_text: str) -> str:
+    """
+    Build the Phase 1.3 JSON IR extraction prompt (shared by the online call and batch prediction).
+    """
+    from datetime import datetime
+
+    # Truncate research_text if too long
+    truncated_research = research_text[:4000] if len(research_text) > 4000 else research_text
+
+    return f"""以下の調査メモから、構造化された情報を抽出してJSON形式で出力してください。
+
+【調査メモ】
+{truncated_research}
+
+【タスク】
+以下のJSON形式**のみ**を出力してください。説明文や前置きは不要です。
+
+{{
+  "facts": [
+    {{
+      "statement": "具体的な事実の記述",
+      "source": "web",
+      "source_detail": "URLまたは出典先",
+      "date": "2024-12-04",
+      "confidence": "high"
+    }}
+  ],
+  "options": [
+    {{
+      "name": "選択肢・案の名前",
+      "pros": ["メリット1", "メリット2"],
+      "cons": ["デメリット1"],
+      "conditions": ["成立条件1"],
+      "estimated_cost": null
+    }}
+  ],
+  "risks": [
+    {{
+      "statement": "リスクの内容",
+      "severity": "high",
+      "timeframe": "short",
+      "mitigation": "対策案（あれば）"
+    }}
+  ],
+  "unknowns": [
+    {{
+      "question": "不明な点・要確認事項",
+      "why_unknown": "insufficient_data",
+      "impact": "high"
+    }}
+  ],
+  "metadata": {{
+    "question": "{user_question[:150]}",
+    "language": "ja",
+    "created_at": "{datetime.now().isoformat()}",
+    "models": ["{model_id}"],
+    "sources_count": 1,
+    "search_queries": []
+  }}
+}}
+
+【重要な制約】
+1. source は "web", "youtube", "model" のいずれか
+2. confidence は "high", "medium", "low" のいずれか
+   - high: 公式情報または複数ソースで確認
+   - medium: 単一ソースまたは間接情報
+   - low: 推測または古い情報
+3. severity/impact は "high", "medium", "low" のいずれか
+4. timeframe は "short", "medium", "long" のいずれか
+5. why_unknown は "insufficient_data", "conflicting_data", "grey_area", "future_dependent" のいずれか
+6. 該当項目がない場合は空配列 [] を使用
+7. JSONのみを出力（コードブロックや説明文は不要）
+"""
+
+
+def parse_ir_json(raw_text: str) -> Optional[dict]:
+    """
+    Parse and normalize the IR extraction output.
+
+    Returns: normalized IR dict, or None if the JSON could not be parsed
+    """
+    from research_ir import validate_research_ir
+    import json
+    import re
+
+    # Remove code blocks if present
+    json_text = re.sub(r'```json\s*|\s*```', '', raw_text)
+
+    # Parse JSON with retry
+    ir_dict = None
+    for attempt in range(2):
+        try:
+            ir_dict = json.loads(json_text)
+            break
+        except json.JSONDecodeError as e:
+            if attempt == 0:
+                # Try to fix common issues
+                json_text = json_text.replace("'", '"')  # Single to double quotes
+                json_text = re.sub(r',\s*}', '}', json_text)  # Remove trailing commas
+                json_text = re.sub(r',\s*]', ']', json_text)
+            else:
+                log.warning("research IR is not valid JSON after repair", error=str(e))
+                return None
+
+    if ir_dict is None:
+        return None
+
+    # Validate and normalize
+    normalized_ir, warnings = validate_research_ir(ir_dict)
+
+    if warnings:
+        log.debug("research IR validation warnings", warnings=warnings)
+
+    return normalized_ir
+
+
+def extract_facts_and_risks_v2(
+    client,
+    model_id: str,
+    user_question: str,
+    research_text: str
+) -> tuple:
+    """
+    Extract structured JSON IR from research text (Phase B).
+    
+    Returns: (ir_dict or None, usage_dict, raw_json_text)
+    """
+    try:
+        extraction_prompt = build_ir_extraction_prompt(model_id, user_question, research_text)
+
+        config = types.GenerateContentConfig(
+            temperature=0.1,  # 事実抽出は低温度
+            response_mime_type="application/json"
+        )
+        
+        response = client.models.generate_content(
+            model=model_id,
+            contents=[{"role": "user", "parts": [{"text": extraction_prompt}]}],
+            config=config
+        )
+        
+        raw_text = extract_text_from_response(response).strip()
+        usage_dict = gemini_usage(response)
+        
+        return (parse_ir_json(raw_text), usage_dict, raw_text)
+        
+    except Exception as e:
+        log.warning("research IR extraction failed", error=str(e), exc_info=log.debug_enabled())
+        return (None, empty_usage(), str(e))
+
+
+def convert_ir_to_markdown(ir: dict) -> tuple[str, str]:
+    """
+    Convert JSON IR to Markdown format for backward compatibility.
+    
+    Args:
+        ir: ResearchIR dictionary
+    
+    Returns:
+        Tuple of (fact_summary, risk_summary)
+    """
+    from research_ir import build_synthesis_prompt_from_ir
+    
+    # Facts section
+    fact_lines = ["## 📊 事実"]
+    confidence_marks = {
+        "high": "✓",
+        "medium": "△",
+        "low": "?",
+        "unknown": "·"
+    }
+    
+    for fact in ir.get("facts", []):
+        mark = confidence_marks.get(fact.get("confidence", "unknown"), "·")
+        fact_lines.append(f"{mark} {fact.get('statement', '')}")
+        if fact.get("source_detail"):
+            fact_lines.append(f"  出典: {fact['source_detail']}")
+    
+    # Unknowns section
+    if ir.get("unknowns"):
+        fact_lines.append("\n### 不明点・要確認事項")
+        for unknown in ir["unknowns"]:
+            fact_lines.append(f"? {unknown.get('question', '')}")
+    
+    fact_summary = "\n".join(fact_lines) if fact_lines else "（抽出された事実なし）"
+    
+    # Risks section
+    risk_lines = ["## ⚠️ リスク・不確実性"]
+    severity_emoji = {"high": "🔴", "medium": "🟡", "low": "🟢", "unknown": "⚪"}
+    
+    # Sort by severity
+    severity_order = {"high": 0, "medium": 1, "low": 2, "unknown": 3}
+    sorted_risks = sorted(
+        ir.get("risks", []),
+        key=lambda x: severity_order.get(x.get("severity", "unknown"), 3)
+    )
+    
+    for risk in sorted_risks:
+        emoji = severity_emoji.get(risk.get("severity", "unknown"), "⚪")
+        risk_lines.append(f"{emoji} {risk.get('statement', '')}")
+        if risk.get("mitigation"):
+            risk_lines.append(f"  対策: {risk['mitigation']}")
+    
+    risk_summary = "\n".join(risk_lines) if risk_lines else "（特定されたリスクなし）"
+    
+    return (fact_summary, risk_summary)
+
+
+def build_session_memory(sessions: list, current_session_id: str, max_entries: int = 10) -> str:
+    """
+    
+    Args:
+        sessions: すべてのセッション
+        current_session_id: 現在のセッションID
+        max_entries: 最大エントリ数
+    
+    Returns:
+        セッション記憶のテキスト
+    """
+    # 現在のセッションを除外
+    past_sessions = [s for s in sessions if s["id"] != current_session_id]
+    
+    if not past_sessions:
+        return ""
+    
+    # 最新のmax_entriesセッションを取得
+    recent_sessions = past_sessions[-max_entries:]
+    
+    # ユーザーの質問と重要な判断を抽出
+    key_contexts = []
+    for session in recent_sessions:
+        for msg in session.get("messages", []):
+            if msg["role"] == "user" and len(msg["content"]) > 50:
+                # 十分な長さの質問のみ
+                key_contexts.append(msg["content"][:200])
+    
+    if not key_contexts:
+        return ""
+    
+    # 簡易要約
+    memory_text = "【過去の文脈・判断基準】\n"
+    memory_text += "\n".join([f"- {ctx}..." for ctx in key_contexts[-5:]])
+    memory_text += "\n\n"
+    
+    return memory_text
+
+
+# =========================
+# Phase 2 / Phase 3 Prompt Builders
+# =========================
+# ライブ実行と「再生成」(Deep Log からの Phase 2/3 再実行) で同じプロンプトを使う
+
+# ★ System Instruction の改善: メタ発言禁止とプロフェッショナルな振る舞いを指示
+BASE_SYSTEM_INSTRUCTION = (
+    "あなたは高度な知性を持つ専門的なリサーチ・アシスタントです。\n"
+    "\n"
+    "**【判断憲法 - この原則に従ってください】**\n"
+    "・安全性 > 品質 > コスト > スピード の優先順位で判断する\n"
+    "・取り返しのつかないリスクは絶対に避ける（人命、セキュリティ、法令違反）\n"
+    "・不確実な情報は必ず明示し、確信が持てない場合は「自信度: Low」と記載する\n"
+    "・複数の選択肢がある場合は、リスクとリターンを定量的に比較する\n"
+    "\n"
+    "以下のガイドラインを厳守してください：\n"
+    "1. **メタ発言の禁止**: 「私はAIです」「世界最高峰の～として」などの自己言及や前置きは一切行わないでください。\n"
+    "2. **意図の汲み取り**: ユーザーの質問の背後にある意図（文脈、暗黙の前提）を推測し、言葉通りではなく「ユーザーが本当に知りたいこと」に答えてください。\n"
+    "3. **構造化された回答**: 結論を先に述べ、その後に詳細な根拠、シナリオ分析、リスク要因を論理的に展開してください。\n"
+    "4. **客観性**: 予測を行う場合は、断定を避け、複数のシナリオ（楽観、悲観、中立）を提示してください。\n"
+    "5. **引用**: 検索を使用した場合は、必ず情報源を明示してください。\n"
+    "6. **改行の制限**: Markdownは使用してよいですが、連続する空行は1行までにしてください。"
+)
+
+
+def build_synthesis_request(
+    prompt: str,
+    research_text: str,
+    current_ir: dict = None,
+    questions_text: str = "",
+    grok_thought: str = "",
+    claude45_thought: str = "",
+    o4mini_thought: str = "",
+    enable_meta: bool = False,
+) -> tuple[str, str]:
+    """
+    Build the Phase 2 (synthesis) system instruction and prompt text.
+
+    Args:
+        prompt: User question
+        research_text: Phase 1 research memo
+        current_ir: Phase 1.3 JSON IR (preferred over the memo when present)
+        questions_text: Phase 1.5a meta questions
+        grok_thought / claude45_thought / o4mini_thought: Phase 1.5 outputs ("" if unavailable)
+        enable_meta: Meta-thinking mode (deep instruction + meta questions)
+
+    Returns:
+        Tuple of (system_instruction, synthesis_prompt_text)
+    """
+    import datetime as dt
+    current_date = dt.datetime.now().strftime("%Y年%m月%d日")
+    current_year = dt.datetime.now().year
+
+    if enable_meta:
+        deep_instruction = BASE_SYSTEM_INSTRUCTION + f"""
+
+【Phase 3: 深い統合と総括指示】
+
+上記の多段フェーズで得られた情報（リサーチメモ、Grok回答、Claude回答、o4-mini回答、各レビュー）を総合し、
+ユーザーにとって最も価値ある最終回答を作成してください。
+
+**将来予測の注意事項（特にマクロ経済・株価など）:**
+・将来の数値（株価水準や金利水準）は、具体的な水準を1つに固定せず、「レンジ」と「不確実性」を明示すること。
+・政治シナリオも1つに決め打ちせず、複数の可能性を示すこと。
+・断定的な予測ではなく、シナリオとリスクに寄せた表現にすること。
+
+**文章スタイル:**
+- 見出し・箇条書きを効果的に使い、読みやすくする
+- Markdownを許可するが、連続する空行は1行まで
+- リサーチメモに引用元URLがあれば、適宜参照リンクとして提示する
+
+**思考プロセスの公開:**
+- 「Phase 1: リサーチ」「Phase 2: 多モデル回答」「Phase 3: 統合」を踏まえた上で、
+  どのような判断軸で最終回答を構成したのかを軽く述べてもよい
+
+ユーザーの質問:
+{prompt}
+
+**あなたの役割**: 最終判断エージェント
+
+**タスク**: 調査メモとサブモデル(Grok, Claude, o4-mini)の指摘を統合し、
+ユーザーにとって実務的に使える「判断」を出してください。
+
+**出力構成**（この順番で必須）:
+
+1. 📌 結論
+   - 1〜3行で、方針 / Yes/No / 推奨案をはっきり書く
+
+2. 🔑 主要な根拠
+   - 箇条書きで3〜7個
+   - それぞれについて「どの情報源 / どのモデルがそう言っているか」を書く
+   - できれば「強さ (強/中/弱)」も付ける
+
+3. 📉📈 シナリオ分岐
+   - 楽観 / ベース / 悲観 の3パターンでどう変わりうるかを書く
+   - それぞれ何がトリガーになるかも書く
+
+4. ⚠️ リスク・反対意見
+   - Grok, Claude, o4-mini が挙げた懸念・反論を統合して列挙
+   - 「どのモデルが指摘しているか」も書く
+
+5. ❓ 残っている不確実性と今後必要な検証
+   - まだはっきりしない点
+   - 追加で確認すべきデータや実験
+   - 「ここまでが AI が安全に言える範囲」という線引き
+
+6. 📊 比較・スコアリング（複数選択肢がある場合）
+   - 選択肢の一覧
+   - 簡易比較表（軸ごとのスコア: 10点満点 or 5段階評価）
+   - 各選択肢の強み・弱み
+   - この推奨をひっくり返す条件
+
+7. 🎯 自信度と引き継ぎ
+   - **自信度は次の形式で1行で書いてください**: 
+     * 自信度: High
+     * 自信度: Medium  
+     * 自信度: Low
+   - **自信が Medium または Low の場合**:
+     * 追加で調べるべきデータ
+     * 人間に確認してほしいポイント
+     * GPT-5.1（Antigravity）に投げるなら何を聞くべきか
+
+8. 💰 コスト・工数の考慮（実装提案がある場合）
+   - 提案の実装難易度（低/中/高）
+   - 予想される時間・コスト
+   - 段階的なアプローチ（まず小さく始める方法）
+
+**Facts優先の原則**:
+- 「調査メモ」よりも、「📊 事実」セクションに書かれた内容を優先すること
+- Factsに反することを書く場合は、必ず「仮説」「推測」と明記すること
+- 「⚠️ リスク」に書かれた不確実性は、リスクセクションに必ず反映すること
+
+**🔍 コード解析時の必須チェック（GPT 5.1 Pro同等品質）**:
+質問がコードやシステムに関する場合、以下を必ず実行すること：
+
+1. **構文エラー検出**:
+   - `{{ }}` のような二重ブレース、インデントエラー、括弧の不一致を探す
+   - f-stringの中のエスケープ問題をチェック
+
+2. **参照 vs コピー問題**:
+   - リストや辞書を返す関数で `.copy()` や `list()` が必要か確認
+   - 「この関数は参照を返しているが、コピーを返すべきか？」を検討
+
+3. **網羅性チェック**:
+   - 問題を1つ見つけたら「同じパターンは他にないか」を確認
+   - 「この関数と類似の関数は全て同じ問題を抱えていないか」を検証
+
+4. **修正コード要件**:
+   - コピペでそのまま使えるコードを提示
+   - 修正理由を簡潔に説明
+
+**重要 - 現在は{current_date}です**:
+- **調査メモに含まれる日付・事実を、あなたの学習データよりも絶対的に優先してください**
+- 「{current_year}年」の情報が調査メモにある場合、それを正として扱ってください
+- 学習データが{current_year-1}年以前で止まっていても、調査メモの最新情報を信頼すること
+- 新しい事実を勝手に作らず、調査メモの範囲内で推論すること
+"""
+    else:
+        deep_instruction = BASE_SYSTEM_INSTRUCTION + f"""
+
+- **調査メモまたは構造化IR（JSON）に含まれる最新の情報（最新のモデル名、バージョン、日付など）を優先的に使用すること**
+- 古い情報と新しい情報が混在する場合は、新しい情報を優先すること
+- **構造化IRがある場合は、「確認された事実」「リスク」「選択肢」「不明点」セクションを最優先で参照すること**
+- **IRに含まれていない新しい事実を勝手に作らないこと**
+"""
+
+    # Phase B: IR-based synthesis prompt (IR優先ロジック)
+    if current_ir is not None:
+        # IR extraction succeeded - use structured IR
+        from research_ir import build_synthesis_prompt_from_ir
+
+        ir_block = build_synthesis_prompt_from_ir(current_ir, prompt)
+
+        synthesis_prompt_text = (
+            f"重要: 今日は{current_date}です。古い情報を回答に含めないでください。\n\n"
+            f"==== 構造化調査IR (Phase B) ====\n"
+            f"{ir_block}\n"
+            f"==== IRここまで ====\n\n"
+        )
+    else:
+        # IR extraction failed or not available - fallback to v1
+        synthesis_prompt_text = (
+            f"重要: 今日は{current_date}です。古い情報を回答に含めないでください。\n\n"
+            f"ユーザーの質問: {prompt}\n\n"
+            f"==== 調査メモ ====\n{research_text}\n==== 調査メモここまで ====\n\n"
+        )
+
+    if enable_meta and questions_text:
+        synthesis_prompt_text += f"==== メタ質問一覧 ====\n{questions_text}\n==== メタ質問ここまで ====\n\n"
+
+    if enable_meta and grok_thought:
+        synthesis_prompt_text += f"==== 別視点からのリスク指摘 ({SECONDARY_MODEL_NAME}) ====\n{grok_thought}\n==== {SECONDARY_MODEL_NAME} ここまで ====\n\n"
+
+    if claude45_thought:
+        synthesis_prompt_text += f"==== 別視点からの回答案 (Claude 4.5 Sonnet / AWS Bedrock) ====\n{claude45_thought}\n==== Claude 4.5 Sonnet ここまで ====\n\n"
+
+    if o4mini_thought:
+        synthesis_prompt_text += f"==== 見落とし/リスクチェック (o4-mini / GitHub Models) ====\n{o4mini_thought}\n==== o4-mini ここまで ====\n\n"
+
+    # 統合指示
+    if enable_meta and (grok_thought or claude45_thought or o4mini_thought):
+        synthesis_prompt_text += f"指示:\n1. まず、メタ質問 Q1〜Qn に一つずつ簡潔に答えてください。\n2. 他のモデル ({SECONDARY_MODEL_NAME}, Claude 4.5 Sonnet, o4-mini) の回答案も参考にしつつ（ただし盲信せず）、独自の視点で統合してください。\n3. そのうえで、それらの回答を踏まえた『全体としての結論・分析・示唆』をまとめてください。"
+    elif enable_meta and questions_text:
+        synthesis_prompt_text += "指示:\n1. まず、メタ質問 Q1〜Qn に一つずつ簡潔に答えてください。\n2. そのうえで、それらの回答を踏まえた『全体としての結論・分析・示唆』をまとめてください。"
+    else:
+        synthesis_prompt_text += "上記メモを根拠に、最終回答を作成してください。**調査メモに含まれる最新の情報を必ず使用してください。**"
+
+    return deep_instruction, synthesis_prompt_text
+
+
+def build_review_request(prompt: str, research_text: str, draft_answer: str, patch_mode: bool = False) -> tuple[str, str]:
+    """
+    Build the Phase 3 (鬼軍曹 review) system instruction and prompt text.
+
+    Args:
+        prompt: User question
+        research_text: Phase 1 research memo
+        draft_answer: Phase 2 draft
+        patch_mode: Ask for JSON edit operations (review_patch) instead of a full rewrite
+
+    Returns:
+        Tuple of (reviewer_instruction, review_prompt_text)
+    """
+    reviewer_instruction = BASE_SYSTEM_INSTRUCTION + """
+
+**あなたの役割**: 鬼軍曹レベルの厳格なレビューア + Devil's Advocate（悪魔の代弁者）
+
+**タスク**: 初版回答をチェックし、必要なら修正版を返す。ただし、**調査メモの情報を優先し、最新情報を維持すること**。
+
+**レビュー観点**:
+- 事実と推測を明確に分ける
+- 過度に自信のある断定を弱める
+- 数字や固有名詞が調査メモと矛盾していないか確認
+- **調査メモに含まれる最新の情報（最新モデル、バージョン、日付など）が正しく使われているか確認**
+- **古い情報で上書きしていないか確認**
+- 見落としている重要なリスク・シナリオがあれば追加
+
+**🔥 Devil's Advocate（悪魔の代弁者）- 必須**:
+レビュー時に以下を必ず実施してください：
+1. **この結論を覆す最強の反論を3つ**考える
+2. それでも結論が正しいと言えるか検証する
+3. 反論に対する再反論が弱い場合は、結論を修正する
+4. 最終回答に「🔴 最強の反論」セクションを追加し、考慮した反論と、それでも結論を維持する理由を明記
+
+**📊 5段階確信度 - 必須**:
+回答の最後に以下の形式で確信度を明記：
+- **確信度: Very High (90%+)** - ほぼ確実、覆る可能性は低い
+- **確信度: High (70-90%)** - 高い信頼性、主要なリスクは考慮済み
+- **確信度: Medium (50-70%)** - 妥当な推論だが不確実性あり
+- **確信度: Low (30-50%)** - 仮説段階、追加検証が必要
+- **確信度: Very Low (<30%)** - 推測の域を出ない、慎重に扱うべき
+
+確信度がMedium以下の場合は、「⚠️ 確信度を上げるために必要なこと」を追記すること。
+
+**🔍 自己矛盾チェック - 必須**:
+- Phase 1（調査メモ）の情報と、Phase 2（統合回答）の内容に矛盾がないか確認
+- 矛盾がある場合は「⚡ 矛盾検出」として明記し、どちらを採用したか理由を説明
+
+**📎 エビデンス引用 - 重要**:
+- 主要な主張には必ず根拠を示す（「調査メモによると...」「XXXの情報源では...」）
+- 根拠なき断定は避け、推測の場合は「おそらく」「可能性がある」と明記
+- 情報源が複数ある場合は、より信頼性の高いものを優先
+
+**🚫 代替案の棄却理由 - 重要**:
+- 結論を導く際に、検討した他の選択肢を明記
+- 「なぜその選択肢を採用しなかったか」を簡潔に説明
+- 例: 「選択肢Aは〇〇の理由で不適、選択肢Bは△△のリスクがあるため、結論Cを採用」
+
+**重要**: 
+- 調査メモの情報が最新である場合、それを優先すること
+- あなたの知識が古い場合は、調査メモの情報を信頼すること
+
+"""
+    if patch_mode:
+        reviewer_instruction += REVIEW_PATCH_OUTPUT_INSTRUCTION
+        review_prompt_text = (
+            f"ユーザー質問: {prompt}\n\n"
+            f"==== 調査メモ ====\n{research_text}\n==== 調査メモここまで ====\n\n"
+            f"初版回答:\n{draft_answer}\n\n"
+            "上記をレビューし、必要な修正を編集操作（JSON）として出してください。**調査メモに含まれる最新情報を維持してください。**"
+        )
+    else:
+        reviewer_instruction += "**出力**: 修正版の回答全文（Devil's Advocateセクション、確信度、エビデンス引用を含む）\n"
+        review_prompt_text = (
+            f"ユーザー質問: {prompt}\n\n"
+            f"==== 調査メモ ====\n{research_text}\n==== 調査メモここまで ====\n\n"
+            f"初版回答:\n{draft_answer}\n\n"
+            "上記をレビューし、必要なら修正版を出してください。**調査メモに含まれる最新情報を維持してください。**"
+        )
+    return reviewer_instruction, review_prompt_text
+
+
+def thinking_config_for(model_id: str):
+    """
+    thinking_level は Gemini 3 系のみ対応のため、それ以外 (カスケードの flash 等) では指定しない
+    """
+    if model_id.startswith("gemini-3"):
+        return types.ThinkingConfig(thinking_level=types.ThinkingLevel.HIGH)
+    return None
+
+
+# 再生成アクション (Deep Log から Phase 2 / Phase 3 だけを再実行)
+REGENERATE_ACTIONS = {
+    "synthesis": "Phase 2 再統合",
+    "review": "Phase 3 鬼軍曹レビュー",
+}
+
+
+def regenerate_from_logs(client, question: str, logs: dict, action: str, model_id: str) -> tuple[str, dict]:
+    """
+    Re-run only Phase 2 (synthesis) or Phase 3 (review) from a stored Deep Log.
+
+    Research, IR, meta questions and Phase 1.5 outputs are rebuilt from
+    reasoning_logs, so the research and fan-out phases are skipped and the
+    regeneration costs a single model call.
+
+    Args:
+        client: Gemini client
+        question: User question of the turn
+        logs: reasoning_logs of the stored model message
+        action: "synthesis" or "review"
+        model_id: Gemini model to use
+
+    Returns:
+        Tuple of (answer_text, usage_dict)
+    """
+    research_text = logs.get("phase1_research") or ""
+
+    def usable(text):
+        # Phase 1.5 がエラー文字列を返していた場合は統合に混ぜない
+        return text if text and not text.startswith("Error") else ""
+
+    if action == "synthesis":
+        questions_text = logs.get("phase1_5_meta_questions") or ""
+        system_instruction, prompt_text = build_synthesis_request(
+            question,
+            research_text,
+            current_ir=logs.get("phase1_3_ir"),
+            questions_text=questions_text,
+            grok_thought=usable(logs.get("phase1_5b_secondary")),
+            claude45_thought=usable(logs.get("phase1_5d_claude")),
+            o4mini_thought=usable(logs.get("phase1_5e_o4mini")),
+            enable_meta=bool(questions_text),
+        )
+        temperature = 0.4
+    elif action == "review":
+        draft_answer = logs.get("phase2_draft")
+        if not draft_answer:
+            raise ValueError("Deep Log に Phase 2 の初版がないため、レビューのみの再実行はできません")
+        system_instruction, prompt_text = build_review_request(question, research_text, draft_answer)
+        temperature = 0.1
+    else:
+        raise ValueError(f"Unknown regenerate action: {action}")
+
+    response = client.models.generate_content(
+        model=model_id,
+        contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt_text)])],
+        config=types.GenerateContentConfig(
+            temperature=temperature,
+            candidate_count=1,
+            system_instruction=system_instruction,
+            thinking_config=thinking_config_for(model_id),
+        ),
+    )
+    answer = extract_text_from_response(response)
+
+    return answer, gemini_usage(response)
+
+
+# =========================
+# Headless Pipeline
+# =========================
+
+MULTILAYER_CATEGORY = "🎯 回答モード(多層)"
+DEFAULT_MODEL_ID = "gemini-3-pro-preview"
+
+# Phase 1.5 fan-out: models still running after this are dropped and Phase 2 proceeds
+FAN_OUT_TIMEOUT = 60
+
+# オート: after Phase 1, wait at most this long for the speculative LLM classification
+# (it normally finished long before; a late result is ignored but still fills the cache)
+ROUTING_WAIT_SECONDS = 2.0
+
+# Executor queue of each Phase 1.5 task
+FAN_OUT_PROVIDERS = {"grok": OPENROUTER, "claude": BEDROCK, "o4mini": GITHUB_MODELS}
+
+# o4-mini (GitHub Models) only accepts short inputs
+O4_MINI_MAX_INPUT_CHARS = 3800
+
+
+class PipelineCallbacks:
+    """
+    Progress hooks for run_pipeline().
+
+    Every method is a no-op, so a caller overrides only the events it shows
+    (the Streamlit status box) or persists (a job queue, a benchmark log).
+    """
+
+    def status(self, text: str) -> None:
+        """One progress line, e.g. "Phase 1: リサーチフェーズ実行中..."."""
+
+    def warning(self, text: str) -> None:
+        """Recoverable problem; the pipeline continues with a fallback."""
+
+    def error(self, text: str) -> None:
+        """A step failed and its output is dropped; the pipeline continues."""
+
+    def phase(self, label: str) -> None:
+        """Headline of the step in progress (the status label in the UI)."""
+
+    def detail(self, title: str, markdown: str, data: Any = None, raw: Optional[str] = None, note: Optional[str] = None) -> None:
+        """Intermediate output shown collapsed (research memo, meta questions, Phase 1.5 answers)."""
+
+    def draft(self, text: str, note: str) -> None:
+        """Provisional answer to show while the review phases run."""
+
+    def phase_done(self, phase: str, output: Dict[str, Any]) -> None:
+        """A checkpoint phase (checkpoints.PHASE_ORDER) finished or was restored."""
+
+    def usage(self, phase: str, model: str, input_tokens: int, output_tokens: int, cost: float) -> None:
+        """A model call was billed."""
+
+
+def should_use_x_search(prompt: str) -> bool:
+    """Grok X検索はニュース/トレンド系のみ"""
+    keywords = ["Xで", "Twitter", "ツイッター", "ポスト", "トレンド", "炎上", "バズ", "話題"]
+    return any(kw in prompt for kw in keywords)
+
+
+def _build_contents(question: str, history: List[Dict[str, Any]], attachments: List[Dict[str, Any]]) -> list:
+    """Convert stored messages + the current turn (with attachments) into Gemini contents."""
+    contents = []
+    for msg in history:
+        if msg["role"] in ("user", "model"):
+            contents.append(
+                types.Content(role=msg["role"], parts=[types.Part.from_text(text=msg["content"])])
+            )
+
+    current_parts = [types.Part.from_text(text=question)]
+    for attachment in attachments:
+        if attachment.get("data") is not None:
+            current_parts.append(
+                types.Part.from_bytes(data=attachment["data"], mime_type=attachment["mime_type"])
+            )
+        elif attachment.get("text"):
+            current_parts.append(types.Part.from_text(text=attachment["text"]))
+    contents.append(types.Content(role="user", parts=current_parts))
+    return contents
+
+
+def _put_conclusion_first(answer: str) -> str:
+    """メタ思考モード: "結論"や"まとめ"などのセクションを探して先頭に移動（簡易的な実装）"""
+    lines = answer.split('\n')
+    conclusion_start = -1
+    for i, line in enumerate(lines):
+        if any(keyword in line for keyword in ['## 結論', '## まとめ', '**結論**', '**まとめ**']):
+            conclusion_start = i
+            break
+
+    if conclusion_start == -1:
+        return answer
+
+    other_content = lines[:conclusion_start]
+
+    # 結論セクションの終わりを見つける（次の##まで or 文末）
+    conclusion_end = len(lines)
+    for i in range(conclusion_start + 1, len(lines)):
+        if lines[i].startswith('## '):
+            conclusion_end = i
+            break
+
+    conclusion_section = lines[conclusion_start:conclusion_end]
+    remaining_content = lines[conclusion_end:]
+
+    # 再構成: モデル名 → 結論 → その他の詳細
+    model_line = ""
+    if lines[0].startswith("**🤖"):
+        model_line = lines[0]
+        other_content = lines[1:conclusion_start]
+
+    return '\n'.join([
+        model_line,
+        "",
+        "---",
+        "",
+        "## 📌 結論（先出し）",
+        *conclusion_section[1:],  # 元の見出しを除く
+        "",
+        "---",
+        "",
+        "## 📝 詳細",
+        *other_content,
+        *remaining_content
+    ]).strip()
+
+
+def _is_quota_error(e: Exception) -> bool:
+    error_msg = str(e).lower()
+    return "quota" in error_msg or "rate" in error_msg or "resource" in error_msg
+
+
+@with_log_context("run_id", "session_id")
+def run_pipeline(
+    question: str,
+    mode: str,
+    history: Optional[List[Dict[str, Any]]] = None,
+    attachments: Optional[List[Dict[str, Any]]] = None,
+    callbacks: Optional[PipelineCallbacks] = None,
+    *,
+    client=None,
+    model_id: str = DEFAULT_MODEL_ID,
+    mode_category: str = MULTILAYER_CATEGORY,
+    use_search: bool = True,
+    candidate_count: int = 1,
+    review_patch_mode: bool = True,
+    run_id: Optional[str] = None,
+    resume_phases: Optional[Dict[str, Any]] = None,
+    cascade_info: Optional[Dict[str, Any]] = None,
+    sessions: Optional[list] = None,
+    session_id: Optional[str] = None,
+    trace: Optional[Trace] = None,
+    skip_phases: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Run one turn of the research → fan-out → synthesis → review pipeline.
+
+    Args:
+        question: User question
+        mode: Response mode label (e.g. "熟考 (本気MAX)ms/Az", "β1高速 (通常)", "🤖 オート (自動ルーティング)")
+        history: Previous session messages (role / content / reasoning_logs), without the question
+        attachments: Extra parts for the question: {"name", "mime_type", "data": bytes} or {"name", "text"}
+        callbacks: Progress hooks (PipelineCallbacks); defaults to no-ops
+        client: Gemini client (defaults to logic.get_client())
+        model_id: Gemini model
+        mode_category: "🎯 回答モード(多層)" or "🎯 回答モード(通常)"
+        use_search: Enable Google Search grounding in Phase 1
+        candidate_count: Candidate count (kept in the checkpoint settings)
+        review_patch_mode: Phase 3 asks for edit operations before a full rewrite
+        run_id: Checkpoint run id; completed phases are saved under it
+        resume_phases: Phases restored from a checkpoint (skipped instead of re-run)
+        cascade_info: Cascade decision carried over from an escalated run
+        sessions / session_id: All sessions and the current one (past-context lookup in Phase 1)
+        trace: Telemetry trace to append spans to (continued across a cascade escalation)
+        skip_phases: Optional phases dropped to stay within budget (estimator.DOWNGRADE_LADDER):
+            "phase1_5d" (Claude), "phase3b", "phase3" (reviews), "phase1_5" (meta questions + fan-out)
+
+    Returns:
+        Dict with final_answer, draft_answer, reasoning_logs (incl. telemetry spans), grounding_sources,
+        per-model statuses, usage (list of billed calls), cost, and
+        escalated=True when a cascade run must be resumed with the strong model
+        (the checkpoint is already updated; resume it with resume_phases).
+    """
+    history = history or []
+    attachments = attachments or []
+    callbacks = callbacks or PipelineCallbacks()
+    resume_phases = resume_phases or {}
+    skip_phases = set(skip_phases or [])
+    client = client or get_client()
+    if client is None:
+        raise RuntimeError("Gemini client is not available")
+    trace = trace or Trace()
+
+    response_mode = mode
+    metrics.inc("requests_total", {"mode": mode})
+    usage_log: List[Dict[str, Any]] = []
+
+    def bill(phase, model, usage, window=None):
+        """Record one call from its normalized usage (pricing.*_usage); the cost comes from the pricing registry."""
+        cost = usage_cost(model, usage)
+        get_usage_ledger().record(
+            phase, model, usage["input_tokens"], usage["output_tokens"], cost,
+            session_id=session_id, run_id=run_id, latency=window[1] - window[0] if window else None,
+            thinking_tokens=usage["thinking_tokens"], cached_tokens=usage["cached_tokens"],
+        )
+        trace.add_call(phase, model, usage["input_tokens"], usage["output_tokens"] + usage["thinking_tokens"], window)
+        usage_log.append({
+            "phase": phase,
+            "model": model,
+            "input_tokens": usage["input_tokens"],
+            "output_tokens": usage["output_tokens"],
+            "thinking_tokens": usage["thinking_tokens"],
+            "cached_tokens": usage["cached_tokens"],
+            "cost": cost,
+        })
+        callbacks.usage(phase, model, usage["input_tokens"], usage["output_tokens"], cost)
+        return cost
+
+    def bill_response(phase, response, window=None):
+        if response is not None and response.usage_metadata:
+            bill(phase, model_id, gemini_usage(response), window=window or last_call_window())
+
+    def checkpoint(phase, output):
+        if run_id:
+            save_phase(run_id, phase, output)
+        callbacks.phase_done(phase, output)
+
+    contents_for_model = _build_contents(question, history, attachments)
+
+    tools = []
+    if use_search:
+        tools.append(types.Tool(google_search=types.GoogleSearch()))
+
+    base_system_instruction = BASE_SYSTEM_INSTRUCTION
+
+    final_answer = ""
+    draft_answer = None
+    grounding_sources_detail = []  # [{"uri", "title"}] (チェックポイント保存用)
+    phase2_quota_aborted = False
+    escalated = False
+
+    # β1 (リサーチなし) でも後段の処理履歴・コスト表示が参照するため既定値を入れておく
+    research_text = None
+    current_ir = None
+    followup_info = None
+    question_classification = None
+    questions_text = None
+    grok_thought = None
+    claude45_thought = None
+    o4mini_thought = None
+    grok_status = "skipped"
+    grok_error_msg = None
+    claude45_status = "skipped"
+    claude45_usage = {}
+    o4mini_status = "skipped"
+    use_grok_reviewer = False
+    grok_review_status = "skipped"
+    review_patch_info = None  # 差分レビューの適用結果 (Deep Log 用)
+
+    # =========================
+    # Manual Mode Settings
+    # =========================
+    # β1通常モード以外はリサーチを実行
+    enable_research = "β1" not in response_mode
+    enable_meta = "メタ" in response_mode or "MAX" in response_mode or "grok" in response_mode
+    enable_strict = "鬼軍曹" in response_mode or "MAX" in response_mode
+    enable_grok_x_search = "grok" in response_mode and should_use_x_search(question)
+
+    # カスケード: まず flash でリサーチ + 統合し、自信度を見てエスカレーション判断
+    is_cascade = "カスケード" in response_mode
+    if is_cascade:
+        model_id = CASCADE_FAST_MODEL
+
+    # オート: ルール → キャッシュ → LLM の順で分類し、質問に見合ったパイプラインを選ぶ
+    routing_classification = None
+    routed_pipeline = None
+    routing_future = None
+    if "オート" in response_mode:
+        routing_classification = classify_question_fast(question)
+        if routing_classification is not None:
+            routed_pipeline = route_question_to_pipeline(routing_classification)
+            enable_research = routed_pipeline["enable_research"]
+            enable_meta = routed_pipeline["enable_meta"]
+            enable_strict = routed_pipeline["enable_strict"]
+            enable_grok_x_search = routed_pipeline["use_x_search"] and should_use_x_search(question)
+            routing_source = {"rule": "ルール", "cache": "キャッシュ", "learned": "学習モデル"}.get(routing_classification["source"], "")
+            callbacks.status(f"🤖 ルーティング ({routing_source}): {routed_pipeline['routing_reason']}")
+        else:
+            # LLM 分類は Phase 1 リサーチと並行して実行し、結果で Phase 1.3 以降を調整する
+            def classify_in_span(user_profile):
+                with trace.span("routing", kind=CALL, provider="vertex"):
+                    return classify_question(client, question, user_profile)
+
+            routing_future = get_executor().submit(GEMINI, classify_in_span, load_user_profile())
+            enable_research = True  # 投機的にリサーチを開始
+            enable_meta = False
+            enable_strict = False
+            callbacks.status("🤖 ルーティング: LLM 分類を Phase 1 と並行実行中...")
+
+    # 予算調整: 見込みコストが上限を超える場合に省略するフェーズ (estimator.plan_within_budget)
+    enable_meta = enable_meta and "phase1_5" not in skip_phases
+    enable_strict = enable_strict and "phase3" not in skip_phases
+
+    # 高速回答 (β1 / 軽量) は同時実行中の熟考より先にスロットを得る
+    priority = set_priority(INTERACTIVE if not enable_research else SYNTHESIS)
+    try:
+        # =========================
+        # 通常モード (高速 / 鬼軍曹)
+        # =========================
+        if not enable_research:
+            config = types.GenerateContentConfig(
+                temperature=0.8,  # Phase A: アイデア出しフェーズ - 多様性重視
+                candidate_count=1,
+                tools=tools,
+                system_instruction=base_system_instruction,
+            )
+
+            callbacks.status("回答生成中...")
+            light_span = trace.start("light", model=model_id)
+            response = client.models.generate_content(
+                model=model_id,
+                contents=contents_for_model,
+                config=config,
+            )
+            final_answer = extract_text_from_response(response)
+            bill_response("light", response)
+            trace.end(light_span)
+
+            # 鬼軍曹レビュー (通常モード版)
+            if enable_strict:
+                callbacks.status("レビューフェーズ実行中...")
+                reviewer_instruction = base_system_instruction + """
+**あなたの役割**: 鬼軍曹レベルの厳格なレビューア
+**タスク**: 初版回答をチェックし、必要なら修正版を返す
+**出力**: 修正版の回答全文のみ
+"""
+                review_contents = [types.Content(role="user", parts=[types.Part(text=f"ユーザー質問: {question}\n\n初版回答:\n{final_answer}\n\nレビューして修正版を出してください。")])]
+                light_review_span = trace.start("light_review", model=model_id)
+                review_resp = client.models.generate_content(
+                    model=model_id,
+                    contents=review_contents,
+                    config=types.GenerateContentConfig(temperature=0.1, candidate_count=1, system_instruction=reviewer_instruction)
+                )
+                final_answer = extract_text_from_response(review_resp)
+                callbacks.status("✓ レビュー完了")
+                bill_response("light_review", review_resp)
+                trace.end(light_review_span)
+
+        # =========================
+        # 熟考モード: 多段階エージェントシステム
+        # =========================
+        else:
+            # --- Phase 1: リサーチエージェント ---
+            # フォローアップ判定: 前ターンの調査メモ/IRを再利用して差分だけ調べる
+            previous_turn = find_previous_research(history)
+            # オート以外のモードでも話題の変化を判定できるよう、LLM なしの分類をターンに残す
+            question_classification = routing_classification or classify_question_fast(question)
+            followup_info = detect_followup(
+                question,
+                previous_turn["question"] if previous_turn else None,
+                classification=question_classification,
+                previous_classification=previous_turn["classification"] if previous_turn else None,
+            )
+            is_followup = followup_info["is_followup"]
+            if previous_turn:
+                metrics.inc("cache_requests_total", {"cache": "followup", "result": "hit" if is_followup else "miss"})
+
+            restored_phase1 = resume_phases.get("phase1")
+            if restored_phase1:
+                # チェックポイントから復元（Phase 1 は再実行しない）
+                research_text = restored_phase1["research_text"]
+                delta_research_text = restored_phase1.get("delta_research_text", "")
+                grounding_sources_detail = restored_phase1.get("grounding_sources", [])
+                callbacks.status("♻️ Phase 1: チェックポイントから復元")
+                callbacks.phase_done("phase1", restored_phase1)
+                callbacks.detail("収集した調査メモ", research_text)
+            else:
+                if is_followup:
+                    callbacks.status(f"Phase 1: 追加リサーチ実行中（フォローアップ: {followup_info['reason']}）...")
+                else:
+                    callbacks.status("Phase 1: リサーチフェーズ実行中...")
+
+                current_year = datetime.datetime.now().year
+
+                research_instruction = base_system_instruction + f"""
+
+    **あなたの役割**: リサーチ専任エージェント
+
+    **タスク**: ユーザーの質問に答えるための調査メモを作成してください。最終回答は書かず、事実収集に集中すること。
+
+    **調査観点**:
+    - 質問に関連する**最新の事実・データ・統計**（**{current_year}年の情報を最優先**）
+    - **現時点で存在する全ての選択肢・モデル・バージョンを網羅的に調査**（例: 製品比較なら、最新版だけでなく直近の全世代を調査）
+    - 公式情報や信頼できる情報源からの引用
+    - 関連する背景情報や文脈
+    - 競合・代替案・比較対象の**完全なリスト**
+    - リスク・制約・注意点（該当する場合）
+    - 参考にした主要な情報源のURL
+
+    **重要**:
+    - 結論や推奨は書かず、後工程が判断できる調査メモに集中すること
+    - **必ず検索機能を使用し、最新の情報を取得すること**
+    - **検索結果に含まれる最新の日付・バージョン・モデル名を優先的に記載すること**
+    - **比較対象となる選択肢を見落とさないよう、複数の検索クエリを試すこと**（例: 「iPhone 最新モデル {current_year}」「iPhone {current_year}年発売」など）
+    - **「これより新しいモデル/バージョンは存在しないか？」を常に確認すること**
+    - 古い情報（{current_year-1}年以前など）しか見つからない場合は、その旨を明記すること
+    """
+
+                current_date = datetime.datetime.now().strftime("%Y年%m月%d日")
+
+                if is_followup:
+                    # 差分リサーチ: 前回メモを渡し、不足分だけ検索させる（過去セッション文脈は前回取得済み）
+                    research_parts = [types.Part(text=(
+                        f"重要: 今日は{current_date}です。この日付より新しい情報を優先してください。\n\n"
+                        + build_incremental_research_prompt(
+                            question, previous_turn["question"], previous_turn["research_text"]
+                        )
+                    ))]
+                else:
+                    # 過去の関連コンテキストとセッション間記憶を取得
+                    past_context = ""
+                    session_memory = ""
+                    if sessions:
+                        past_context = get_relevant_context(question, sessions, session_id)
+                        session_memory = build_session_memory(sessions, session_id, max_entries=10)
+
+                    # リサーチ用のコンテンツを構築
+                    research_parts = [types.Part(text=(
+                        f"重要: 今日は{current_date}です。この日付より新しい情報を優先してください。\n\n"
+                        f"質問: {question}"
+                    ))]
+
+                    # セッション記憶を先頭に追加
+                    if session_memory:
+                        research_parts.insert(0, types.Part(text=session_memory))
+
+                    if past_context:
+                        research_parts.insert(0, types.Part(text="以下は過去の関連チャットから抽出したコンテキストです：\n\n" + past_context))
+
+                research_contents = contents_for_model + [
+                    types.Content(role="user", parts=research_parts)
+                ]
+
+                research_config = types.GenerateContentConfig(
+                    temperature=0.4,  # 最新情報を柔軟に採用するため0.2→0.4に上昇
+                    candidate_count=1,
+                    tools=tools,
+                    system_instruction=research_instruction,
+                )
+
+                phase1_span = trace.start("phase1", model=model_id)
+                research_resp = client.models.generate_content(
+                    model=model_id,
+                    contents=research_contents,
+                    config=research_config,
+                )
+
+                # TODO: Agentic Loop (Deep Research)
+                # - 検索結果の不確実性が高い場合、while ループで自律的に再検索
+                # - 最大ループ回数のガード（例: max_loops=3）
+                # - 1ターンあたりの最大コスト制限
+                # - 実装優先度: 中（実運用で「ここで再検索してほしい」という痛みが見えてから）
+
+                research_text = extract_text_from_response(research_resp)
+                delta_research_text = ""
+                if is_followup:
+                    delta_research_text = research_text
+                    research_text = merge_research_text(previous_turn["research_text"], delta_research_text)
+
+                # リサーチフェーズのグラウンディング情報を保存
+                if research_resp.candidates and research_resp.candidates[0].grounding_metadata:
+                    grounding_sources_detail = extract_grounding_sources(research_resp.candidates[0].grounding_metadata)
+
+                callbacks.status("✓ 追加リサーチ完了（前回の調査メモに統合）" if is_followup else "✓ リサーチ完了")
+                callbacks.detail("収集した調査メモ", research_text)
+                bill_response("phase1", research_resp)
+                trace.end(phase1_span)
+
+                checkpoint("phase1", {
+                    "research_text": research_text,
+                    "delta_research_text": delta_research_text,
+                    "grounding_sources": grounding_sources_detail,
+                })
+
+            # オート: Phase 1 と並行していた分類結果で後段フェーズを有効化/省略
+            if routing_future is not None:
+                routing_label = "LLM"
+                try:
+                    routing_classification = routing_future.result(timeout=ROUTING_WAIT_SECONDS)
+                except FuturesTimeoutError:
+                    # 分類を待ってクリティカルパスを延ばさない: 未開始なら取り消し、実行中なら結果を捨てる
+                    routing_future.cancel()
+                    log.warning("routing classification timed out", timeout=ROUTING_WAIT_SECONDS)
+                    routing_classification = classify_question_fast(question) or {**SAFE_DEFAULT_CLASSIFICATION, "source": "default"}
+                    routing_label = "LLM タイムアウト"
+                routed_pipeline = route_question_to_pipeline(routing_classification)
+                enable_meta = routed_pipeline["enable_meta"] and "phase1_5" not in skip_phases
+                enable_strict = routed_pipeline["enable_strict"] and "phase3" not in skip_phases
+                enable_grok_x_search = routed_pipeline["use_x_search"] and should_use_x_search(question)
+                if not routed_pipeline["enable_research"]:
+                    routed_pipeline["routing_reason"] += "（リサーチは投機実行済みのため統合のみ実施）"
+                callbacks.status(f"🤖 ルーティング ({routing_label}): {routed_pipeline['routing_reason']}")
+
+            # --- Phase 1.3: 事実とリスクの抽出 (ms/Azモードのみ) ---
+            # Phase B: JSON IR extraction with v1 fallback
+            fact_summary = ""
+            risk_summary = ""
+            is_ms_az_mode = "ms/Az" in response_mode
+            if routed_pipeline:
+                # オート: フル検証 (o4-mini まで使う構成) のときだけ JSON IR を抽出
+                is_ms_az_mode = routed_pipeline["use_o4_mini"]
+
+            if is_ms_az_mode:  # ms/Azモードでのみ重いJSON抽出を実行
+                restored_phase13 = resume_phases.get("phase1_3")
+                if restored_phase13:
+                    current_ir = restored_phase13.get("current_ir")
+                    fact_summary = restored_phase13.get("fact_summary", "")
+                    risk_summary = restored_phase13.get("risk_summary", "")
+                    callbacks.status("♻️ Phase 1.3: チェックポイントから復元")
+                    callbacks.phase_done("phase1_3", restored_phase13)
+                else:
+                    callbacks.status("Phase 1.3: JSON IR抽出中...")
+                    phase13_span = trace.start("phase1_3", model=model_id)
+
+                    previous_ir = previous_turn.get("ir") if is_followup else None
+
+                    # Try v2 extraction first (follow-up: delta memo only, merged into the stored IR)
+                    ir, ir_usage, ir_raw_json = extract_facts_and_risks_v2(
+                        client=client,
+                        model_id=model_id,
+                        user_question=question,
+                        research_text=delta_research_text if previous_ir else research_text
+                    )
+
+                    if previous_ir:
+                        ir = merge_research_ir(previous_ir, ir) if ir is not None else previous_ir
+
+                    if ir is not None:
+                        # IR extraction succeeded
+                        current_ir = ir
+                        fact_summary, risk_summary = convert_ir_to_markdown(ir)
+                        phase13_usage = ir_usage
+                        callbacks.status("✓ Phase 1.3完了 (JSON IR)")
+                        callbacks.detail(
+                            "📊 抽出された事実とリスク (Phase B: JSON IR)",
+                            f"{fact_summary}\n\n{risk_summary}",
+                            data=ir,
+                            raw=ir_raw_json,
+                        )
+                    else:
+                        # IR extraction failed - fallback to v1
+                        callbacks.status("⚠️ IR抽出失敗 - v1にフォールバック中...")
+                        fact_summary, risk_summary, phase13_usage = extract_facts_and_risks(
+                            client, model_id, research_text
+                        )
+                        callbacks.status("✓ Phase 1.3完了 (v1 fallback)")
+                        callbacks.detail(
+                            "抽出された事実とリスク (v1 fallback)",
+                            f"{fact_summary}\n\n{risk_summary}",
+                            note=f"IR抽出エラー: {ir_raw_json[:200]}",
+                        )
+
+                    bill("phase1_3", model_id, phase13_usage, window=last_call_window())
+                    trace.end(phase13_span, status="ok" if current_ir is not None else "fallback")
+
+                    checkpoint("phase1_3", {
+                        "current_ir": current_ir,
+                        "fact_summary": fact_summary,
+                        "risk_summary": risk_summary,
+                    })
+
+            # --- Phase 1.5: メタ質問エージェント ---
+            questions_text = ""
+            if enable_meta:
+                restored_phase15a = resume_phases.get("phase1_5a")
+                if restored_phase15a:
+                    questions_text = restored_phase15a.get("questions_text", "")
+                    callbacks.status("♻️ Phase 1.5a: チェックポイントから復元")
+                    callbacks.phase_done("phase1_5a", restored_phase15a)
+                else:
+                    callbacks.status("Phase 1.5: メタ質問生成中...")
+
+                    question_instruction = base_system_instruction + """
+
+    **あなたの役割**: メタ質問エージェント
+
+    **目的**:
+    ユーザーの元の質問と調査メモを踏まえて、このテーマをさらに深く理解するための「鋭いサブ質問」を作成すること。
+
+    **ルール**:
+    - 最大5個まで
+    - 各質問は1-2行で具体的かつ鋭く
+    - 以下の観点を意識:
+      1. 前提が崩れる可能性はどこか？
+      2. 強気/弱気シナリオの分岐点は何か？
+      3. 競合・技術・規制の不確実性は？
+      4. 「予測が外れるとしたらどんなパターンか？」
+
+    **出力**: 箇条書き（Q1, Q2...）のみ
+    """
+
+                    question_contents = [types.Content(role="user", parts=[types.Part(text=f"ユーザーの元の質問:\n{question}\n\n==== 調査メモ ====\n{research_text}\n==== 調査メモここまで ====\n\nこのテーマをさらに深掘りするための重要なサブ質問を作成してください。")])]
+
+                    phase15a_span = trace.start("phase1_5a", model=model_id)
+                    question_resp = client.models.generate_content(
+                        model=model_id,
+                        contents=question_contents,
+                        config=types.GenerateContentConfig(
+                            temperature=0.4,
+                            candidate_count=1,
+                            system_instruction=question_instruction,
+                        )
+                    )
+
+                    questions_text = extract_text_from_response(question_resp)
+
+                    callbacks.status("✓ メタ質問生成完了")
+                    callbacks.detail("生成されたメタ質問", questions_text)
+                    bill_response("phase1_5a", question_resp)
+                    trace.end(phase15a_span)
+
+                    checkpoint("phase1_5a", {"questions_text": questions_text})
+
+            # ▼▼▼ Phase 1.5b/d/e: 並列処理（高速化） ▼▼▼
+            # 並列タスク用のヘルパー関数（スレッドセーフ）
+            def run_grok_task():
+                """Grok/OpenRouter セカンダリモデル"""
+                if not (enable_meta and has_openrouter()):
+                    return {"status": "skipped", "thought": "", "usage": {}, "error": None}
+                if routed_pipeline and not routed_pipeline["use_grok"]:
+                    return {"status": "skipped", "thought": "", "usage": {}, "error": None}
+                try:
+                    grok_mode = "full_max" if "MAX" in response_mode else "default"
+                    grok_input = f"【事実】\n{fact_summary}\n\n【リスク】\n{risk_summary}" if fact_summary else research_text
+                    with trace.span("phase1_5b", kind=CALL, model=SECONDARY_MODEL_ID) as span:
+                        result, usage = think_with_grok(question, grok_input, enable_x_search=enable_grok_x_search, mode=grok_mode)
+                        result = result.strip()
+                        span["input_tokens"] = (usage or {}).get("prompt_tokens", 0)
+                        span["output_tokens"] = (usage or {}).get("completion_tokens", 0)
+                        if not result:
+                            span["status"] = "empty"
+                    if result:
+                        return {"status": "success", "thought": result, "usage": usage, "error": None}
+                    return {"status": "empty", "thought": "", "usage": usage, "error": None}
+                except Exception as e:
+                    return {"status": "error", "thought": "", "usage": {}, "error": str(e)}
+
+            def run_claude_task():
+                """Claude 4.5 Sonnet (AWS Bedrock)"""
+                is_az_mode = routed_pipeline["use_claude"] if routed_pipeline else "Az" in response_mode
+                if not (is_az_mode and has_bedrock()) or skip_phases & {"phase1_5", "phase1_5d"}:
+                    return {"status": "skipped", "thought": "", "usage": {}, "error": None}
+                try:
+                    if fact_summary:
+                        safe_text = f"【事実】\n{fact_summary}\n\n【リスク】\n{risk_summary}"
+                    else:
+                        safe_text = research_text[:40000]
+                    with trace.span("phase1_5d", kind=CALL, model=CLAUDE_MODEL_ID) as span:
+                        thought, usage = think_with_claude45_bedrock(question, safe_text)
+                        span["input_tokens"] = (usage or {}).get("inputTokens", 0)
+                        span["output_tokens"] = (usage or {}).get("outputTokens", 0)
+                        if not thought or thought.startswith("Error"):
+                            span["status"] = "error"
+                    thought = thought.strip() if thought else ""
+                    if thought and not thought.startswith("Error"):
+                        return {"status": "success", "thought": thought, "usage": usage, "error": None}
+                    return {"status": "error", "thought": thought, "usage": {}, "error": None}
+                except Exception as e:
+                    return {"status": "error", "thought": "", "usage": {}, "error": str(e)}
+
+            def run_o4mini_task():
+                """o4-mini (GitHub Models)"""
+                if fact_summary:
+                    safe_text = f"{fact_summary[:1500]}\n\n{risk_summary[:1500]}"
+                else:
+                    safe_text = research_text[:3000]
+                input_len = len(f"{question}\n\n{safe_text}")
+
+                if not (is_ms_az_mode and has_github_models() and input_len <= O4_MINI_MAX_INPUT_CHARS) or "phase1_5" in skip_phases:
+                    return {"status": "skipped", "thought": "", "usage": {}, "input_len": input_len, "error": None}
+                try:
+                    with trace.span("phase1_5e", kind=CALL, model=GITHUB_MODEL_ID) as span:
+                        thought, usage = think_with_o4_mini(question, safe_text)
+                        span["input_tokens"] = (usage or {}).get("prompt_tokens", 0)
+                        span["output_tokens"] = (usage or {}).get("completion_tokens", 0)
+                        if not thought or thought.startswith("Error"):
+                            span["status"] = "error"
+                    thought = thought.strip() if thought else ""
+                    if thought and not thought.startswith("Error"):
+                        return {"status": "success", "thought": thought, "usage": usage, "input_len": input_len, "error": None}
+                    return {"status": "error", "thought": thought, "usage": {}, "input_len": input_len, "error": None}
+                except Exception as e:
+                    return {"status": "error", "thought": "", "usage": {}, "input_len": input_len, "error": str(e)}
+
+            grok_thought = ""
+            claude45_thought = ""
+            o4mini_thought = ""
+
+            restored_phase15 = resume_phases.get("phase1_5")
+            if restored_phase15:
+                grok_status = restored_phase15["grok"]["status"]
+                grok_thought = restored_phase15["grok"]["thought"]
+                grok_error_msg = restored_phase15["grok"].get("error")
+                claude45_status = restored_phase15["claude"]["status"]
+                claude45_thought = restored_phase15["claude"]["thought"]
+                claude45_usage = restored_phase15["claude"].get("usage", {})
+                o4mini_status = restored_phase15["o4mini"]["status"]
+                o4mini_thought = restored_phase15["o4mini"]["thought"]
+                callbacks.status("♻️ Phase 1.5: チェックポイントから復元")
+                callbacks.phase_done("phase1_5", restored_phase15)
+            else:
+                callbacks.status("🚀 Phase 1.5: マルチモデル並列思考中...")
+                phase15_span = trace.start("phase1_5")
+
+                # プロセス共通の実行器: プロバイダごとの同時実行数上限で待ち行列に入る
+                phase_executor = get_executor()
+                futures = {
+                    phase_executor.submit(FAN_OUT_PROVIDERS["grok"], run_grok_task): "grok",
+                    phase_executor.submit(FAN_OUT_PROVIDERS["claude"], run_claude_task): "claude",
+                    phase_executor.submit(FAN_OUT_PROVIDERS["o4mini"], run_o4mini_task): "o4mini"
+                }
+
+                try:
+                    for future in as_completed(futures, timeout=FAN_OUT_TIMEOUT):
+                        name = futures[future]
+                        try:
+                            result = future.result()
+
+                            if name == "grok":
+                                grok_status = result["status"]
+                                grok_thought = result["thought"]
+                                grok_error_msg = result.get("error")
+                                if result.get("usage"):
+                                    bill("phase1_5b", SECONDARY_MODEL_ID, openai_usage(result["usage"]))
+                                if grok_status == "success":
+                                    callbacks.status(f"✓ {SECONDARY_MODEL_NAME} 完了")
+                                elif grok_status == "error":
+                                    callbacks.status(f"⚠ {SECONDARY_MODEL_NAME}: {grok_error_msg}")
+
+                            elif name == "claude":
+                                claude45_status = result["status"]
+                                claude45_thought = result["thought"]
+                                claude45_usage = result.get("usage", {})
+                                if claude45_status == "success":
+                                    callbacks.status("✓ Claude 4.5 Sonnet 完了")
+                                    # コスト計算（料金は pricing.py の料金表から）
+                                    if claude45_usage:
+                                        claude_cost = bill("phase1_5d", CLAUDE_MODEL_ID, bedrock_usage(claude45_usage))
+                                        callbacks.status(f"💰 Claude: ${claude_cost:.4f}")
+                                elif claude45_status == "error":
+                                    callbacks.status("⚠ Claude 4.5 エラー")
+
+                            elif name == "o4mini":
+                                o4mini_status = result["status"]
+                                o4mini_thought = result["thought"]
+                                if result.get("usage"):
+                                    bill("phase1_5e", GITHUB_MODEL_ID, openai_usage(result["usage"]))
+                                if o4mini_status == "success":
+                                    callbacks.status("✓ o4-mini 完了")
+                                elif o4mini_status == "skipped" and is_ms_az_mode and has_github_models():
+                                    input_len = result.get("input_len", 0)
+                                    if input_len > O4_MINI_MAX_INPUT_CHARS:
+                                        callbacks.status(f"ℹ️ o4-mini スキップ (入力長: {input_len})")
+
+                        except Exception as e:
+                            callbacks.status(f"⚠ {name} 並列処理エラー: {e}")
+                except FuturesTimeoutError:
+                    # 打ち切り、未完了のモデルは無しで Phase 2 へ進む（実行中の呼び出しはバックグラウンドで完了）
+                    for future, name in futures.items():
+                        if future.done():
+                            continue
+                        future.cancel()
+                        metrics.inc("fanout_timeouts_total", {"provider": FAN_OUT_PROVIDERS[name]})
+                        callbacks.status(f"⚠ {name}: タイムアウト ({FAN_OUT_TIMEOUT}秒)")
+                        if name == "grok":
+                            grok_status, grok_error_msg = "error", "timeout"
+                        elif name == "claude":
+                            claude45_status = "error"
+                        else:
+                            o4mini_status = "error"
+
+                trace.end(phase15_span)
+                checkpoint("phase1_5", {
+                    "grok": {"status": grok_status, "thought": grok_thought, "error": grok_error_msg},
+                    "claude": {"status": claude45_status, "thought": claude45_thought, "usage": claude45_usage},
+                    "o4mini": {"status": o4mini_status, "thought": o4mini_thought},
+                })
+
+            # 結果を表示（成功したもののみ）
+            if grok_status == "success" and grok_thought:
+                callbacks.detail(f"{SECONDARY_MODEL_NAME} の独立回答案", grok_thought)
+            if claude45_status == "success" and claude45_thought:
+                callbacks.detail("Claude 4.5 Sonnet の独立回答案", claude45_thought)
+            if o4mini_status == "success" and o4mini_thought:
+                callbacks.detail("o4-mini の独立回答案", o4mini_thought)
+            # ▲▲▲ Phase 1.5 並列処理 ここまで ▲▲▲
+
+            # --- Phase 2: 統合エージェント ---
+            callbacks.status("Phase 2: 統合フェーズ実行中...")
+
+            deep_instruction, synthesis_prompt_text = build_synthesis_request(
+                question,
+                research_text,
+                current_ir=current_ir,
+                questions_text=questions_text if enable_meta else "",
+                grok_thought=grok_thought if enable_meta else "",
+                claude45_thought=claude45_thought if claude45_status == "success" else "",
+                o4mini_thought=o4mini_thought if o4mini_status == "success" else "",
+                enable_meta=enable_meta,
+            )
+            if is_cascade:
+                # エスカレーション判定 (cascade.parse_confidence) が読む自信度行を必ず出力させる
+                deep_instruction += CASCADE_CONFIDENCE_INSTRUCTION
+
+            synthesis_contents = contents_for_model + [
+                types.Content(role="user", parts=[
+                    types.Part(text=synthesis_prompt_text)
+                ])
+            ]
+
+            synthesis_config = types.GenerateContentConfig(
+                temperature=0.4,  # Phase A: 統合時の柔軟性向上
+                candidate_count=1,
+                tools=[],  # 統合フェーズでは検索OFF
+                system_instruction=deep_instruction,
+                thinking_config=thinking_config_for(model_id),
+            )
+
+            restored_phase2 = resume_phases.get("phase2")
+            if restored_phase2:
+                draft_answer = restored_phase2["draft_answer"]
+                callbacks.status("♻️ Phase 2: チェックポイントから復元")
+                callbacks.phase_done("phase2", restored_phase2)
+            else:
+                # Phase 2 リトライ機能（クォータエラー対策）
+                max_retries = 3
+                synthesis_resp = None
+                synthesis_window = None
+                phase2_span = trace.start("phase2", model=model_id)
+
+                for attempt in range(max_retries):
+                    try:
+                        synthesis_resp = client.models.generate_content(
+                            model=model_id,
+                            contents=synthesis_contents,
+                            config=synthesis_config,
+                        )
+                        synthesis_window = last_call_window()
+                        draft_answer = extract_text_from_response(synthesis_resp)
+
+                        # ▼▼▼ finish_reason検出：途中で切れたら自動継続 ▼▼▼
+                        candidate = synthesis_resp.candidates[0] if synthesis_resp.candidates else None
+                        if candidate and hasattr(candidate, 'finish_reason'):
+                            finish_reason = str(candidate.finish_reason).upper()
+                            if "MAX_TOKENS" in finish_reason or "LENGTH" in finish_reason:
+                                callbacks.status("⚠️ 回答が途中で切れました。続きを取得中...")
+                                try:
+                                    continuation_resp = client.models.generate_content(
+                                        model=model_id,
+                                        contents=[
+                                            types.Content(role="user", parts=[
+                                                types.Part.from_text(text="先ほどの回答が途中で途切れました。続きを書いてください。要約せず、途切れた箇所から続けてください。")
+                                            ])
+                                        ],
+                                        config=synthesis_config,
+                                    )
+                                    continuation_text = extract_text_from_response(continuation_resp)
+                                    bill_response("phase2_continuation", continuation_resp)
+                                    draft_answer += "\n\n" + continuation_text
+                                    callbacks.status("✓ 統合完了（自動継続）")
+                                except Exception:
+                                    draft_answer += "\n\n*（続きの取得に失敗しました）*"
+                            else:
+                                callbacks.status("✓ 統合完了")
+                        else:
+                            callbacks.status("✓ 統合完了")
+                        # ▲▲▲ finish_reason検出 ここまで ▲▲▲
+
+                        break
+                    except Exception as e:
+                        if not _is_quota_error(e):
+                            raise
+                        phase2_span["retries"] = attempt + 1
+                        if attempt < max_retries - 1:
+                            wait_time = (attempt + 1) * 15 + 15  # 30秒, 45秒, 60秒（強化版）
+                            callbacks.status(f"⏳ クォータ制限のため {wait_time}秒待機中... (試行 {attempt + 2}/{max_retries})")
+                            time.sleep(wait_time)
+                        else:
+                            callbacks.warning("⚠️ Phase 2: クォータ制限により断念。リサーチ結果のサマリーを表示します。（後で「再開」からPhase 2をやり直せます）")
+                            phase2_quota_aborted = True
+                            # フォールバック: リサーチ結果の要約を回答として使用
+                            draft_answer = f"**⚠️ 統合フェーズがクォータ制限により中断されました**\n\n### 収集した情報（Phase 1）:\n\n{research_text[:3000]}..."
+
+                if draft_answer is None:
+                    draft_answer = f"**⚠️ Phase 2エラー**\n\n{research_text[:2000]}..."
+
+                bill_response("phase2", synthesis_resp, window=synthesis_window)
+                trace.end(phase2_span, status="quota_aborted" if phase2_quota_aborted else "ok", retries=phase2_span["retries"])
+
+                # カスケード: 自信度 Medium 以下 or 高リスクなら pro + 多モデルで Phase 1.5 以降をやり直す
+                if is_cascade and not phase2_quota_aborted:
+                    cascade_confidence = parse_confidence(draft_answer)
+                    cascade_risk = None
+                    if cascade_confidence in ("very_high", "high"):
+                        # 自信度が高いときだけリスク判定を追加で行う（ルール/キャッシュ/学習モデルで足りれば LLM は呼ばない）
+                        risk_classification = routing_classification or classify_question_fast(question)
+                        if risk_classification is None:
+                            def bill_risk(response):
+                                if response is not None and response.usage_metadata:
+                                    bill("cascade_risk", ROUTING_MODEL_ID, gemini_usage(response), window=last_call_window())
+
+                            with trace.span("cascade_risk", kind=CALL, model=ROUTING_MODEL_ID):
+                                risk_classification = analyze_question_for_routing(client, question, on_response=bill_risk)
+                        cascade_risk = risk_classification.get("risk_level")
+                    escalate, cascade_reason = should_escalate(cascade_confidence, cascade_risk)
+                    cascade_info = build_cascade_info(cascade_confidence, cascade_risk, escalate, cascade_reason)
+
+                    if escalate:
+                        callbacks.status(f"⬆️ カスケード: {cascade_reason} → {CASCADE_STRONG_MODEL} にエスカレーション")
+                        # Phase 1 / 1.3 のチェックポイントを残したまま、上位モードでの再開として実行し直す
+                        if run_id:
+                            update_run(
+                                run_id,
+                                drop_phases=["phase1_5a", "phase1_5", "phase2", "phase3"],
+                                telemetry=trace.to_dict(),
+                                response_mode=CASCADE_ESCALATION_MODE,
+                                model_id=CASCADE_STRONG_MODEL,
+                                settings={
+                                    "mode_category": mode_category,
+                                    "use_search": use_search,
+                                    "candidate_count": candidate_count,
+                                    "cascade": cascade_info,
+                                    "skip_phases": sorted(skip_phases),
+                                },
+                            )
+                        escalated = True
+                    else:
+                        callbacks.status(f"✓ カスケード: {cascade_reason}（{CASCADE_FAST_MODEL} で完了）")
+
+                if not phase2_quota_aborted and not escalated:
+                    checkpoint("phase2", {"draft_answer": draft_answer})
+
+            # --- Phase 3: レビューエージェント (鬼軍曹モードのみ) ---
+            if escalated:
+                final_answer = draft_answer
+            elif enable_strict:
+                # 初版を先に表示（レビュー中）
+                callbacks.draft(
+                    draft_answer,
+                    "🪖 レビュー中の暫定回答（Phase 2 初版）です。鬼軍曹レビューが終わるとこの場所で更新されます。",
+                )
+                callbacks.phase("Phase 3: レビュー中（初版を表示中）...")
+                callbacks.status("Phase 3: レビューフェーズ実行中...")
+
+                reviewer_instruction, review_prompt_text = build_review_request(question, research_text, draft_answer)
+                review_contents = [
+                    types.Content(role="user", parts=[types.Part.from_text(text=review_prompt_text)])
+                ]
+
+                review_config = types.GenerateContentConfig(
+                    temperature=0.1,
+                    candidate_count=1,
+                    system_instruction=reviewer_instruction,
+                    thinking_config=thinking_config_for(model_id),
+                )
+
+                restored_phase3 = resume_phases.get("phase3")
+                if restored_phase3:
+                    final_answer = restored_phase3["final_answer"]
+                    callbacks.status("♻️ Phase 3: チェックポイントから復元")
+                    callbacks.phase_done("phase3", restored_phase3)
+                else:
+                    # Phase 3 リトライ機能（クォータエラー対策）
+                    max_retries = 3
+                    review_resp = None
+                    review_quota_aborted = False
+                    phase3_span = trace.start("phase3", model=model_id)
+
+                    # 差分レビュー: 編集操作だけを受け取りローカルで初版に適用
+                    patched = False
+                    if review_patch_mode:
+                        try:
+                            patch_instruction, patch_prompt_text = build_review_request(question, research_text, draft_answer, patch_mode=True)
+                            patch_resp = client.models.generate_content(
+                                model=model_id,
+                                contents=[types.Content(role="user", parts=[types.Part.from_text(text=patch_prompt_text)])],
+                                config=types.GenerateContentConfig(
+                                    temperature=0.1,
+                                    candidate_count=1,
+                                    system_instruction=patch_instruction,
+                                    response_mime_type="application/json",
+                                    thinking_config=thinking_config_for(model_id),
+                                ),
+                            )
+                            bill_response("phase3_patch", patch_resp)
+
+                            review_edits = parse_review_edits(extract_text_from_response(patch_resp))
+                            if review_edits is None:
+                                patch_result = {"applied": False, "applied_count": 0, "failed": [], "reason": "JSON解析失敗"}
+                            else:
+                                patch_result = apply_review_edits(draft_answer, review_edits)
+                            review_patch_info = {
+                                "applied": patch_result["applied"],
+                                "applied_count": patch_result["applied_count"],
+                                "failed_count": len(patch_result["failed"]),
+                                "reason": patch_result["reason"],
+                            }
+                            if patch_result["applied"]:
+                                final_answer = patch_result["text"]
+                                patched = True
+                                callbacks.status(f"✓ 差分レビュー完了（編集 {patch_result['applied_count']} 件を適用）")
+                            else:
+                                failed_note = f"、未適用の編集 {len(patch_result['failed'])} 件" if patch_result["failed"] else ""
+                                callbacks.status(f"↩️ 差分を適用できないため全文レビューに切り替えます（{patch_result['reason']}{failed_note}）")
+                        except Exception as e:
+                            review_patch_info = {"applied": False, "applied_count": 0, "failed_count": 0, "reason": str(e)[:200]}
+                            callbacks.status(f"↩️ 差分レビューに失敗したため全文レビューに切り替えます（{str(e)[:100]}）")
+
+                    if not patched:
+                        for attempt in range(max_retries):
+                            try:
+                                review_resp = client.models.generate_content(
+                                    model=model_id,
+                                    contents=review_contents,
+                                    config=review_config,
+                                )
+                                final_answer = extract_text_from_response(review_resp)
+                                callbacks.status("✓ レビュー完了")
+                                break
+                            except Exception as e:
+                                if not _is_quota_error(e):
+                                    raise
+                                phase3_span["retries"] = attempt + 1
+                                if attempt < max_retries - 1:
+                                    wait_time = (attempt + 1) * 15 + 5  # 20秒, 35秒, 50秒（強化版）
+                                    callbacks.status(f"⏳ クォータ制限のため {wait_time}秒待機中... (試行 {attempt + 2}/{max_retries})")
+                                    time.sleep(wait_time)
+                                else:
+                                    callbacks.warning("⚠️ Phase 3: クォータ制限により断念。Phase 2の結果を使用します。")
+                                    final_answer = draft_answer  # Phase 2の結果を使用
+                                    review_quota_aborted = True
+
+                    bill_response("phase3", review_resp)
+                    trace.end(
+                        phase3_span,
+                        status="quota_aborted" if review_quota_aborted else "ok",
+                        retries=phase3_span["retries"],
+                    )
+
+                    if not review_quota_aborted:
+                        checkpoint("phase3", {"final_answer": final_answer})
+
+                # --- Phase 3b: Grok鬼軍曹レビュー (多層モード + 鬼軍曹モード全般) ---
+                # 多層モードで、かつ鬼軍曹系のモード（鬼軍曹、メタ思考、本気MAX）で発動
+                use_grok_reviewer = (mode_category == MULTILAYER_CATEGORY and (enable_strict or "鬼軍曹" in response_mode)) and "phase3b" not in skip_phases
+                if use_grok_reviewer and has_openrouter():
+                    callbacks.draft(
+                        final_answer,
+                        f"✅ 鬼軍曹レビュー済み。{SECONDARY_MODEL_NAME} による最終レビューを実行中です...",
+                    )
+                    callbacks.phase(f"Phase 3b: {SECONDARY_MODEL_NAME} 最終レビュー中...")
+                    callbacks.status(f"{SECONDARY_MODEL_NAME}による最終レビュー実行中...")
+
+                    review_mode = "normal"
+                    if "鬼軍曹" in response_mode:
+                        review_mode = "onigunsou"
+                    elif "MAX" in response_mode:
+                        review_mode = "full_max"
+
+                    with trace.span("phase3b", model=SECONDARY_MODEL_ID) as phase3b_span:
+                        grok_answer, grok_review_usage = get_executor().run(OPENROUTER, review_with_grok, question, final_answer, research_text, mode=review_mode)
+                        grok_answer = grok_answer.strip()
+                        if grok_review_usage:
+                            bill("phase3b", SECONDARY_MODEL_ID, openai_usage(grok_review_usage))
+                        if grok_answer.startswith("Error calling"):
+                            phase3b_span["status"] = "error"
+
+                    # エラーチェック：Grokがエラー文字列を返した場合
+                    if grok_answer.startswith("Error calling"):
+                        grok_review_status = "error"
+                        callbacks.error(f"⚠️ {SECONDARY_MODEL_NAME} 最終レビュー エラー\n\n{grok_answer}")
+                        # final_answerはGemini鬼軍曹版のまま使用
+                    else:
+                        grok_review_status = "success"
+                        # レビューコメント（書き直しではない）なので回答末尾に添える
+                        final_answer += f"\n\n---\n\n## 🔍 {SECONDARY_MODEL_NAME} 最終レビュー\n\n{grok_answer}"
+            else:
+                final_answer = draft_answer
+
+        # 多層モード: 使用モデルを表示
+        if mode_category == MULTILAYER_CATEGORY and not escalated:
+            final_answer = (
+                f"**🤖 使用モデル: {model_id} (Deep Thinking / High Reasoning)**\n"
+                f"**モード: {response_mode}**\n\n---\n\n{final_answer}"
+            )
+
+            # --- メタ思考モード: 結論を先出しする ---
+            if "メタ思考" in response_mode:
+                final_answer = _put_conclusion_first(final_answer)
+
+            if draft_answer is not None:
+                callbacks.detail(
+                    "初版との比較",
+                    "**初版:**\n\n"
+                    + (draft_answer[:500] + "..." if len(draft_answer) > 500 else draft_answer)
+                    + "\n\n**修正版:**\n\n"
+                    + (final_answer[:500] + "..." if len(final_answer) > 500 else final_answer),
+                )
+    finally:
+        reset_priority(priority)
+
+    # Phase 1.5 のタイムアウトで打ち切ったモデルは未完了のまま記録する
+    trace.close_open()
+
+    # Deep Log: 推論プロセスを保存（確実性向上）
+    reasoning_logs = {
+        "phase1_research": research_text,
+        "phase1_3_ir": current_ir,
+        "followup": followup_info,
+        "phase1_5_meta_questions": questions_text,
+        "phase1_5b_secondary": grok_thought,
+        "phase1_5d_claude": claude45_thought,
+        "phase1_5e_o4mini": o4mini_thought,
+        "phase2_draft": draft_answer,
+        "phase3_patch": review_patch_info,
+        "cascade": cascade_info,
+        "routing_classification": routing_classification,
+        "question_classification": routing_classification or question_classification,
+        "routing_pipeline": routed_pipeline,
+        "skipped_phases": sorted(skip_phases),
+        "telemetry": trace.to_dict(),
+    }
+
+    return {
+        "final_answer": final_answer,
+        "draft_answer": draft_answer,
+        "model_id": model_id,
+        "mode": response_mode,
+        "enable_research": enable_research,
+        "enable_meta": enable_meta,
+        "enable_strict": enable_strict,
+        "routing_classification": routing_classification,
+        "routed_pipeline": routed_pipeline,
+        "cascade_info": cascade_info,
+        "escalated": escalated,
+        "phase2_quota_aborted": phase2_quota_aborted,
+        "grok_status": grok_status,
+        "grok_error_msg": grok_error_msg,
+        "claude45_status": claude45_status,
+        "claude45_usage": claude45_usage,
+        "o4mini_status": o4mini_status,
+        "use_grok_reviewer": use_grok_reviewer,
+        "grok_review_status": grok_review_status,
+        "grounding_sources": grounding_sources_detail,
+        "skipped_phases": sorted(skip_phases),
+        "reasoning_logs": reasoning_logs,
+        "usage": usage_log,
+        "cost": sum(entry["cost"] for entry in usage_log),
+    }
+
+
+
+# Cascade escalations handled by run_pipeline_from_checkpoint() before giving up
+MAX_ESCALATIONS = 2
+
+
+def run_pipeline_from_checkpoint(
+    question: str,
+    mode: str,
+    run_id: str,
+    history: Optional[List[Dict[str, Any]]] = None,
+    attachments: Optional[List[Dict[str, Any]]] = None,
+    callbacks: Optional[PipelineCallbacks] = None,
+    **kwargs
+) -> Dict[str, Any]:
+    """
+    Run (or continue) a checkpointed run without a UI in the loop.
+
+    Completed phases are restored from the checkpoint, and a cascade escalation
+    is re-run immediately with the upgraded mode / model stored in the
+    checkpoint instead of being returned to the caller.
+
+    Args:
+        question / mode / history / attachments / callbacks: As run_pipeline()
+        run_id: Checkpoint run id (start_run() must already have been called)
+        **kwargs: Other run_pipeline() keyword arguments (client, model_id, use_search, ...)
+
+    Returns:
+        run_pipeline() result; usage / cost include runs before an escalation
+    """
+    usage_log: List[Dict[str, Any]] = []
+    for _ in range(MAX_ESCALATIONS + 1):
+        checkpoint = load_checkpoint(run_id) or {}
+        settings = checkpoint.get("settings", {})
+        if checkpoint:
+            mode = checkpoint.get("response_mode", mode)
+            kwargs["model_id"] = checkpoint.get("model_id", kwargs.get("model_id", DEFAULT_MODEL_ID))
+            kwargs["mode_category"] = settings.get("mode_category", kwargs.get("mode_category", MULTILAYER_CATEGORY))
+            kwargs["skip_phases"] = settings.get("skip_phases", kwargs.get("skip_phases"))
+        result = run_pipeline(
+            question,
+            mode,
+            history=history,
+            attachments=attachments,
+            callbacks=callbacks,
+            run_id=run_id,
+            resume_phases=checkpoint.get("phases", {}),
+            cascade_info=settings.get("cascade"),
+            trace=Trace.from_dict(checkpoint.get("telemetry")),
+            **kwargs,
+        )
+        usage_log.extend(result["usage"])
+        if not result["escalated"]:
+            result["usage"] = usage_log
+            result["cost"] = sum(record["cost"] for record in usage_log)
+            return result
+        if callbacks:
+            callbacks.status(f"⬆️ カスケード: {(result['cascade_info'] or {}).get('reason', '')} のため上位モードで再実行します")
+    raise RuntimeError("カスケードのエスカレーションが上限に達しました")
+
+
+def with_processing_history(result: Dict[str, Any], answer: str) -> str:
+    """
+    Prefix an answer with the "📊 処理履歴" block (phases run and per-model status).
+
+    Args:
+        result: run_pipeline() result
+        answer: Final answer text (may include app-side additions such as suggestions)
+
+    Returns:
+        Answer text as stored in the session
+    """
+    routed_pipeline = result["routed_pipeline"]
+    grok_status = result["grok_status"]
+    claude45_status = result["claude45_status"]
+    o4mini_status = result["o4mini_status"]
+    grok_review_status = result["grok_review_status"]
+
+    processing_history = []
+    if routed_pipeline:
+        processing_history.append(f"**ルーティング**: {routed_pipeline['routing_reason']}")
+    if result.get("skipped_phases"):
+        processing_history.append(f"**予算調整**: {', '.join(result['skipped_phases'])} を省略（見込みコストが上限を超えるため）")
+    if result["enable_research"]:
+        processing_history.append("**Phase 1**: Gemini リサーチ (Google検索)")
+    else:
+        processing_history.append("**軽量**: Gemini 単発回答（リサーチなし）")
+
+    if result["enable_meta"]:
+        processing_history.append("**Phase 1.5a**: Gemini メタ質問生成")
+    # Grok/セカンダリモデル status
+    if grok_status == "success":
+        processing_history.append(f"**Phase 1.5b**: OpenRouterセカンダリモデル ({SECONDARY_MODEL_NAME}) 独立思考 ✓")
+    elif grok_status == "error":
+        msg = result["grok_error_msg"] or "エラー"
+        processing_history.append(f"**Phase 1.5b**: OpenRouterセカンダリモデル ({SECONDARY_MODEL_NAME}) 独立思考 ⚠️ {msg}")
+    elif grok_status == "empty":
+        processing_history.append(f"**Phase 1.5b**: OpenRouterセカンダリモデル ({SECONDARY_MODEL_NAME}) 独立思考（出力なし）")
+
+    if claude45_status == "success":
+        processing_history.append("**Phase 1.5d**: Claude 4.5 Sonnet 独立思考 (AWS Bedrock) ✓")
+    elif claude45_status == "error":
+        processing_history.append("**Phase 1.5d**: Claude 4.5 Sonnet 独立思考 ⚠️ エラー")
+
+    if o4mini_status == "success":
+        processing_history.append("**Phase 1.5e**: o4-mini 独立思考 (GitHub Models) ✓")
+    elif o4mini_status == "error":
+        processing_history.append("**Phase 1.5e**: o4-mini 独立思考 ⚠️ エラー")
+
+    if result["enable_research"]:
+        processing_history.append("**Phase 2**: Gemini 統合フェーズ")
+
+    if result["enable_strict"]:
+        processing_history.append("**Phase 3**: Gemini 鬼軍曹レビュー")
+        if result["use_grok_reviewer"]:
+            if grok_review_status == "success":
+                processing_history.append(f"**Phase 3b**: {SECONDARY_MODEL_NAME} 最終レビュー ✓")
+            elif grok_review_status == "error":
+                processing_history.append(f"**Phase 3b**: {SECONDARY_MODEL_NAME} 最終レビュー ⚠️ エラー")
+
+    return (
+        "## 📊 処理履歴\n\n"
+        + "\n".join([f"- {item}" for item in processing_history])
+        + "\n\n---\n\n"
+        + answer
+    )
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    class _PrintCallbacks(PipelineCallbacks):
+        def status(self, text):
+            print(f"  {text}")
+
+        def warning(self, text):
+            print(f"  ⚠️ {text}")
+
+        def error(self, text):
+            print(f"  ❌ {text}")
+
+    parser = argparse.ArgumentParser(description="Run the research pipeline for one question (no Streamlit)")
+    parser.add_argument("question", help="User question")
+    parser.add_argument("--mode", default="熟考 (本気MAX)ms/Az", help="Response mode label as shown in the UI")
+    parser.add_argument("--model", default=DEFAULT_MODEL_ID, help="Gemini model ID")
+    parser.add_argument("--no-search", action="store_true", help="Disable Google Search grounding")
+    parser.add_argument("--json", action="store_true", help="Print the full result as JSON")
+    parser.add_argument("--resume", metavar="RUN_ID", help="Resume a checkpointed run (its id is printed when a run stops)")
+    args = parser.parse_args()
+
+    from checkpoints import new_run_id, start_run, finish_run, mark_failed
+
+    # Checkpointed like batch.py, so a cascade escalation is re-run on the strong model
+    run_id = args.resume or new_run_id()
+    if not args.resume:
+        start_run(run_id, "cli", args.question, args.mode, args.model, settings={
+            "mode_category": MULTILAYER_CATEGORY,
+            "use_search": not args.no_search,
+            "candidate_count": 1,
+        })
+    try:
+        result = run_pipeline_from_checkpoint(
+            args.question,
+            args.mode,
+            run_id,
+            callbacks=_PrintCallbacks(),
+            model_id=args.model,
+            use_search=not args.no_search,
+            session_id="cli",
+        )
+    except Exception as e:
+        mark_failed(run_id, str(e))
+        print(f"  ❌ {e}\n  ▶️ 再開: --resume {run_id}")
+        raise SystemExit(1)
+    if result["phase2_quota_aborted"]:
+        # Draft-only answer: keep the checkpoint so a resume re-runs Phase 2
+        mark_failed(run_id, "Phase 2: quota exhausted")
+        print(f"  ⚠️ Phase 2 がクォータ制限で中断したため初版のみです（再開: --resume {run_id}）")
+    else:
+        finish_run(run_id)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+    else:
+        print(result["final_answer"])
+        print(f"\n💰 ${result['cost']:.4f}")
@@ -0,0 +1,722 @@
+#!/usr/bin/env python3
+"""
+Phase U: Pipeline Benchmark - Local Stand-in Providers
+Runs the real run_pipeline() end to end against local stand-ins for every
+provider it calls, so an orchestration change (scheduler, executor, quota
+ledger, phase ordering) can be measured without spending money:
+
+- Vertex generate_content: text / JSON answers with usage_metadata (thinking
+  and cached tokens), grounding metadata for search calls, MAX_TOKENS
+  truncation and 429 RESOURCE_EXHAUSTED errors
+- OpenRouter / GitHub Models chat completions (requests.post): usage with
+  reasoning tokens and OpenRouter's reported cost, HTTP 429 / 500 and timeouts
+- Bedrock converse (boto3): reasoningContent blocks and cache token usage
+
+Each provider has a latency distribution (log-normal around a median), error
+and quota-error rates and token ranges (DEFAULT_PROFILES, overridable with a
+JSON file). Latencies are multiplied by --time-scale so a 本気MAX run takes
+seconds; the orchestration overhead itself is not scaled.
+
+Per response mode the report gives end-to-end and per-phase latency (from the
+telemetry spans), achieved provider concurrency, thread count, CPU utilization
+and peak Python memory (tracemalloc). Usage is recorded in a temporary ledger
+and checkpoints in a temporary directory, so the real budget is untouched.
+
+⚠️ Like logic.py, this module must not import streamlit.
+
+Usage:
+    python pipeline_benchmark.py [--modes "熟考 (本気MAX)ms/Az" "β1高速 (通常)"] [--runs 5] [--concurrency 2]
+                                 [--time-scale 0.05] [--profile profiles.json] [--json report.json]
+"""
+
+import argparse
+import json
+import math
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Tuple
+
+import requests
+from google.genai import errors as genai_errors
+from google.genai import types
+
+import providers
+from cassette import isolated_pipeline_state, model_host_provider
+from checkpoints import start_run
+from pipeline import DEFAULT_MODEL_ID, MULTILAYER_CATEGORY, run_pipeline_from_checkpoint
+from pricing import VERTEX, BEDROCK, OPENROUTER, GITHUB_MODELS
+from quota import DEFAULT_OUTPUT_ESTIMATE, QuotaLedger, QuotaLimitedClient, estimate_tokens
+from telemetry import phase_totals
+
+
+DEFAULT_MODES = [
+    "β1高速 (通常)",
+    "熟考 + 鬼軍曹",
+    "熟考 (本気MAX)ms/Az",
+    "⚡ カスケード (flash→pro)",
+    "🤖 オート (自動ルーティング)",
+]
+
+DEFAULT_QUESTIONS = [
+    "2025年の金利見通しと住宅ローンへの影響は？",
+    "Python の asyncio とスレッドの使い分けを教えて",
+    "中小企業が生成AIを導入する際のリスクと進め方は？",
+    "新しい降圧薬に切り替えるときに注意すべき点は？",
+]
+
+# Latencies are seconds before --time-scale; token ranges are (min, max) per call.
+# latency_sigma: log-normal spread; error_rate / quota_rate: share of failed / 429 calls.
+DEFAULT_PROFILES = {
+    VERTEX: {
+        "latency_median": 6.0, "latency_sigma": 0.5,
+        # A Vertex 429 pauses the model in the quota ledger for DEFAULT_EXHAUSTED_BACKOFF (not time-scaled)
+        "error_rate": 0.0, "quota_rate": 0.0,
+        "output_tokens": (600, 2500), "thinking_tokens": (200, 1500), "cached_ratio": 0.0,
+        # Answers reporting 自信度 Medium (cascade escalations) / finish_reason MAX_TOKENS (Phase 2 continuation)
+        "low_confidence_rate": 0.2, "truncation_rate": 0.0,
+        "grounding_chunks": 4,
+        # Per-model overrides
+        "models": {
+            "gemini-2.5-flash": {"latency_median": 2.0, "thinking_tokens": (0, 400)},
+            "gemini-2.0-flash-exp": {"latency_median": 0.8, "output_tokens": (60, 120), "thinking_tokens": (0, 0)},
+        },
+    },
+    OPENROUTER: {
+        "latency_median": 5.0, "latency_sigma": 0.6,
+        "error_rate": 0.02, "quota_rate": 0.03,
+        "output_tokens": (400, 1200), "thinking_tokens": (0, 0),
+    },
+    BEDROCK: {
+        "latency_median": 15.0, "latency_sigma": 0.4,
+        "error_rate": 0.01, "quota_rate": 0.01,
+        "output_tokens": (800, 2000), "thinking_tokens": (1000, 3000), "cached_ratio": 0.0,
+    },
+    GITHUB_MODELS: {
+        "latency_median": 8.0, "latency_sigma": 0.5,
+        "error_rate": 0.02, "quota_rate": 0.05,
+        "output_tokens": (400, 1500), "thinking_tokens": (500, 2000),
+    },
+}
+
+DEFAULT_TIME_SCALE = 0.05
+
+# Thread-count sampling interval (seconds)
+SAMPLE_INTERVAL = 0.05
+
+
+def merge_profiles(overrides: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Any]]:
+    """DEFAULT_PROFILES with per-provider overrides (Vertex "models" entries are merged per model)."""
+    profiles = {provider: {**profile, "models": dict(profile.get("models", {}))} for provider, profile in DEFAULT_PROFILES.items()}
+    for provider, override in (overrides or {}).items():
+        if provider not in profiles:
+            raise ValueError(f"Unknown provider in profile: {provider} (expected one of {', '.join(profiles)})")
+        override = dict(override)
+        for model, model_override in override.pop("models", {}).items():
+            profiles[provider]["models"][model] = {**profiles[provider]["models"].get(model, {}), **model_override}
+        profiles[provider].update(override)
+    return profiles
+
+
+class StandInStats:
+    """Calls, failures and in-flight concurrency per provider (reset per benchmarked mode)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._providers: Dict[str, Dict[str, Any]] = {}
+
+    def _entry(self, provider: str) -> Dict[str, Any]:
+        return self._providers.setdefault(provider, {"calls": 0, "errors": 0, "busy_seconds": 0.0, "in_flight": 0, "peak_in_flight": 0})
+
+    def begin(self, provider: str) -> None:
+        with self._lock:
+            entry = self._entry(provider)
+            entry["calls"] += 1
+            entry["in_flight"] += 1
+            entry["peak_in_flight"] = max(entry["peak_in_flight"], entry["in_flight"])
+
+    def finish(self, provider: str, seconds: float, outcome: str) -> None:
+        with self._lock:
+            entry = self._entry(provider)
+            entry["in_flight"] -= 1
+            entry["busy_seconds"] += seconds
+            if outcome != "ok":
+                entry["errors"] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {provider: dict(entry) for provider, entry in self._providers.items()}
+
+
+class _StandIn:
+    """Shared sampling for the provider stand-ins."""
+
+    def __init__(self, provider: str, profile: Dict[str, Any], stats: StandInStats, rng: random.Random, rng_lock: threading.Lock, time_scale: float):
+        self.provider = provider
+        self.profile = profile
+        self.stats = stats
+        self._rng = rng
+        self._rng_lock = rng_lock
+        self.time_scale = time_scale
+
+    def profile_for(self, model: Optional[str] = None) -> Dict[str, Any]:
+        return {**self.profile, **self.profile.get("models", {}).get(model, {})}
+
+    def random(self) -> float:
+        with self._rng_lock:
+            return self._rng.random()
+
+    def tokens(self, bounds: Tuple[int, int]) -> int:
+        with self._rng_lock:
+            return self._rng.randint(int(bounds[0]), int(bounds[1]))
+
+    def choice(self, options: List[Any]) -> Any:
+        with self._rng_lock:
+            return self._rng.choice(options)
+
+    def simulate(self, profile: Dict[str, Any], timeout: Optional[float] = None) -> str:
+        """
+        Sleep for one sampled call and decide its outcome.
+
+        Returns:
+            "ok" | "error" | "quota" | "timeout" (the call took longer than timeout)
+        """
+        with self._rng_lock:
+            latency = self._rng.lognormvariate(math.log(profile["latency_median"]), profile["latency_sigma"]) * self.time_scale
+            draw = self._rng.random()
+        if draw < profile["quota_rate"]:
+            outcome = "quota"
+            # Rejections come back quickly
+            latency *= 0.1
+        elif draw < profile["quota_rate"] + profile["error_rate"]:
+            outcome = "error"
+        else:
+            outcome = "ok"
+        if timeout is not None and latency > timeout:
+            latency, outcome = timeout, "timeout"
+
+        self.stats.begin(self.provider)
+        try:
+            time.sleep(latency)
+        finally:
+            self.stats.finish(self.provider, latency, outcome)
+        return outcome
+
+
+def _filler_text(label: str, tokens: int) -> str:
+    """Answer body of roughly `tokens` characters (Japanese is close to one token per character)."""
+    lines = [f"## {label}（ベンチマーク用スタンドイン応答）"]
+    length = len(lines[0])
+    index = 1
+    while length < tokens:
+        line = f"- 検討ポイント {index}: 前提・根拠・リスクを整理した結果をここに記載します。"
+        lines.append(line)
+        length += len(line)
+        index += 1
+    return "\n".join(lines)
+
+
+class StandInVertexClient(_StandIn):
+    """genai.Client stand-in: client.models.generate_content(model=, contents=, config=)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(VERTEX, *args, **kwargs)
+        self.models = self
+
+    def generate_content(self, *, model: str, contents, config=None, **kwargs):
+        profile = self.profile_for(model)
+        outcome = self.simulate(profile)
+        if outcome == "quota":
+            raise genai_errors.ClientError(429, {"error": {"code": 429, "message": "Resource exhausted (stand-in)", "status": "RESOURCE_EXHAUSTED"}})
+        if outcome == "error":
+            raise genai_errors.ServerError(503, {"error": {"code": 503, "message": "Service unavailable (stand-in)", "status": "UNAVAILABLE"}})
+
+        output_tokens = self.tokens(profile["output_tokens"])
+        prompt_text = json.dumps(contents, ensure_ascii=False, default=str)
+        system_instruction = str(getattr(config, "system_instruction", "") or "")
+        if getattr(config, "response_mime_type", None) == "application/json":
+            text = self._json_answer(prompt_text, system_instruction)
+            output_tokens = len(text) // 2
+        else:
+            text = _filler_text(model, output_tokens)
+            # Like the real models, only report a confidence line when the instruction asks for one
+            if "自信度" in system_instruction or "自信度" in prompt_text:
+                confidence = "Medium" if self.random() < profile["low_confidence_rate"] else "High"
+                text += f"\n\n自信度: {confidence}"
+        truncated = self.random() < profile["truncation_rate"]
+
+        input_tokens = max(1, estimate_tokens(contents) - DEFAULT_OUTPUT_ESTIMATE)
+        thinking_tokens = self.tokens(profile["thinking_tokens"])
+        cached_tokens = int(input_tokens * profile["cached_ratio"])
+        grounded = bool(getattr(config, "tools", None))
+        candidate = types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text=text)]),
+            finish_reason=types.FinishReason.MAX_TOKENS if truncated else types.FinishReason.STOP,
+            grounding_metadata=self._grounding(profile["grounding_chunks"]) if grounded else None,
+        )
+        return types.GenerateContentResponse(
+            candidates=[candidate],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=input_tokens,
+                candidates_token_count=output_tokens,
+                thoughts_token_count=thinking_tokens,
+                cached_content_token_count=cached_tokens,
+                total_token_count=input_tokens + output_tokens + thinking_tokens,
+            ),
+        )
+
+    def _json_answer(self, prompt_text: str, system_instruction: str) -> str:
+        """Phase 3 edit operations, routing classification or JSON IR, depending on the request."""
+        if '"edits"' in system_instruction:
+            return json.dumps({
+                "edits": [{"op": "append_section", "heading": "🔴 最強の反論", "text": "前提が変わった場合の反論をここに記載します。"}],
+                "confidence": "High (70-90%)",
+            }, ensure_ascii=False)
+        if "needs_research" in prompt_text:
+            return json.dumps({
+                "domain": self.choice(["general", "finance", "coding", "medical", "planning"]),
+                "complexity": self.choice(["low", "medium", "high"]),
+                "risk_level": self.choice(["low", "medium", "high"]),
+                "needs_research": self.random() < 0.7,
+                "needs_cross_check": self.random() < 0.3,
+                "needs_x_search": False,
+                "notes": "stand-in classification",
+            }, ensure_ascii=False)
+        return json.dumps({
+            "facts": [
+                {"statement": f"事実 {i + 1}", "source": "web", "source_detail": f"https://example.com/source/{i + 1}", "confidence": "high"}
+                for i in range(3)
+            ],
+            "options": [{"name": "選択肢 A", "pros": ["利点"], "cons": ["欠点"]}],
+            "risks": [{"description": "リスク 1", "severity": "medium"}],
+            "unknowns": ["不明点 1"],
+            "metadata": {},
+        }, ensure_ascii=False)
+
+    @staticmethod
+    def _grounding(chunks: int) -> types.GroundingMetadata:
+        return types.GroundingMetadata(
+            grounding_chunks=[
+                types.GroundingChunk(web=types.GroundingChunkWeb(uri=f"https://example.com/source/{i + 1}", title=f"情報源 {i + 1}"))
+                for i in range(chunks)
+            ],
+            web_search_queries=["stand-in search query"],
+        )
+
+
+class _StandInHTTPResponse:
+    """The parts of requests.Response the providers use."""
+
+    def __init__(self, status_code: int, payload: Dict[str, Any]):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload, ensure_ascii=False)
+
+    def json(self) -> Dict[str, Any]:
+        return self._payload
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error (stand-in)", response=self)
+
+
+class StandInChatCompletions:
+    """requests.post stand-in for the OpenAI-compatible endpoints (OpenRouter, GitHub Models)."""
+
+    def __init__(self, stand_ins: Dict[str, _StandIn]):
+        self.stand_ins = stand_ins
+
+    def post(self, url: str, headers=None, json=None, timeout=None, **kwargs):
+        provider = model_host_provider(url)
+        if provider is None:
+            raise RuntimeError(f"Benchmark stand-ins do not serve {url}")
+        stand_in = self.stand_ins[provider]
+        body = json or {}
+        model = body.get("model", "")
+        profile = stand_in.profile_for(model)
+
+        outcome = stand_in.simulate(profile, timeout=timeout * stand_in.time_scale if timeout else None)
+        if outcome == "timeout":
+            raise requests.Timeout(f"Read timed out (stand-in, timeout={timeout})")
+        if outcome == "quota":
+            return _StandInHTTPResponse(429, {"error": {"code": 429, "message": "Rate limit exceeded (stand-in)"}})
+        if outcome == "error":
+            return _StandInHTTPResponse(500, {"error": {"code": 500, "message": "Internal error (stand-in)"}})
+
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+        output_tokens = stand_in.tokens(profile["output_tokens"])
+        reasoning_tokens = stand_in.tokens(profile["thinking_tokens"])
+        usage = {
+            "prompt_tokens": max(1, prompt_chars // 2),
+            "completion_tokens": output_tokens + reasoning_tokens,
+            "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+        }
+        if provider == OPENROUTER and model.endswith(":free"):
+            usage["cost"] = 0.0
+        return _StandInHTTPResponse(200, {
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": _filler_text(model, output_tokens)}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+
+class StandInBedrock(_StandIn):
+    """boto3 stand-in: boto3.client("bedrock-runtime", ...).converse(...)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(BEDROCK, *args, **kwargs)
+
+    def client(self, service_name: str = "bedrock-runtime", **kwargs) -> "StandInBedrock":
+        return self
+
+    def converse(self, modelId: str, messages: List[Dict[str, Any]], inferenceConfig=None, additionalModelRequestFields=None, **kwargs):
+        profile = self.profile_for(modelId)
+        outcome = self.simulate(profile)
+        if outcome == "quota":
+            raise RuntimeError("An error occurred (ThrottlingException) when calling the Converse operation: Too many requests (stand-in)")
+        if outcome == "error":
+            raise RuntimeError("An error occurred (InternalServerException) when calling the Converse operation (stand-in)")
+
+        prompt_chars = sum(len(part.get("text", "")) for message in messages for part in message.get("content", []))
+        input_tokens = max(1, prompt_chars // 2)
+        cached_tokens = int(input_tokens * profile["cached_ratio"])
+        output_tokens = self.tokens(profile["output_tokens"])
+        content = []
+        thinking_tokens = 0
+        if (additionalModelRequestFields or {}).get("thinking", {}).get("type") == "enabled":
+            thinking_tokens = self.tokens(profile["thinking_tokens"])
+            content.append({"reasoningContent": {"reasoningText": {"text": _filler_text("thinking", min(thinking_tokens, 500))}}})
+        content.append({"text": _filler_text(modelId, output_tokens)})
+        return {
+            "output": {"message": {"role": "assistant", "content": content}},
+            "stopReason": "end_turn",
+            # Bedrock counts thinking as output; cache reads are not part of inputTokens
+            "usage": {
+                "inputTokens": input_tokens - cached_tokens,
+                "outputTokens": output_tokens + thinking_tokens,
+                "cacheReadInputTokens": cached_tokens,
+                "cacheWriteInputTokens": 0,
+            },
+        }
+
+
+@contextmanager
+def stand_in_providers(
+    profiles: Optional[Dict[str, Dict[str, Any]]] = None,
+    time_scale: float = DEFAULT_TIME_SCALE,
+    seed: Optional[int] = None,
+    real_quotas: bool = False
+):
+    """
+    Route every provider call of the pipeline to local stand-ins for the duration of the block.
+
+    Patches requests.post (OpenRouter / GitHub Models) and providers.boto3
+    (Bedrock) inside isolated_pipeline_state() (placeholder credentials so
+    every fan-out runs, temporary usage ledger and checkpoints). The Vertex
+    stand-in goes through QuotaLimitedClient (with a fresh ledger) so the
+    scheduler and quota reservations are part of the measurement.
+
+    Args:
+        profiles: Provider profiles (merge_profiles() output; default DEFAULT_PROFILES)
+        time_scale: Multiplier for every sampled latency
+        seed: Seed for latencies, outcomes and token counts
+        real_quotas: Keep quota.MODEL_QUOTAS (otherwise lifted for the block)
+
+    Yields:
+        {"client": Gemini client for run_pipeline, "stats": StandInStats}
+    """
+    profiles = profiles or merge_profiles()
+    stats = StandInStats()
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    stand_ins = {
+        VERTEX: StandInVertexClient(profiles[VERTEX], stats, rng, rng_lock, time_scale),
+        BEDROCK: StandInBedrock(profiles[BEDROCK], stats, rng, rng_lock, time_scale),
+        OPENROUTER: _StandIn(OPENROUTER, profiles[OPENROUTER], stats, rng, rng_lock, time_scale),
+        GITHUB_MODELS: _StandIn(GITHUB_MODELS, profiles[GITHUB_MODELS], stats, rng, rng_lock, time_scale),
+    }
+
+    saved_boto3 = (getattr(providers, "boto3", None), providers.HAS_BOTO3)
+    saved_post = requests.post
+
+    with isolated_pipeline_state(real_quotas=real_quotas):
+        try:
+            providers.boto3, providers.HAS_BOTO3 = stand_ins[BEDROCK], True
+            requests.post = StandInChatCompletions(stand_ins).post
+            yield {"client": QuotaLimitedClient(stand_ins[VERTEX], QuotaLedger()), "stats": stats}
+        finally:
+            requests.post = saved_post
+            providers.boto3, providers.HAS_BOTO3 = saved_boto3
+
+
+class _ThreadSampler:
+    """Samples threading.active_count() in the background."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="benchmark-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            # Exclude the sampler itself
+            self.samples.append(threading.active_count() - 1)
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "_ThreadSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile (q in 0-100)."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def _summary(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "mean": round(statistics.mean(values), 3),
+        "p50": round(_percentile(values, 50), 3),
+        "p95": round(_percentile(values, 95), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def _run_once(client, mode: str, question: str) -> Dict[str, Any]:
+    started = time.perf_counter()
+    run_id = f"bench-{uuid.uuid4().hex[:12]}"
+    # Cascade escalations are re-run from the checkpoint's upgraded mode / model
+    start_run(run_id, "benchmark", question, mode, DEFAULT_MODEL_ID, settings={
+        "mode_category": MULTILAYER_CATEGORY,
+        "use_search": True,
+        "candidate_count": 1,
+    })
+    try:
+        result = run_pipeline_from_checkpoint(
+            question,
+            mode,
+            run_id,
+            history=[],
+            client=client,
+            sessions=[],
+            session_id="benchmark",
+        )
+    except Exception as e:
+        return {"seconds": time.perf_counter() - started, "error": f"{type(e).__name__}: {e}"[:300]}
+    return {
+        "seconds": time.perf_counter() - started,
+        "phases": phase_totals(result["reasoning_logs"].get("telemetry")),
+        "cost": result["cost"],
+        # run_pipeline_from_checkpoint() re-runs escalations itself; the first pass is kept in cascade_info
+        "escalated": bool((result.get("cascade_info") or {}).get("escalated")),
+        "routed_pipeline": (result.get("routed_pipeline") or {}).get("mode_name"),
+    }
+
+
+def benchmark_mode(stand_in: Dict[str, Any], mode: str, runs: int, concurrency: int, questions: List[str]) -> Dict[str, Any]:
+    """
+    Run one response mode `runs` times (`concurrency` at a time) against the stand-ins.
+
+    Returns:
+        Latency summaries (end-to-end and per phase), provider call / concurrency
+        statistics, thread count, CPU utilization and peak traced memory
+    """
+    stand_in["stats"].reset()
+    tracemalloc.reset_peak()
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    with _ThreadSampler() as sampler:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="benchmark-run") as pool:
+            futures = [pool.submit(_run_once, stand_in["client"], mode, questions[i % len(questions)]) for i in range(runs)]
+            outcomes = [future.result() for future in futures]
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+    _, peak_memory = tracemalloc.get_traced_memory()
+
+    completed = [outcome for outcome in outcomes if "error" not in outcome]
+    phases: Dict[str, List[float]] = {}
+    for outcome in completed:
+        for name, seconds in outcome["phases"].items():
+            phases.setdefault(name, []).append(seconds)
+    routes: Dict[str, int] = {}
+    for outcome in completed:
+        if outcome["routed_pipeline"]:
+            routes[outcome["routed_pipeline"]] = routes.get(outcome["routed_pipeline"], 0) + 1
+
+    return {
+        "runs": runs,
+        "completed": len(completed),
+        "failures": [outcome["error"] for outcome in outcomes if "error" in outcome],
+        "escalations": sum(outcome["escalated"] for outcome in completed),
+        "routes": routes,
+        "wall_seconds": round(wall, 3),
+        "latency": _summary([outcome["seconds"] for outcome in completed]),
+        "phases": {name: _summary(values) for name, values in phases.items()},
+        "cost_per_run": round(statistics.mean([outcome["cost"] for outcome in completed]), 6) if completed else None,
+        "providers": {
+            provider: {
+                "calls": entry["calls"],
+                "errors": entry["errors"],
+                # Average number of calls in flight over the mode's wall time
+                "mean_in_flight": round(entry["busy_seconds"] / wall, 2) if wall else 0.0,
+                "peak_in_flight": entry["peak_in_flight"],
+            }
+            for provider, entry in stand_in["stats"].snapshot().items()
+        },
+        "threads": {
+            "peak": max(sampler.samples, default=0),
+            "mean": round(statistics.mean(sampler.samples), 1) if sampler.samples else 0.0,
+        },
+        "cpu_utilization": round(cpu / wall, 3) if wall else 0.0,
+        "peak_traced_memory_mb": round(peak_memory / 1024 ** 2, 2),
+    }
+
+
+def run_benchmark(
+    modes: Optional[List[str]] = None,
+    runs: int = 3,
+    concurrency: int = 1,
+    questions: Optional[List[str]] = None,
+    profiles: Optional[Dict[str, Dict[str, Any]]] = None,
+    time_scale: float = DEFAULT_TIME_SCALE,
+    seed: Optional[int] = 0,
+    real_quotas: bool = False
+) -> Dict[str, Any]:
+    """
+    Benchmark response modes against the stand-in providers.
+
+    Args:
+        modes: Response mode labels (default DEFAULT_MODES)
+        runs: Runs per mode
+        concurrency: Runs in flight at once (simulated concurrent users)
+        questions: Questions cycled through the runs (default DEFAULT_QUESTIONS)
+        profiles: Provider profiles (merge_profiles() output)
+        time_scale: Multiplier for every sampled latency
+        seed: Random seed for the stand-ins
+        real_quotas: Keep the per-minute quota limits
+
+    Returns:
+        {"settings": {...}, "modes": {mode: benchmark_mode() result}, "max_rss_mb": float}
+    """
+    modes = modes or DEFAULT_MODES
+    profiles = profiles or merge_profiles()
+    report = {
+        "settings": {
+            "runs": runs,
+            "concurrency": concurrency,
+            "time_scale": time_scale,
+            "seed": seed,
+            "real_quotas": real_quotas,
+            "profiles": profiles,
+        },
+        "modes": {},
+    }
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        with stand_in_providers(profiles, time_scale, seed, real_quotas) as stand_in:
+            for mode in modes:
+                report["modes"][mode] = benchmark_mode(stand_in, mode, runs, concurrency, questions or DEFAULT_QUESTIONS)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["max_rss_mb"] = round(max_rss / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    settings = report["settings"]
+    lines = [
+        f"Pipeline benchmark: {settings['runs']} runs/mode, concurrency {settings['concurrency']}, "
+        f"time scale {settings['time_scale']} (seconds below are scaled wall-clock)",
+        "",
+    ]
+    for mode, result in report["modes"].items():
+        latency = result["latency"]
+        lines.append(f"■ {mode}  ({result['completed']}/{result['runs']} completed, wall {result['wall_seconds']:.2f}s)")
+        if latency["n"]:
+            lines.append(f"  end-to-end: mean {latency['mean']:.3f}s  p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  max {latency['max']:.3f}s")
+            lines.append(f"  cost/run: ${result['cost_per_run']:.4f}  escalations: {result['escalations']}"
+                         + (f"  routes: {result['routes']}" if result["routes"] else ""))
+        for name, summary in result["phases"].items():
+            lines.append(f"    {name:<22} mean {summary['mean']:.3f}s  p95 {summary['p95']:.3f}s  (n={summary['n']})")
+        for provider, entry in result["providers"].items():
+            lines.append(
+                f"  {provider:<14} calls {entry['calls']:>4}  errors {entry['errors']:>3}  "
+                f"in flight mean {entry['mean_in_flight']:.2f} / peak {entry['peak_in_flight']}"
+            )
+        lines.append(
+            f"  threads mean {result['threads']['mean']} / peak {result['threads']['peak']}  "
+            f"cpu {result['cpu_utilization']:.0%}  peak traced memory {result['peak_traced_memory_mb']:.1f} MB"
+        )
+        for failure in result["failures"][:3]:
+            lines.append(f"  ❌ {failure}")
+        lines.append("")
+    lines.append(f"max RSS: {report['max_rss_mb']:.1f} MB")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark run_pipeline against local stand-in providers")
+    parser.add_argument("--modes", nargs="+", default=DEFAULT_MODES, help="Response mode labels as shown in the UI")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per mode")
+    parser.add_argument("--concurrency", type=int, default=1, help="Runs in flight at once")
+    parser.add_argument("--time-scale", type=float, default=DEFAULT_TIME_SCALE, help="Multiplier for the simulated provider latencies")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for latencies, errors and token counts")
+    parser.add_argument("--profile", help="JSON file with provider profile overrides, e.g. {\"bedrock\": {\"latency_median\": 30}}")
+    parser.add_argument("--error-rate", type=float, help="Override error_rate for every provider")
+    parser.add_argument("--real-quotas", action="store_true", help="Keep the per-minute Gemini quota limits")
+    parser.add_argument("--question", action="append", help="Question to run (repeatable; default: built-in set)")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    overrides: Dict[str, Dict[str, Any]] = {}
+    if args.profile:
+        with open(args.profile, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+    profiles = merge_profiles(overrides)
+    if args.error_rate is not None:
+        for profile in profiles.values():
+            profile["error_rate"] = args.error_rate
+
+    report = run_benchmark(
+        args.modes,
+        runs=args.runs,
+        concurrency=args.concurrency,
+        questions=args.question,
+        profiles=profiles,
+        time_scale=args.time_scale,
+        seed=args.seed,
+        real_quotas=args.real_quotas,
+    )
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
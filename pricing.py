@@ -0,0 +1,165 @@
+"""
+Phase R: Pricing Registry
+One price table for every model the app calls (Vertex Gemini, Bedrock
+Claude, OpenRouter, GitHub Models) and one usage shape for every provider's
+response, so each phase is billed from the tokens the provider reported —
+including thinking tokens (billed at the output price) and cache hits
+(billed at the cached-input price) — instead of per-file constants.
+
+Normalized usage:
+    {"input_tokens", "output_tokens", "thinking_tokens", "cached_tokens",
+     "cache_write_tokens", "reported_cost"}
+    input_tokens includes cached_tokens; output_tokens excludes thinking_tokens;
+    reported_cost is the provider's own figure (OpenRouter) or None.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+from typing import Dict, Any, Optional
+
+from providers import CLAUDE_MODEL_ID, GITHUB_MODEL_ID
+
+
+VERTEX = "vertex"
+BEDROCK = "bedrock"
+OPENROUTER = "openrouter"
+GITHUB_MODELS = "github_models"
+
+# USD per 1M tokens. cached_input: cache-hit input price; cache_write: cache-creation input price
+MODEL_PRICES = {
+    "gemini-3-pro-preview":  {"provider": VERTEX, "input": 2.0,  "output": 12.0, "cached_input": 0.20},
+    "gemini-2.5-pro":        {"provider": VERTEX, "input": 1.25, "output": 10.0, "cached_input": 0.125},
+    "gemini-2.5-flash":      {"provider": VERTEX, "input": 0.30, "output": 2.50, "cached_input": 0.03},
+    "gemini-2.5-flash-lite": {"provider": VERTEX, "input": 0.10, "output": 0.40, "cached_input": 0.01},
+    "gemini-2.0-flash":      {"provider": VERTEX, "input": 0.10, "output": 0.40, "cached_input": 0.025},
+    CLAUDE_MODEL_ID:         {"provider": BEDROCK, "input": 3.0, "output": 15.0, "cached_input": 0.30, "cache_write": 3.75},
+    # GitHub Models free tier (rate-limited, not billed)
+    GITHUB_MODEL_ID:         {"provider": GITHUB_MODELS, "input": 0.0, "output": 0.0},
+}
+
+# Vertex batch prediction price relative to online calls
+BATCH_PRICE_FACTOR = float(os.getenv("GEMINI_BATCH_PRICE_FACTOR", "0.5"))
+
+# Paid OpenRouter models not in MODEL_PRICES are billed from the cost OpenRouter reports
+_FREE_PRICE = {"input": 0.0, "output": 0.0}
+
+
+def price_for(model: str) -> Dict[str, Any]:
+    """
+    Price entry of a model id.
+
+    OpenRouter ids ending in ":free" cost nothing; unknown ids also price at
+    zero (their usage is still recorded, and OpenRouter's reported cost wins).
+    """
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    if model and model.endswith(":free"):
+        return {"provider": OPENROUTER, **_FREE_PRICE}
+    return {"provider": None, **_FREE_PRICE}
+
+
+def empty_usage() -> Dict[str, Any]:
+    return {
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "thinking_tokens": 0,
+        "cached_tokens": 0,
+        "cache_write_tokens": 0,
+        "reported_cost": None,
+    }
+
+
+def _field(source, *names) -> int:
+    """First present field of an SDK object or a REST dict (snake_case or camelCase)."""
+    for name in names:
+        value = source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+        if value:
+            return int(value)
+    return 0
+
+
+def gemini_usage(response_or_metadata) -> Dict[str, Any]:
+    """
+    Usage of a Gemini call: a GenerateContentResponse, its usage_metadata, or a
+    REST/batch prediction dict ({"usageMetadata": {...}}).
+    """
+    usage = empty_usage()
+    if response_or_metadata is None:
+        return usage
+    if isinstance(response_or_metadata, dict):
+        metadata = response_or_metadata.get("usageMetadata", response_or_metadata)
+    else:
+        metadata = getattr(response_or_metadata, "usage_metadata", response_or_metadata)
+    if not metadata:
+        return usage
+    usage["input_tokens"] = _field(metadata, "prompt_token_count", "promptTokenCount")
+    usage["output_tokens"] = _field(metadata, "candidates_token_count", "candidatesTokenCount")
+    usage["thinking_tokens"] = _field(metadata, "thoughts_token_count", "thoughtsTokenCount")
+    usage["cached_tokens"] = _field(metadata, "cached_content_token_count", "cachedContentTokenCount")
+    return usage
+
+
+def bedrock_usage(raw: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Usage of a Bedrock Converse call (resp["usage"]); cache reads/writes are billed separately."""
+    usage = empty_usage()
+    raw = raw or {}
+    cached = raw.get("cacheReadInputTokens", 0) or 0
+    usage["input_tokens"] = (raw.get("inputTokens", 0) or 0) + cached
+    usage["output_tokens"] = raw.get("outputTokens", 0) or 0
+    usage["cached_tokens"] = cached
+    usage["cache_write_tokens"] = raw.get("cacheWriteInputTokens", 0) or 0
+    return usage
+
+
+def openai_usage(raw: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Usage of an OpenAI-compatible chat completion (OpenRouter, GitHub Models)."""
+    usage = empty_usage()
+    raw = raw or {}
+    thinking = (raw.get("completion_tokens_details") or {}).get("reasoning_tokens", 0) or 0
+    usage["input_tokens"] = raw.get("prompt_tokens", 0) or 0
+    usage["output_tokens"] = max(0, (raw.get("completion_tokens", 0) or 0) - thinking)
+    usage["thinking_tokens"] = thinking
+    usage["cached_tokens"] = (raw.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+    # OpenRouter usage accounting: cost in USD credits
+    usage["reported_cost"] = raw.get("cost")
+    return usage
+
+
+def token_usage(input_tokens: Optional[int], output_tokens: Optional[int]) -> Dict[str, Any]:
+    """Usage from plain input / output counts (estimates, legacy records)."""
+    usage = empty_usage()
+    usage["input_tokens"] = input_tokens or 0
+    usage["output_tokens"] = output_tokens or 0
+    return usage
+
+
+def usage_cost(model: str, usage: Dict[str, Any], price_factor: float = 1.0) -> float:
+    """
+    Cost in USD of one call.
+
+    Args:
+        model: Model id (price_for)
+        usage: Normalized usage (gemini_usage / bedrock_usage / openai_usage / token_usage)
+        price_factor: Multiplier (BATCH_PRICE_FACTOR for Vertex batch prediction)
+
+    Returns:
+        The provider-reported cost when present, otherwise tokens × MODEL_PRICES
+    """
+    if usage.get("reported_cost") is not None:
+        return float(usage["reported_cost"]) * price_factor
+    price = price_for(model)
+    cached = usage.get("cached_tokens", 0) or 0
+    uncached = max(0, (usage.get("input_tokens", 0) or 0) - cached)
+    cost = (
+        uncached * price["input"]
+        + cached * price.get("cached_input", price["input"])
+        + (usage.get("cache_write_tokens", 0) or 0) * price.get("cache_write", price["input"])
+        + ((usage.get("output_tokens", 0) or 0) + (usage.get("thinking_tokens", 0) or 0)) * price["output"]
+    ) / 1_000_000
+    return cost * price_factor
+
+
+def calculate_cost(model_id: str, input_tok: Optional[int], output_tok: Optional[int]) -> float:
+    """Cost from plain input / output counts (no thinking / cache breakdown)."""
+    return usage_cost(model_id, token_usage(input_tok, output_tok))
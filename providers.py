@@ -0,0 +1,531 @@
+"""
+Secondary Model Providers - OpenRouter / AWS Bedrock / GitHub Models
+Independent-thinking and review calls made next to Gemini in Phase 1.5 and
+Phase 3b. Credentials come from the environment; app.py passes the values
+it reads from st.secrets through configure_credentials().
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import requests
+
+from metrics import instrument_call
+from phase_executor import OPENROUTER, BEDROCK, GITHUB_MODELS
+from scheduler import scheduled
+
+try:
+    import boto3
+    HAS_BOTO3 = True
+except ImportError:
+    HAS_BOTO3 = False
+
+
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+
+# ▼▼▼ AWS Bedrock (Claude 4.5 Sonnet用) ▼▼▼
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID", "")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY", "")
+
+# Claude 4.5 Sonnet の inference profile ID
+CLAUDE_MODEL_ID = "us.anthropic.claude-sonnet-4-5-20250929-v1:0"
+CLAUDE_REGION = "us-east-1"
+# ▲▲▲ AWS Bedrock ここまで ▲▲▲
+
+# ▼▼▼ GitHub Models (o4-mini用) ▼▼▼
+GITHUB_TOKEN = os.getenv("GITHUB_TOKEN", "")
+GITHUB_MODEL_ID = "o4-mini"
+# ▲▲▲ GitHub Models ここまで ▲▲▲
+
+# ▼▼▼ OpenRouter セカンダリモデル（元 Grok スロット）▼▼▼
+# デフォルトは Amazon Nova 2 Lite (free)
+DEFAULT_SECONDARY_MODEL_ID = "amazon/nova-2-lite-v1:free"
+
+# 環境変数優先で差し替え可能
+SECONDARY_MODEL_ID = (
+    os.getenv("OPENROUTER_SECONDARY_MODEL_ID")   # 新しい推奨環境変数
+    or os.getenv("GROK_MODEL_ID")               # 互換性のために残す
+    or DEFAULT_SECONDARY_MODEL_ID
+)
+
+# UI 用に人間に見せる名前も ENV から変えられるようにしておく
+SECONDARY_MODEL_NAME = os.getenv(
+    "OPENROUTER_SECONDARY_MODEL_NAME",
+    "Amazon Nova 2 Lite (free)",
+)
+# ▲▲▲ OpenRouter セカンダリモデル ここまで ▲▲▲
+
+
+def configure_credentials(
+    openrouter_api_key: str = None,
+    aws_access_key_id: str = None,
+    aws_secret_access_key: str = None,
+    github_token: str = None,
+) -> None:
+    """
+    Override the environment credentials (app.py passes its st.secrets values).
+    Arguments left as None keep the current value.
+    """
+    global OPENROUTER_API_KEY, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, GITHUB_TOKEN
+    if openrouter_api_key is not None:
+        OPENROUTER_API_KEY = openrouter_api_key
+    if aws_access_key_id is not None:
+        AWS_ACCESS_KEY_ID = aws_access_key_id
+    if aws_secret_access_key is not None:
+        AWS_SECRET_ACCESS_KEY = aws_secret_access_key
+    if github_token is not None:
+        GITHUB_TOKEN = github_token
+
+
+def has_openrouter() -> bool:
+    return bool(OPENROUTER_API_KEY)
+
+
+def has_bedrock() -> bool:
+    return bool(AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY)
+
+
+def has_github_models() -> bool:
+    return bool(GITHUB_TOKEN)
+
+
+@scheduled
+@instrument_call(OPENROUTER)
+def think_with_grok(user_question: str, research_text: str, enable_x_search: bool = False, mode: str = "default") -> tuple[str, dict]:
+    """
+    OpenRouter のセカンダリモデル（デフォルト: amazon/nova-2-lite-v1:free）で
+    リサーチメモを別視点から検討する。
+    enable_x_search=True の場合、X/Twitter情報の活用を促す
+    mode="full_max" の場合、独立したリード研究者として振る舞う
+    Returns: (回答テキスト, usage辞書 - OpenRouter の usage。cost を含む)
+    """
+    if not OPENROUTER_API_KEY:
+        raise RuntimeError("OpenRouter API Key is missing.")
+
+    # X検索強化版の場合、特別な指示を追加
+    x_search_instruction = ""
+    if enable_x_search:
+        x_search_instruction = (
+            "\n\n**重要**: あなたは X（Twitter）の情報にアクセスできると仮定して構いませんが、"
+            "実際にWebを閲覧したかのような断定的表現（「公式サイトを確認したところ〜」など）は避けてください。\n"
+        )
+    
+    
+    # Phase A: モデル役割特化
+    role_specialization = """
+【あなたの専門役割】
+・エッジな視点、カウンター意見、皮肉な見方を提供する専門家
+・主流の意見に対する「待った」を入れる役割
+・X/Twitter的な鋭い指摘や炎上リスクの検出
+
+【他のモデルに任せること】
+・Web検索や長文要約 → Gemini
+・構造的リスク分析 → Claude 4.5
+・テストケース列挙 → o4-mini
+"""
+    
+    if mode == "full_max":
+        user_content = (
+            role_specialization +
+            f"\nユーザーの質問:\n{user_question}\n\n"
+            f"調査メモ:\n{research_text}\n\n"
+            "指示:\n"
+            "あなたは別視点のリード研究者です。\n"
+            "・新しい結論を作るよりも、「見落としていそうな論点・リスク・反対意見」を出すことを優先してください。\n"
+            "・3〜7個の箇条書きにまとめてください。各項目は1〜3行以内で簡潔に。\n"
+            "・連続する空行は1行までにしてください。\n"
+            f"{x_search_instruction}"
+        )
+    else:
+        user_content = (
+            role_specialization +
+            f"\nユーザーの質問:\n{user_question}\n\n"
+            f"調査メモ:\n{research_text}\n\n"
+            "指示:\n"
+            "調査メモを元に、「他のモデルが見落としそうな視点・リスク」を3〜5個、箇条書きで出してください。\n"
+            "・フルの回答ではなく、チェックリスト形式で。\n"
+            "・各項目は1〜3行以内で簡潔に。\n"
+            f"{x_search_instruction}"
+        )
+
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://gemini-app.streamlit.app/", 
+        "X-Title": "Gemini Web Studio",
+    }
+    
+    data = {
+        "model": SECONDARY_MODEL_ID,
+        "messages": [
+            {"role": "user", "content": user_content}
+        ],
+        "temperature": 0.8,  # Phase A: エッジな視点・カウンター意見を出しやすく
+        "max_tokens": 2000,
+        # usage に実コスト (cost) を含めて返させる
+        "usage": {"include": True},
+        # Nova 2 Lite など reasoning 対応モデルならここで有効化も可能：
+        # "reasoning": {"effort": "medium"},
+    }
+
+    try:
+        response = requests.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=60,
+        )
+        response.raise_for_status()
+        result = response.json()
+        return (result["choices"][0]["message"]["content"], result.get("usage") or {})
+    except Exception as e:
+        # ここは raise にして、呼び出し側で error として扱う方が安全
+        raise RuntimeError(f"Error calling OpenRouter model ({SECONDARY_MODEL_ID}): {e}")
+
+@scheduled
+@instrument_call(OPENROUTER)
+def review_with_grok(user_question: str, gemini_answer: str, research_text: str, mode: str = "normal") -> tuple[str, dict]:
+    """
+    OpenRouterセカンダリモデルを使って、Geminiの最終回答をレビューする
+    mode="onigunsou": 厳格な検察官としてレビュー
+    mode="full_max": ダブル鬼軍曹としてレビュー
+    Returns: (レビューテキスト, usage辞書)
+    """
+    if not OPENROUTER_API_KEY:
+        return ("OpenRouter API Key is missing.", {})
+
+    # 共通: セカンダリモデルの役割を「レビューコメント専用」に厳しく制限
+    system_content = (
+        "あなたはGeminiの回答をチェックするレビューアです。\n"
+        "\n"
+        "【前提】\n"
+        "・あなたの汎用知識はあくまで参考情報です。\n"
+        "・ユーザーが渡した「調査メモ」と「Geminiの回答」に書かれている事実を、あなた自身の知識よりも常に優先してください。\n"
+        "\n"
+        "【禁止事項】\n"
+        "・自分の知識のカットオフや最終更新日について言及してはいけません。\n"
+        "  （例:「2024年12月時点では〜」「私の知識は2024年までです」など）\n"
+        "・「〜というモデルは存在しない」「まだ発表されていない」と断定してはいけません。\n"
+        "  必要な場合は「公開情報と食い違う可能性があるので要確認」のように、弱い表現にしてください。\n"
+        "・Webサイトを『今見た』かのような表現（例:『公式サイトを確認したところ〜』）を使ってはいけません。\n"
+        "\n"
+        "【レビューの方針】\n"
+        "・調査メモとGeminiの回答のあいだにある、具体的な矛盾・危険な誤り・過度な断定だけを指摘してください。\n"
+        "・単に「自分の知識と違う」「自分の知識では確認できない」だけの場合、それをもって誤り認定してはいけません。\n"
+        "  その場合は「公開情報と異なる可能性があるので要確認」程度の一行コメントに留めてください。\n"
+        "・Markdownは使用してかまいませんが、連続する空行は1行までにしてください。\n"
+    )
+    
+    if mode == "onigunsou":
+        system_content += (
+            "\n⚠️ 重要な注意:\n"
+            "・あなたは **自分の学習知識ではなく、調査メモとGeminiの回答** を前提にレビューしてください。\n"
+            "・調査メモに自分の記憶と異なる新しい情報があっても、「誤り」と決めつけず、\n"
+            "  「公開情報と食い違う可能性があるので要確認」といった弱い表現にしてください。\n"
+            "・「◯年◯月時点では〜」のような日付ベースの反論は行わないでください。\n"
+        )
+        instruction = (
+            "以下の形式で、レビューコメントだけ返してください。\n\n"
+            "## 評価概要\n"
+            "- 回答は OK / 要修正 / 危険 のいずれかで評価してください。\n\n"
+            "## 問題点\n"
+            "- 箇条書きで、危険な誤り・過度な断定・論理の飛躍などを書いてください。\n\n"
+            "## 修正のポイント\n"
+            "- どの部分をどう弱める／書き換えるべきか だけを簡潔に示してください。\n\n"
+            "※ Geminiの回答全文を書き直したり、独自の最終回答を作らないでください。"
+        )
+    elif mode == "full_max":
+        system_content += (
+            "\n⚠️ 重要な注意:\n"
+            "・あなたは検察官レベルに厳しくレビューしますが、\n"
+            "  それでもなお **調査メモの記載をファクトとして扱う** 必要があります。\n"
+            "・自分の知識との差分だけを根拠に「誤り」「危険」と判断してはいけません。\n"
+            "・最新情報かどうか分からない場合は「要確認」とだけ述べ、\n"
+            "  カットオフや学習時期には一切触れないでください。\n"
+        )
+        instruction = (
+            "以下の形式で、厳しめのレビューコメントだけ返してください。\n\n"
+            f"## {SECONDARY_MODEL_NAME}評価概要\n"
+            "- OK / 要修正 / 危険 のいずれかで評価してください。\n\n"
+            "## 重大な問題点\n"
+            "- 箇条書きで、特にユーザーを誤誘導しそうな点だけ挙げてください。\n\n"
+            "## 改善のヒント\n"
+            "- どの論点を弱めたり、追加で注意書きすべきかを書いてください。\n\n"
+            "※ Geminiの回答全文を書き直したり、独自の最終回答を作らないでください。"
+        )
+    else:
+        instruction = (
+            "以下のGeminiの回答をレビューし、論理的な誤りや不足している視点があれば指摘してください。\n"
+            "また、より良い回答にするための改善案を提示してください。"
+        )
+
+    user_content = (
+        f"ユーザーの質問:\n{user_question}\n\n"
+        f"調査メモ:\n{research_text}\n\n"
+        f"Geminiの回答:\n{gemini_answer}\n\n"
+        f"指示:\n{instruction}"
+    )
+
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://gemini-app.streamlit.app/", 
+        "X-Title": "Gemini Web Studio",
+    }
+    
+    data = {
+        "model": SECONDARY_MODEL_ID,
+        "messages": [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": user_content}
+        ],
+        "temperature": 0.5, # レビューなので少し抑えめ
+        "max_tokens": 2000,
+        "usage": {"include": True},
+    }
+    try:
+        response = requests.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=60
+        )
+        response.raise_for_status()
+        result = response.json()
+        
+        # カットオフ系のノイズを削除
+        raw_content = result["choices"][0]["message"]["content"]
+        return (_clean_grok_review(raw_content), result.get("usage") or {})
+    except requests.exceptions.HTTPError as e:
+        # ステータスコードとレスポンス本文を返す
+        status = e.response.status_code if e.response else "unknown"
+        body = e.response.text[:500] if e.response is not None else ""
+        return (f"Error calling {SECONDARY_MODEL_NAME}: HTTP {status}: {body}", {})
+    except Exception as e:
+        return (f"Error calling {SECONDARY_MODEL_NAME}: {type(e).__name__}: {e}", {})
+
+
+def _clean_grok_review(text: str) -> str:
+    """
+    Grok のレビューから「知識カットオフ」「◯年◯月時点」系のノイズを軽く削る
+    """
+    NG_PHRASES = [
+        "カットオフ",
+        "cutoff",
+        "知識は",
+        "2024年12月時点",
+        "2024 年 12 月時点",
+        "2024年11月時点",
+        "私の知識",
+    ]
+    lines = []
+    for line in text.splitlines():
+        if any(ng in line for ng in NG_PHRASES):
+            # その行は捨てる
+            continue
+        lines.append(line)
+    return "\n".join(lines).strip()
+
+
+
+@scheduled
+@instrument_call(BEDROCK)
+def think_with_claude45_bedrock(user_question: str, research_text: str) -> tuple[str, dict]:
+    """
+    AWS Bedrock 経由で Claude Sonnet 4.5 を使って独立した回答案を作成する
+    Returns: (回答テキスト, usage辞書)
+    """
+    if not HAS_BOTO3:
+        return ("Error: boto3 library not installed. (pip install boto3)", {})
+    if not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY:
+        return ("Error: AWS credentials are missing.", {})
+
+    # Claude 4.5 への役割付与: 論理的推論とリスク指摘に特化
+    system_prompt = (
+        "あなたはGeminiとは異なる独立したAIアドバイザーです。\n"
+        "提供された調査メモを事実のベースとしつつも、あなたの強みである「論理的推論(Reasoning)」を活かして、\n"
+        "Geminiが見落としがちな『前提の誤り』『隠れたリスク』『別の可能性』を指摘してください。\n"
+        "回答は簡潔に、箇条書きで出力してください。"
+    )
+
+    
+    # Phase A: モデル役割特化
+    role_specialization = """
+【あなたの専門役割】
+・構造的リスク、システム的な問題点の発見
+・長期的なシナリオ分析（1年後、5年後の影響）
+・見落とされがちな前提条件や依存関係の指摘
+
+【あなたが重視すべきこと】
+・短期的な視点よりも、長期的・構造的な視点
+・「このアプローチが失敗する条件は？」
+・「スケールした時に何が壊れるか？」
+"""
+    
+    user_content = (
+        role_specialization +
+        f"\nユーザーの質問:\n{user_question}\n\n"
+        f"調査メモ:\n{research_text}\n\n"
+        "指示:\n"
+        "調査メモの内容を元に、長期的な視点で「リスク」「前提条件」「依存関係」を中心に\n"
+        "3〜5個の重要なポイントを箇条書きで書いてください。"
+    )
+
+    try:
+        # AWS Bedrock クライアント作成
+        bedrock = boto3.client(
+            service_name='bedrock-runtime',
+            region_name=CLAUDE_REGION,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+        )
+
+        # Bedrock converse API を使用（inference profile対応 + Extended Thinking）
+        resp = bedrock.converse(
+            modelId=CLAUDE_MODEL_ID,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"text": f"{system_prompt}\n\n{user_content}"}
+                    ],
+                }
+            ],
+            inferenceConfig={
+                "maxTokens": 5000,  # Thinking modeでは多めに確保
+                "temperature": 1.0,  # Extended Thinking mode では必須
+            },
+            # Extended Thinking Mode を有効化
+            additionalModelRequestFields={
+                "thinking": {
+                    "type": "enabled",
+                    "budget_tokens": 3000  # 思考用トークン数
+                }
+            }
+        )
+
+        # 思考ブロックと回答テキストの取り出し (reasoningContent対応)
+        thinking_blocks = []
+        text_chunks = []
+        output = resp.get("output", {})
+        message = output.get("message", {})
+        
+        for part in message.get("content", []):
+            # Extended Thinking の推論プロセス (reasoningContent)
+            if "reasoningContent" in part:
+                rc = part["reasoningContent"]
+                if isinstance(rc, dict):
+                    # reasoningText.text を取得
+                    rt = rc.get("reasoningText", {})
+                    if isinstance(rt, dict):
+                        t = rt.get("text")
+                        if t:
+                            thinking_blocks.append(t)
+                    # フォールバック: rc["text"] も試す
+                    elif "text" in rc:
+                        thinking_blocks.append(rc["text"])
+            # 最終回答テキスト
+            elif "text" in part:
+                text_chunks.append(part["text"])
+
+        # 使用量情報の取得
+        usage = resp.get("usage", {})
+        usage_dict = {
+            "inputTokens": usage.get("inputTokens", 0),
+            "outputTokens": usage.get("outputTokens", 0),
+            # プロンプトキャッシュ (読み取り / 書き込み) は料金が異なる
+            "cacheReadInputTokens": usage.get("cacheReadInputTokens", 0),
+            "cacheWriteInputTokens": usage.get("cacheWriteInputTokens", 0),
+        }
+
+        result_text = "".join(text_chunks) if text_chunks else "[Claude 4.5 Sonnetからのテキストが空でした]"
+        
+        # 思考ブロックがある場合は冒頭に追加
+        if thinking_blocks:
+            thinking_text = "\n\n".join([f"**🧠 思考プロセス {i+1}:**\n{block}" for i, block in enumerate(thinking_blocks)])
+            result_text = f"{thinking_text}\n\n---\n\n**💡 最終回答:**\n{result_text}"
+        
+        return (result_text, usage_dict)
+
+    except Exception as e:
+        # エラー詳細を返す
+        return (f"Error calling Claude 4.5 Sonnet (Bedrock): {e}", {})
+
+
+
+
+@scheduled
+@instrument_call(GITHUB_MODELS)
+def think_with_o4_mini(user_question: str, research_text: str) -> tuple[str, dict]:
+    """
+    GitHub Models経由でo4-miniを使って独立した回答案を作成する
+    制限: input 4000トークン以下の場合のみ使用
+    Returns: (回答テキスト, usage辞書 - OpenAI 互換の usage)
+    """
+    if not GITHUB_TOKEN:
+        return ("Error: GitHub Token is missing.", {})
+    
+    # 長さチェックは呼び出し側で実施済み（3800文字以下を保証）
+    
+    
+    system_prompt = (
+        "あなたは、与えられた要約をもとに「抜けていそうな観点」を列挙するテスター/チェッカーです。\n"
+        "【重要な制約】\n"
+        "・フルの回答は書かないでください。\n"
+        "・「他のモデルが見落としそうなリスク・エッジケース・反論」だけを箇条書きで出してください。\n"
+        "・最大5個まで。各項目は1〜3行以内で簡潔に。\n"
+        "・連続する空行は1行までにしてください。"
+    )
+    
+    
+    # Phase A: モデル役割特化
+    role_specialization = """
+【あなたの専門役割】
+・テストケース、エッジケースの列挙
+・「◯◯の場合はどうなる？」というチェックリスト作成
+・実装上の落とし穴や細かい注意点の指摘
+
+【出力形式の推奨】
+・箇条書きのチェックリスト形式
+・「確認すべきこと」リスト
+・「想定すべきケース」リスト
+"""
+    
+    user_content = (
+        role_specialization +
+        f"\nユーザーの質問:\n{user_question}\n\n"
+        f"調査メモ:\n{research_text}\n\n"
+        "指示:\n"
+        "調査メモを元に、考慮すべき「テストケース」「エッジケース」「チェック項目」を\n"
+        "箇条書きで3〜7個出してください。"
+    )
+    
+    headers = {
+        "Authorization": f"Bearer {GITHUB_TOKEN}",
+        "Content-Type": "application/json",
+    }
+    
+    data = {
+        "model": "gpt-4o-mini",  # GitHub Models用のモデル名
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ],
+        "temperature": 0.7,
+        "max_tokens": 2000,
+    }
+    
+    try:
+        import requests
+        response = requests.post(
+            f"https://models.inference.ai.azure.com/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=60
+        )
+        response.raise_for_status()
+        result = response.json()
+        answer_text = result["choices"][0]["message"]["content"]
+        return (answer_text, result.get("usage") or {})
+    except Exception as e:
+        return (f"Error calling o4-mini (GitHub Models): {e}", {})
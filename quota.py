@@ -0,0 +1,389 @@
+"""
+Phase H: Shared Quota Ledger
+Tracks requests and tokens per model per minute for the whole process, so the
+browser sessions of one Streamlit server share the Vertex quota instead of
+each discovering 429s on its own. Callers reserve capacity before calling;
+when the minute's budget is used up they wait in a FIFO queue per model.
+
+Set QUOTA_DB_PATH to share the ledger across processes (several Streamlit
+workers, the batch CLI) through a local SQLite file.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import time
+import sqlite3
+import itertools
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Any, Optional
+
+import metrics
+from pricing import VERTEX
+from scheduler import SchedulerBusyError, get_scheduler
+
+
+WINDOW_SECONDS = 60.0
+
+# Per-model budget per minute (requests / input+output tokens)
+MODEL_QUOTAS = {
+    "gemini-3-pro-preview":  {"rpm": 25,  "tpm": 1_000_000},
+    "gemini-2.5-pro":        {"rpm": 60,  "tpm": 2_000_000},
+    "gemini-2.5-flash":      {"rpm": 200, "tpm": 4_000_000},
+    "gemini-2.5-flash-lite": {"rpm": 300, "tpm": 4_000_000},
+    "gemini-2.0-flash":      {"rpm": 300, "tpm": 4_000_000},
+}
+DEFAULT_QUOTA = {"rpm": 60, "tpm": 1_000_000}
+
+# Output tokens assumed when the config does not set max_output_tokens
+DEFAULT_OUTPUT_ESTIMATE = 4096
+
+# How long a caller waits for capacity before giving up
+DEFAULT_RESERVE_TIMEOUT = 180.0
+
+# Back-off applied to every caller after a 429 (unless the error says otherwise)
+DEFAULT_EXHAUSTED_BACKOFF = 30.0
+
+QUOTA_DB_PATH = os.getenv("QUOTA_DB_PATH")
+
+
+class QuotaExhaustedError(Exception):
+    """Raised when capacity could not be reserved in time (message contains "quota" for the retry loops)."""
+
+
+@dataclass
+class Reservation:
+    model: str
+    tokens: int
+    entry_id: Any
+
+
+def quota_for(model: str) -> Dict[str, int]:
+    return MODEL_QUOTAS.get(model, DEFAULT_QUOTA)
+
+
+def _text_length(value) -> int:
+    """Characters of text in generate_content contents (str / Content / Part / lists)."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_text_length(item) for item in value)
+    text = getattr(value, "text", None)
+    if isinstance(text, str):
+        return len(text)
+    parts = getattr(value, "parts", None)
+    if parts:
+        return _text_length(parts)
+    return 0
+
+
+def estimate_tokens(contents, config=None) -> int:
+    """
+    Rough token estimate used for the reservation (settled with usage_metadata afterwards).
+
+    Japanese text is close to one token per character, English about four
+    characters per token; two characters per token is a conservative middle.
+    """
+    max_output = getattr(config, "max_output_tokens", None) if config is not None else None
+    return _text_length(contents) // 2 + (max_output or DEFAULT_OUTPUT_ESTIMATE)
+
+
+class _MemoryBackend:
+    """Process-wide ledger: sliding window per model + FIFO ticket queue."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._entries: Dict[str, deque] = {}
+        self._queues: Dict[str, deque] = {}
+        self._blocked_until: Dict[str, float] = {}
+        self._tickets = itertools.count()
+
+    def _prune(self, model: str, now: float) -> deque:
+        entries = self._entries.setdefault(model, deque())
+        while entries and entries[0][0] <= now - WINDOW_SECONDS:
+            entries.popleft()
+        return entries
+
+    def reserve(self, model: str, tokens: int, timeout: float) -> Reservation:
+        limits = quota_for(model)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            ticket = next(self._tickets)
+            queue = self._queues.setdefault(model, deque())
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.time()
+                    entries = self._prune(model, now)
+                    used_tokens = sum(entry[1] for entry in entries)
+                    blocked_until = self._blocked_until.get(model, 0.0)
+                    fits = (
+                        len(entries) < limits["rpm"]
+                        # A single call larger than the whole budget still runs on an empty window
+                        and (used_tokens + tokens <= limits["tpm"] or not entries)
+                    )
+                    if queue[0] == ticket and now >= blocked_until and fits:
+                        entry = [now, tokens]
+                        entries.append(entry)
+                        return Reservation(model, tokens, entry)
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QuotaExhaustedError(f"quota ledger: no capacity for {model} within {timeout:g}s")
+                    # Wake up when the oldest entry leaves the window or the block ends
+                    wake = blocked_until - now if now < blocked_until else (
+                        entries[0][0] + WINDOW_SECONDS - now if entries else 0.5
+                    )
+                    self._cond.wait(min(max(wake, 0.05), remaining))
+            finally:
+                queue.remove(ticket)
+                self._cond.notify_all()
+
+    def settle(self, reservation: Reservation, actual_tokens: int) -> None:
+        with self._cond:
+            reservation.entry_id[1] = actual_tokens
+            self._cond.notify_all()
+
+    def block(self, model: str, seconds: float) -> None:
+        with self._cond:
+            until = time.time() + seconds
+            self._blocked_until[model] = max(self._blocked_until.get(model, 0.0), until)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._cond:
+            now = time.time()
+            models = set(self._entries) | set(self._queues)
+            return {
+                model: {
+                    "requests": len(self._prune(model, now)),
+                    "tokens": sum(entry[1] for entry in self._entries.get(model, ())),
+                    "waiting": len(self._queues.get(model, ())),
+                    "blocked_for": max(0.0, self._blocked_until.get(model, 0.0) - now),
+                }
+                for model in models
+            }
+
+
+class _SQLiteBackend:
+    """Cross-process ledger in a local SQLite file; the waiters table keeps the queue FIFO."""
+
+    POLL_SECONDS = 0.25
+    # Waiters whose process died stop heartbeating and are dropped after this
+    STALE_WAITER_SECONDS = 30.0
+
+    def __init__(self, path: str):
+        self.path = path
+        metrics.watch_file("quota_db", path)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY, model TEXT, ts REAL, tokens INTEGER);
+                CREATE INDEX IF NOT EXISTS usage_model_ts ON usage (model, ts);
+                CREATE TABLE IF NOT EXISTS waiters (id INTEGER PRIMARY KEY, model TEXT, heartbeat REAL);
+                CREATE TABLE IF NOT EXISTS blocks (model TEXT PRIMARY KEY, until REAL);
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per call: sqlite3 connections must not be shared across threads
+        conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def reserve(self, model: str, tokens: int, timeout: float) -> Reservation:
+        limits = quota_for(model)
+        deadline = time.monotonic() + timeout
+        conn = self._connect()
+        try:
+            waiter_id = conn.execute(
+                "INSERT INTO waiters (model, heartbeat) VALUES (?, ?)", (model, time.time())
+            ).lastrowid
+            while True:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("DELETE FROM usage WHERE ts <= ?", (now - WINDOW_SECONDS,))
+                    conn.execute("DELETE FROM waiters WHERE heartbeat < ?", (now - self.STALE_WAITER_SECONDS,))
+                    conn.execute("UPDATE waiters SET heartbeat = ? WHERE id = ?", (now, waiter_id))
+                    head = conn.execute("SELECT MIN(id) FROM waiters WHERE model = ?", (model,)).fetchone()[0]
+                    count, used_tokens = conn.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM usage WHERE model = ?", (model,)
+                    ).fetchone()
+                    blocked = conn.execute("SELECT until FROM blocks WHERE model = ?", (model,)).fetchone()
+                    blocked_until = blocked[0] if blocked else 0.0
+                    fits = count < limits["rpm"] and (used_tokens + tokens <= limits["tpm"] or count == 0)
+                    if head == waiter_id and now >= blocked_until and fits:
+                        entry_id = conn.execute(
+                            "INSERT INTO usage (model, ts, tokens) VALUES (?, ?, ?)", (model, now, tokens)
+                        ).lastrowid
+                        conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+                        conn.execute("COMMIT")
+                        return Reservation(model, tokens, entry_id)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+                if time.monotonic() >= deadline:
+                    conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+                    raise QuotaExhaustedError(f"quota ledger: no capacity for {model} within {timeout:g}s")
+                time.sleep(self.POLL_SECONDS)
+        finally:
+            conn.close()
+
+    def settle(self, reservation: Reservation, actual_tokens: int) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE usage SET tokens = ? WHERE id = ?", (actual_tokens, reservation.entry_id))
+
+    def block(self, model: str, seconds: float) -> None:
+        until = time.time() + seconds
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO blocks (model, until) VALUES (?, ?) "
+                "ON CONFLICT(model) DO UPDATE SET until = MAX(until, excluded.until)",
+                (model, until),
+            )
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        now = time.time()
+        with self._connect() as conn:
+            usage = conn.execute(
+                "SELECT model, COUNT(*), COALESCE(SUM(tokens), 0) FROM usage WHERE ts > ? GROUP BY model",
+                (now - WINDOW_SECONDS,),
+            ).fetchall()
+            waiting = dict(conn.execute("SELECT model, COUNT(*) FROM waiters GROUP BY model").fetchall())
+            blocks = dict(conn.execute("SELECT model, until FROM blocks").fetchall())
+        result = {}
+        for model, count, tokens in usage:
+            result[model] = {"requests": count, "tokens": tokens, "waiting": 0, "blocked_for": 0.0}
+        for model in set(waiting) | set(blocks):
+            stats = result.setdefault(model, {"requests": 0, "tokens": 0, "waiting": 0, "blocked_for": 0.0})
+            stats["waiting"] = waiting.get(model, 0)
+            stats["blocked_for"] = max(0.0, blocks.get(model, 0.0) - now)
+        return result
+
+
+class QuotaLedger:
+    """
+    Reserve-before-call ledger shared by every caller in the process.
+
+    Usage:
+        reservation = ledger.reserve(model_id, estimate_tokens(contents, config))
+        response = client.models.generate_content(...)
+        ledger.settle(reservation, response.usage_metadata.total_token_count)
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self._backend = _SQLiteBackend(db_path) if db_path else _MemoryBackend()
+
+    def reserve(self, model: str, tokens: int, timeout: float = DEFAULT_RESERVE_TIMEOUT) -> Reservation:
+        """
+        Block until the model's per-minute budget has room, in arrival order.
+
+        Raises:
+            QuotaExhaustedError: if no capacity became free within timeout
+        """
+        return self._backend.reserve(model, max(int(tokens), 0), timeout)
+
+    def settle(self, reservation: Reservation, actual_tokens: Optional[int]) -> None:
+        """Replace the estimate with the real token count once the response arrived."""
+        if actual_tokens is not None:
+            self._backend.settle(reservation, int(actual_tokens))
+
+    def report_exhausted(self, model: str, retry_after: Optional[float] = None) -> None:
+        """A 429 pauses the model for every caller, not just the one that hit it."""
+        metrics.inc("quota_exhausted_total", {"model": model})
+        self._backend.block(model, retry_after or DEFAULT_EXHAUSTED_BACKOFF)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Per-model {requests, tokens, waiting, blocked_for} for the current window."""
+        return self._backend.snapshot()
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Same heuristic as the app's retry loops."""
+    message = str(error)
+    return "RESOURCE_EXHAUSTED" in message or "429" in message or "quota" in message.lower()
+
+
+_last_call = threading.local()
+
+
+def last_call_window() -> Optional[tuple]:
+    """(start, end) epoch seconds of the current thread's most recent generate_content call (excluding queueing)."""
+    return getattr(_last_call, "window", None)
+
+
+class _QuotaModels:
+    """client.models proxy: generate_content goes through the ledger, the rest passes through."""
+
+    def __init__(self, models, ledger: QuotaLedger):
+        self._models = models
+        self._ledger = ledger
+
+    def generate_content(self, *, model: str, contents, config=None, **kwargs):
+        tokens = estimate_tokens(contents, config)
+        # Per-model budget first (waiting up to DEFAULT_RESERVE_TIMEOUT must not hold a
+        # shared slot), then the priority slot (interactive > synthesis > background)
+        try:
+            reservation = self._ledger.reserve(model, tokens)
+        except QuotaExhaustedError:
+            metrics.inc("model_calls_total", {"provider": VERTEX, "outcome": "quota"})
+            raise
+        scheduler = get_scheduler()
+        try:
+            request = scheduler.acquire(cost=tokens / 1000)
+        except SchedulerBusyError:
+            # The call never ran: give its estimated tokens back to the window
+            self._ledger.settle(reservation, 0)
+            raise
+        try:
+            # A failed call must not leave the previous call's timing behind
+            _last_call.window = None
+            started = time.monotonic()
+            started_at = time.time()
+            try:
+                response = self._models.generate_content(model=model, contents=contents, config=config, **kwargs)
+                _last_call.window = (started_at, started_at + time.monotonic() - started)
+            except Exception as e:
+                if is_quota_error(e):
+                    self._ledger.report_exhausted(model)
+                metrics.record_call(VERTEX, time.monotonic() - started, metrics.error_outcome(e))
+                raise
+            metrics.record_call(VERTEX, time.monotonic() - started)
+        finally:
+            scheduler.release(request)
+        usage = getattr(response, "usage_metadata", None)
+        self._ledger.settle(reservation, getattr(usage, "total_token_count", None) if usage else None)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+
+class QuotaLimitedClient:
+    """Wraps a genai.Client so every generate_content call is scheduled and reserves quota first."""
+
+    def __init__(self, client, ledger: Optional[QuotaLedger] = None):
+        self._client = client
+        self.models = _QuotaModels(client.models, ledger or get_ledger())
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+_ledger: Optional[QuotaLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> QuotaLedger:
+    """Process-wide ledger (SQLite-backed when QUOTA_DB_PATH is set)."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = QuotaLedger(QUOTA_DB_PATH)
+        return _ledger
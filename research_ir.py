@@ -200,6 +200,59 @@ def validate_research_ir(ir: dict) -> tuple[ResearchIR, List[str]]:
     return normalized, warnings
 
 
+# ========================================
+# Incremental Merge (follow-up turns)
+# ========================================
+
+def merge_research_ir(base: ResearchIR, delta: ResearchIR) -> ResearchIR:
+    """
+    Merge a delta IR (from an incremental research pass) into a stored IR.
+
+    Items are de-duplicated by their statement / name / question text.
+    Delta items come later so Phase 2 still sees the base ordering first.
+
+    Args:
+        base: IR stored with the previous turn
+        delta: IR extracted from the delta research memo
+
+    Returns:
+        Merged and normalized ResearchIR
+    """
+    def _key(text) -> str:
+        return "".join(str(text or "").split()).lower()
+
+    def _merge(base_items: list, delta_items: list, field: str) -> list:
+        seen = {_key(item.get(field)) for item in base_items}
+        merged = list(base_items)
+        for item in delta_items:
+            key = _key(item.get(field))
+            if key and key not in seen:
+                seen.add(key)
+                merged.append(item)
+        return merged
+
+    base_meta = base.get("metadata", {})
+    delta_meta = delta.get("metadata", {})
+
+    merged = {
+        "facts": _merge(base.get("facts", []), delta.get("facts", []), "statement"),
+        "options": _merge(base.get("options", []), delta.get("options", []), "name"),
+        "risks": _merge(base.get("risks", []), delta.get("risks", []), "statement"),
+        "unknowns": _merge(base.get("unknowns", []), delta.get("unknowns", []), "question"),
+        "metadata": {
+            "question": delta_meta.get("question") or base_meta.get("question", ""),
+            "language": base_meta.get("language", "ja"),
+            "created_at": datetime.now().isoformat(),
+            "models": list(dict.fromkeys(base_meta.get("models", []) + delta_meta.get("models", []))),
+            "sources_count": int(base_meta.get("sources_count", 0)) + int(delta_meta.get("sources_count", 0)),
+            "search_queries": list(dict.fromkeys(base_meta.get("search_queries", []) + delta_meta.get("search_queries", []))),
+        },
+    }
+
+    normalized, _ = validate_research_ir(merged)
+    return normalized
+
+
 # ========================================
 # Synthesis Prompt Builder
 # ========================================
@@ -0,0 +1,196 @@
+"""
+Phase E: Diff-style Review - Edit Operations Instead of Full Rewrite
+The Phase 3 reviewer returns a small set of edit operations (JSON) that are
+applied locally to the Phase 2 draft, so the review call only pays output
+tokens for the parts it actually changes.
+"""
+
+import json
+import re
+from typing import Dict, Any, Optional
+
+from applog import get_logger
+
+log = get_logger(__name__)
+
+
+# Output-format instruction appended to the Phase 3 reviewer instruction
+REVIEW_PATCH_OUTPUT_INSTRUCTION = """**出力形式（差分レビュー・厳守）**:
+修正版の全文は書かず、初版回答への**編集操作**だけを次の JSON で出力してください（説明文・コードブロック不要）。
+
+{
+  "edits": [
+    {"op": "replace", "find": "初版から一字一句そのまま抜き出した文字列", "text": "置き換え後の文字列"},
+    {"op": "insert", "after": "初版から一字一句そのまま抜き出した文字列（その行の直後に挿入）", "text": "挿入する文字列"},
+    {"op": "append_section", "heading": "見出し", "text": "セクション本文（Markdown）"}
+  ],
+  "confidence": "High (70-90%)"
+}
+
+- "find" / "after" は初版に**そのまま存在する**短い文字列にすること（1〜2文程度）
+- Devil's Advocate は append_section (heading: "🔴 最強の反論") で追加すること
+- 確信度は "confidence" に Very High (90%+) / High (70-90%) / Medium (50-70%) / Low (30-50%) / Very Low (<30%) のいずれかで書くこと
+- 確信度が Medium 以下の場合は append_section (heading: "⚠️ 確信度を上げるために必要なこと") を追加すること
+- 回答の大部分を書き換える必要がある場合は {"rewrite": true} とだけ出力すること
+"""
+
+VALID_OPS = {"replace", "insert", "append_section"}
+
+# Fall back to a full rewrite when the edits touch more than this share of the draft
+MAX_CHANGE_RATIO = 0.5
+
+# Fall back when the reviewer returns an unreasonable number of edits
+MAX_EDITS = 20
+
+# String fields each op needs ("heading" of append_section is optional)
+REQUIRED_FIELDS = {"replace": ("find", "text"), "insert": ("after", "text"), "append_section": ("text",)}
+
+
+def _is_valid_edit(edit: Any) -> bool:
+    """An edit is usable only with a known op and string values for its fields."""
+    if not isinstance(edit, dict) or edit.get("op") not in VALID_OPS:
+        return False
+    if not all(isinstance(edit.get(field), str) for field in REQUIRED_FIELDS[edit["op"]]):
+        return False
+    return edit.get("heading") is None or isinstance(edit["heading"], str)
+
+
+def parse_review_edits(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Parse the reviewer's JSON edit set.
+
+    Args:
+        text: Raw reviewer output
+
+    Returns:
+        Dict with "edits" (valid edits), "malformed" (count of edits dropped for a
+        missing op / non-string field), "confidence" (str) and "rewrite" (bool),
+        or None if unparsable
+    """
+    if not text:
+        return None
+
+    cleaned = re.sub(r'```json\s*|\s*```', '', text.strip())
+    # Tolerate leading / trailing prose around the JSON object
+    start = cleaned.find("{")
+    end = cleaned.rfind("}")
+    if start == -1 or end == -1:
+        return None
+
+    try:
+        data = json.loads(cleaned[start:end + 1])
+    except json.JSONDecodeError as e:
+        log.debug("review edits are not valid JSON", error=str(e))
+        return None
+
+    if not isinstance(data, dict) or ("edits" not in data and "rewrite" not in data):
+        return None
+
+    raw_edits = data.get("edits") or []
+    if not isinstance(raw_edits, list):
+        raw_edits = [raw_edits]
+    edits = [edit for edit in raw_edits if _is_valid_edit(edit)]
+    if len(edits) < len(raw_edits):
+        log.debug("review edits dropped as malformed", count=len(raw_edits) - len(edits))
+
+    return {
+        "edits": edits,
+        "malformed": len(raw_edits) - len(edits),
+        "confidence": str(data.get("confidence") or "").strip(),
+        "rewrite": bool(data.get("rewrite", False)),
+    }
+
+
+def _find_span(draft: str, needle: str) -> int:
+    """Locate needle in draft (exact first, then with surrounding whitespace stripped)."""
+    if not needle:
+        return -1
+    index = draft.find(needle)
+    if index == -1:
+        index = draft.find(needle.strip())
+    return index
+
+
+def apply_review_edits(
+    draft: str,
+    review: Dict[str, Any],
+    max_change_ratio: float = MAX_CHANGE_RATIO
+) -> Dict[str, Any]:
+    """
+    Apply parsed edit operations to the draft.
+
+    Args:
+        draft: Phase 2 draft answer
+        review: Output of parse_review_edits()
+        max_change_ratio: Replaced/inserted characters relative to the draft above which
+            the edit set is considered a rewrite
+
+    Returns:
+        Dict with:
+        - applied: False if the caller should fall back to a full rewrite
+        - text: Patched answer (the draft itself when not applied)
+        - applied_count / failed: Applied edit count and edits whose anchor was not found
+        - reason: Why the edit set was rejected (empty when applied)
+    """
+    result = {"applied": False, "text": draft, "applied_count": 0, "failed": [], "reason": ""}
+
+    if review.get("rewrite"):
+        result["reason"] = "レビューアが全面書き換えを要求"
+        return result
+
+    # A dropped edit would silently lose one of the reviewer's corrections
+    if review.get("malformed"):
+        result["reason"] = f"不正な編集指示 ({review['malformed']}件)"
+        return result
+
+    edits = review.get("edits", [])
+    if len(edits) > MAX_EDITS:
+        result["reason"] = f"編集数が多すぎる ({len(edits)}件)"
+        return result
+
+    in_place = [e for e in edits if e["op"] in ("replace", "insert")]
+    changed_chars = sum(len(e.get("find") or "") + len(e.get("text") or "") for e in in_place)
+    if draft and changed_chars > len(draft) * max_change_ratio:
+        result["reason"] = f"変更量が大きい ({changed_chars}/{len(draft)}文字)"
+        return result
+
+    text = draft
+    appended = []
+    for edit in edits:
+        op = edit["op"]
+        if op == "replace":
+            index = _find_span(text, edit.get("find", ""))
+            if index == -1:
+                result["failed"].append(edit)
+                continue
+            find = edit["find"] if text.startswith(edit["find"], index) else edit["find"].strip()
+            text = text[:index] + edit.get("text", "") + text[index + len(find):]
+        elif op == "insert":
+            index = _find_span(text, edit.get("after", ""))
+            if index == -1:
+                result["failed"].append(edit)
+                continue
+            line_end = text.find("\n", index)
+            if line_end == -1:
+                line_end = len(text)
+            text = text[:line_end] + "\n" + edit.get("text", "") + text[line_end:]
+        else:  # append_section
+            heading = (edit.get("heading") or "").strip()
+            body = edit.get("text", "").strip()
+            appended.append(f"## {heading}\n\n{body}" if heading else body)
+        result["applied_count"] += 1
+
+    # Any anchored edit missing: dropping it would silently lose that correction, so rewrite instead
+    if result["failed"]:
+        result["reason"] = f"編集箇所が見つからない ({len(result['failed'])}/{len(in_place)}件)"
+        result["applied_count"] = 0
+        return result
+
+    if appended:
+        text = text.rstrip() + "\n\n" + "\n\n".join(appended)
+    if review.get("confidence"):
+        text = text.rstrip() + f"\n\n**確信度: {review['confidence']}**"
+
+    result["applied"] = True
+    result["text"] = text
+    return result
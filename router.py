@@ -5,13 +5,197 @@ Analyzes user questions and routes to appropriate pipeline configuration.
 
 import json
 import re
-from typing import Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Optional
 
+import metrics
+from applog import get_logger
+from learned_router import CONFIDENCE_THRESHOLD, predict_pipeline, pipeline_to_classification
 
-def analyze_question_for_routing(
+log = get_logger(__name__)
+
+
+# =========================
+# Rule-based pre-classifier (no LLM call)
+# =========================
+
+# Domains where a wrong answer is costly; a keyword hit alone routes to full verification.
+# Matched as substrings, so keep them specific: ローン is in ドローン, 法的 in 方法的,
+# 副作用 / 診断 are also programming / security terms.
+HIGH_RISK_KEYWORDS = {
+    "medical": ["症状", "薬の副作用", "受診", "診察", "治療", "処方", "服用", "病院", "病気", "妊娠", "持病", "サプリ"],
+    "legal": ["違法", "合法", "訴訟", "弁護士", "契約書", "著作権", "損害賠償", "労働基準", "法的責任", "法的措置", "法律"],
+    "finance": ["投資", "株価", "NISA", "iDeCo", "確定申告", "節税", "利回り", "為替", "仮想通貨", "住宅ローン", "ローン金利", "ローン返済", "借入"],
+}
+
+# X/Twitter & news phrasing (same list as the app's X-search trigger)
+NEWS_KEYWORDS = ["Xで", "Twitter", "ツイッター", "ポスト", "トレンド", "炎上", "バズ", "話題", "速報", "ニュース"]
+
+CHITCHAT_KEYWORDS = [
+    "こんにちは", "こんばんは", "おはよう", "ありがとう", "よろしく", "はじめまして",
+    "おやすみ", "元気", "hello", "thanks",
+]
+
+# Short definition / translation style questions that never need the heavy pipeline
+LIGHT_PATTERNS = [
+    r"とは[？?]?$", r"の意味[はを]?", r"を?英語で", r"を?日本語に", r"翻訳して", r"読み方",
+]
+
+CHITCHAT_MAX_CHARS = 30
+LIGHT_MAX_CHARS = 40
+
+# Lightweight model used for LLM classification
+ROUTING_MODEL_ID = "gemini-2.0-flash-exp"
+
+# Used when the LLM classification fails or does not arrive in time (never cached)
+SAFE_DEFAULT_CLASSIFICATION = {
+    "domain": "general",
+    "complexity": "medium",
+    "risk_level": "medium",
+    "needs_research": True,
+    "needs_cross_check": False,
+    "needs_x_search": False,
+    "notes": "Default (classification not performed)"
+}
+
+
+def _classification(domain: str, complexity: str, risk_level: str, needs_research: bool, notes: str, **flags) -> Dict[str, Any]:
+    return {
+        "domain": domain,
+        "complexity": complexity,
+        "risk_level": risk_level,
+        "needs_research": needs_research,
+        "needs_cross_check": flags.get("needs_cross_check", False),
+        "needs_x_search": flags.get("needs_x_search", False),
+        "notes": notes,
+    }
+
+
+def classify_question_by_rules(user_question: str) -> Optional[Dict[str, Any]]:
+    """
+    Resolve obvious questions locally (like the app's should_use_x_search).
+
+    Args:
+        user_question: User's question text
+
+    Returns:
+        Classification dict (same shape as analyze_question_for_routing), or None
+        when the question is not obvious and the LLM classifier should decide
+    """
+    question = (user_question or "").strip()
+    if not question:
+        return None
+    lowered = question.lower()
+
+    # High-risk domains first: a keyword is enough to justify full verification
+    for domain, keywords in HIGH_RISK_KEYWORDS.items():
+        hits = [kw for kw in keywords if kw.lower() in lowered]
+        if hits:
+            return _classification(
+                domain, "medium", "high", True,
+                f"rule: 高リスクキーワード ({', '.join(hits[:3])})",
+                needs_cross_check=True,
+            )
+
+    if any(kw.lower() in lowered for kw in NEWS_KEYWORDS):
+        return _classification(
+            "news", "medium", "medium", True,
+            "rule: ニュース/トレンド系キーワード",
+            needs_x_search=True,
+        )
+
+    if len(question) <= CHITCHAT_MAX_CHARS and any(kw in lowered for kw in CHITCHAT_KEYWORDS):
+        return _classification("chitchat", "low", "low", False, "rule: 挨拶・雑談")
+
+    if len(question) <= LIGHT_MAX_CHARS and any(re.search(p, question) for p in LIGHT_PATTERNS):
+        return _classification("general", "low", "low", False, "rule: 短い定義・翻訳質問")
+
+    return None
+
+
+# =========================
+# Classification cache (LLM results keyed by normalized prompt)
+# =========================
+
+CLASSIFICATION_CACHE_SIZE = 256
+_classification_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_classification_cache_lock = threading.Lock()
+
+
+def normalize_question(user_question: str) -> str:
+    """Lower-case and strip whitespace / punctuation so trivial variations share a cache entry."""
+    text = (user_question or "").lower()
+    return re.sub(r"[\s、。,.!?！？「」『』（）()\[\]【】:：;；\"'・\-]+", "", text)
+
+
+def classify_question_fast(user_question: str) -> Optional[Dict[str, Any]]:
+    """
+    Classify without an LLM call (rules, then cache, then the learned local router).
+
+    Returns:
+        Classification dict with "source" ("rule" | "cache" | "learned"), or None if the LLM is needed
+    """
+    rule_result = classify_question_by_rules(user_question)
+    if rule_result is not None:
+        return {**rule_result, "source": "rule"}
+
+    key = normalize_question(user_question)
+    with _classification_cache_lock:
+        cached = _classification_cache.get(key)
+        if cached is not None:
+            _classification_cache.move_to_end(key)
+    if cached is not None:
+        metrics.inc("cache_requests_total", {"cache": "classification", "result": "hit"})
+        return {**cached, "source": "cache"}
+    metrics.inc("cache_requests_total", {"cache": "classification", "result": "miss"})
+
+    # Learned router trained on past turns; low-confidence predictions go to the LLM
+    prediction = predict_pipeline(user_question)
+    if prediction is not None and prediction["confidence"] >= CONFIDENCE_THRESHOLD:
+        return {**pipeline_to_classification(prediction), "source": "learned"}
+
+    return None
+
+
+def classify_question(
     client,
     user_question: str,
     user_profile: Optional[Dict] = None
+) -> Dict[str, Any]:
+    """
+    Classify a question with the cheapest source available: rules → cache → learned → LLM.
+
+    Args:
+        client: Gemini client
+        user_question: User's question text
+        user_profile: Optional user profile for context
+
+    Returns:
+        Classification dict with an extra "source" key ("rule" | "cache" | "learned" | "llm")
+    """
+    fast_result = classify_question_fast(user_question)
+    if fast_result is not None:
+        return fast_result
+
+    key = normalize_question(user_question)
+    classification = analyze_question_for_routing(client, user_question, user_profile)
+
+    # Do not cache the safe default returned on errors
+    if not classification.get("notes", "").startswith("Default (classification not performed)"):
+        with _classification_cache_lock:
+            _classification_cache[key] = classification
+            if len(_classification_cache) > CLASSIFICATION_CACHE_SIZE:
+                _classification_cache.popitem(last=False)
+
+    return {**classification, "source": "llm"}
+
+
+def analyze_question_for_routing(
+    client,
+    user_question: str,
+    user_profile: Optional[Dict] = None,
+    on_response: Optional[Callable[[Any], None]] = None,
 ) -> Dict[str, Any]:
     """
     Analyze user question to determine optimal pipeline configuration.
@@ -20,23 +204,16 @@ def analyze_question_for_routing(
         client: Gemini client
         user_question: User's question text
         user_profile: Optional user profile for context
+        on_response: Called with the raw model response (e.g. for billing)
     
     Returns:
         Classification dict with domain, complexity, risk_level, etc.
     """
     try:
         from google.genai import types
-        
+
         # Safe default for fallback
-        safe_default = {
-            "domain": "general",
-            "complexity": "medium",
-            "risk_level": "medium",
-            "needs_research": True,
-            "needs_cross_check": False,
-            "needs_x_search": False,
-            "notes": "Default (classification not performed)"
-        }
+        safe_default = dict(SAFE_DEFAULT_CLASSIFICATION)
         
         # Build analysis prompt
         profile_context = ""
@@ -98,10 +275,12 @@ def analyze_question_for_routing(
         )
         
         response = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
+            model=ROUTING_MODEL_ID,
             contents=[{"role": "user", "parts": [{"text": analysis_prompt}]}],
             config=config
         )
+        if on_response is not None:
+            on_response(response)
         
         # Extract text
         result_text = ""
@@ -112,7 +291,7 @@ def analyze_question_for_routing(
             result_text = "".join([p.text for p in parts if hasattr(p, 'text')])
         
         if not result_text:
-            print("[DEBUG] analyze_question_for_routing: No text in response")
+            log.warning("routing classification returned no text")
             return safe_default
         
         # Remove code blocks if present
@@ -139,16 +318,20 @@ def analyze_question_for_routing(
         if classification["risk_level"] not in valid_risk:
             classification["risk_level"] = "medium"
         
-        print(f"[DEBUG] Question classified: {classification}")
+        log.debug(
+            "question classified",
+            domain=classification["domain"],
+            complexity=classification["complexity"],
+            risk_level=classification["risk_level"],
+            needs_research=classification["needs_research"],
+        )
         return classification
         
     except json.JSONDecodeError as e:
-        print(f"[DEBUG] analyze_question_for_routing: JSON parse error: {e}")
+        log.warning("routing classification is not valid JSON", error=str(e))
         return safe_default
     except Exception as e:
-        print(f"[DEBUG] analyze_question_for_routing: Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.warning("routing classification failed", error=str(e), exc_info=log.debug_enabled())
         return safe_default
 
 
@@ -237,5 +420,5 @@ def route_question_to_pipeline(classification: Dict[str, Any]) -> Dict[str, Any]
         pipeline["use_grok"] = True  # Grok needed for X search
         pipeline["routing_reason"] += " + X検索強化"
     
-    print(f"[DEBUG] Routed to: {pipeline['mode_name']} - {pipeline['routing_reason']}")
+    log.debug("routed", pipeline=pipeline["mode_name"], reason=pipeline["routing_reason"])
     return pipeline
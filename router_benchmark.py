@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Router Benchmark - Offline Evaluation over Historical Sessions
+Replays the user prompts stored in chat_sessions.json through
+route_question_to_pipeline() and compares the estimated cost / latency of the
+pipeline the router would have chosen with the pipeline that actually ran,
+broken down by domain and checked against the stored 👍/👎 ratings.
+
+No API calls are made: turns are classified with the recorded
+routing_classification when present, otherwise with the local rule classifier
+(and a neutral default when the rules do not match).
+
+Usage:
+    python router_benchmark.py [--sessions chat_sessions.json] [--latency-file phase_latency.json] [--json report.json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+from typing import Dict, Any, Optional, List, Tuple
+
+from logic import PRICING, SESSIONS_FILE
+from pricing import price_for
+from providers import CLAUDE_MODEL_ID
+from router import classify_question_by_rules, route_question_to_pipeline
+
+
+# Model used for the Gemini phases when the turn does not record one
+DEFAULT_MODEL = "gemini-3-pro-preview"
+
+# Fan-out models billed outside the Gemini phases (Grok / o4-mini run on free tiers)
+FAN_OUT_PRICING = {
+    "claude": price_for(CLAUDE_MODEL_ID),
+}
+
+# Typical token counts and latency (seconds) per phase
+PHASE_ESTIMATES = {
+    "light":     {"input": 1000,  "output": 1500, "latency": 12.0},
+    "phase1":    {"input": 2000,  "output": 3000, "latency": 25.0},
+    "phase1_3":  {"input": 4000,  "output": 1000, "latency": 8.0},
+    "phase1_5a": {"input": 4000,  "output": 800,  "latency": 10.0},
+    "phase1_5":  {"input": 5000,  "output": 2000, "latency": 30.0, "billing": "claude"},
+    "phase2":    {"input": 8000,  "output": 3000, "latency": 40.0},
+    "phase3":    {"input": 11000, "output": 1500, "latency": 30.0},
+}
+
+PIPELINE_PHASES = {
+    "light": ["light"],
+    "research": ["phase1", "phase1_3", "phase2"],
+    "research_meta": ["phase1", "phase1_3", "phase1_5a", "phase1_5", "phase2"],
+    "full_verify": ["phase1", "phase1_3", "phase1_5a", "phase1_5", "phase2", "phase3"],
+}
+
+# Heavier pipelines rank higher; used to label downgrades / upgrades
+PIPELINE_RANK = {"light": 0, "research": 1, "research_meta": 2, "full_verify": 3}
+
+# Minimum measured turns before a pipeline's median latency replaces the phase estimate
+MIN_LATENCY_SAMPLES = 3
+
+# Classification used when neither a recorded nor a rule classification exists
+NEUTRAL_CLASSIFICATION = {
+    "domain": "general",
+    "complexity": "medium",
+    "risk_level": "medium",
+    "needs_research": True,
+    "needs_cross_check": False,
+    "needs_x_search": False,
+    "notes": "benchmark: neutral default",
+}
+
+
+def estimate_pipeline_cost(pipeline: str, model_id: str = DEFAULT_MODEL) -> float:
+    """
+    Estimate the USD cost of one run of a pipeline from PHASE_ESTIMATES.
+
+    Args:
+        pipeline: Key of PIPELINE_PHASES
+        model_id: Gemini model used for the Gemini phases
+
+    Returns:
+        Estimated cost in USD
+    """
+    gemini_price = PRICING.get(model_id, PRICING[DEFAULT_MODEL])
+    cost = 0.0
+    for phase in PIPELINE_PHASES[pipeline]:
+        estimate = PHASE_ESTIMATES[phase]
+        price = FAN_OUT_PRICING.get(estimate.get("billing"), gemini_price)
+        cost += estimate["input"] / 1_000_000 * price["input"]
+        cost += estimate["output"] / 1_000_000 * price["output"]
+    return cost
+
+
+def estimate_pipeline_latency(pipeline: str, phase_latency: Optional[Dict[str, float]] = None) -> float:
+    """Sum of per-phase latencies (phase_latency overrides the defaults)."""
+    phase_latency = phase_latency or {}
+    return sum(
+        phase_latency.get(phase, PHASE_ESTIMATES[phase]["latency"])
+        for phase in PIPELINE_PHASES[pipeline]
+    )
+
+
+def infer_actual_pipeline(message: Dict[str, Any]) -> Optional[str]:
+    """
+    Reconstruct which pipeline produced a stored answer from its Deep Log.
+
+    Returns:
+        Key of PIPELINE_PHASES, or None for turns without reasoning_logs
+    """
+    logs = message.get("reasoning_logs")
+    if not logs:
+        return None
+
+    routed = logs.get("routing_pipeline") or {}
+    if routed.get("mode_name") in PIPELINE_PHASES:
+        return routed["mode_name"]
+
+    if not logs.get("phase1_research"):
+        return "light"
+    fan_out = any(logs.get(key) for key in (
+        "phase1_5_meta_questions", "phase1_5b_secondary", "phase1_5d_claude", "phase1_5e_o4mini"
+    ))
+    reviewed = bool(logs.get("phase3_patch")) or "最強の反論" in (message.get("content") or "")
+    if fan_out and reviewed:
+        return "full_verify"
+    if fan_out:
+        return "research_meta"
+    return "research"
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def extract_turns(sessions: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Pair every user prompt with the model answer that followed it.
+
+    metadata.cost is the running session cost, so the per-turn cost is the
+    difference to the previous answer of the same session.
+
+    Returns:
+        Tuple of (turns, skipped) where skipped counts answers without a Deep Log
+    """
+    turns = []
+    skipped = 0
+    for session in sessions:
+        messages = session.get("messages", [])
+        previous_cost = 0.0
+        for i, message in enumerate(messages):
+            if message.get("role") != "model" or i == 0:
+                continue
+            user_message = messages[i - 1]
+            if user_message.get("role") != "user":
+                continue
+
+            metadata = message.get("metadata") or {}
+            running_cost = float(metadata.get("cost") or 0.0)
+            turn_cost = running_cost - previous_cost if running_cost >= previous_cost else running_cost
+            previous_cost = running_cost
+
+            actual = infer_actual_pipeline(message)
+            if actual is None or message.get("error"):
+                skipped += 1
+                continue
+
+            started = _parse_timestamp(user_message.get("timestamp"))
+            finished = _parse_timestamp(message.get("timestamp"))
+            latency = None
+            if started and finished and finished >= started:
+                latency = (finished - started).total_seconds()
+
+            turns.append({
+                "prompt": user_message.get("content", ""),
+                "model": metadata.get("model") or DEFAULT_MODEL,
+                "actual_pipeline": actual,
+                "actual_cost": turn_cost,
+                "actual_latency": latency,
+                "rating": message.get("rating"),
+                "recorded_classification": (message.get("reasoning_logs") or {}).get("routing_classification"),
+            })
+    return turns, skipped
+
+
+def classify_offline(turn: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    """Recorded classification → rule classifier → neutral default."""
+    if turn["recorded_classification"]:
+        return turn["recorded_classification"], "recorded"
+    rule_result = classify_question_by_rules(turn["prompt"])
+    if rule_result is not None:
+        return rule_result, "rule"
+    return dict(NEUTRAL_CLASSIFICATION), "default"
+
+
+def measured_pipeline_latency(turns: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Median measured end-to-end latency per actual pipeline (enough samples only)."""
+    samples: Dict[str, List[float]] = {}
+    for turn in turns:
+        if turn["actual_latency"] is not None:
+            samples.setdefault(turn["actual_pipeline"], []).append(turn["actual_latency"])
+    return {
+        pipeline: statistics.median(values)
+        for pipeline, values in samples.items()
+        if len(values) >= MIN_LATENCY_SAMPLES
+    }
+
+
+def run_benchmark(
+    sessions: List[Dict[str, Any]],
+    phase_latency: Optional[Dict[str, float]] = None
+) -> Dict[str, Any]:
+    """
+    Compare routed vs actual pipelines for every stored turn.
+
+    Args:
+        sessions: "sessions" list of chat_sessions.json
+        phase_latency: Optional measured per-phase latency (seconds) overriding PHASE_ESTIMATES
+
+    Returns:
+        Report dict with "summary", "domains" and "turns"
+    """
+    turns, skipped = extract_turns(sessions)
+    measured = measured_pipeline_latency(turns)
+
+    def pipeline_latency(pipeline: str) -> float:
+        if pipeline in measured:
+            return measured[pipeline]
+        return estimate_pipeline_latency(pipeline, phase_latency)
+
+    domains: Dict[str, Dict[str, Any]] = {}
+    sources = {"recorded": 0, "rule": 0, "default": 0}
+    for turn in turns:
+        classification, source = classify_offline(turn)
+        sources[source] += 1
+        routed = route_question_to_pipeline(classification)["mode_name"]
+        if routed not in PIPELINE_PHASES:
+            routed = "research"
+
+        # Stored cost when recorded, otherwise the same estimate used for the routed side
+        actual_cost = turn["actual_cost"] or estimate_pipeline_cost(turn["actual_pipeline"], turn["model"])
+        actual_latency = turn["actual_latency"] if turn["actual_latency"] is not None else pipeline_latency(turn["actual_pipeline"])
+        if routed == turn["actual_pipeline"]:
+            # Same pipeline: compare like with like instead of measured vs estimated
+            routed_cost, routed_latency = actual_cost, actual_latency
+        else:
+            routed_cost = estimate_pipeline_cost(routed, turn["model"])
+            routed_latency = pipeline_latency(routed)
+
+        turn.update({
+            "domain": classification.get("domain", "general"),
+            "classification_source": source,
+            "routed_pipeline": routed,
+            "actual_cost": actual_cost,
+            "routed_cost": routed_cost,
+            "actual_latency": actual_latency,
+            "routed_latency": routed_latency,
+        })
+
+        stats = domains.setdefault(turn["domain"], {
+            "turns": 0, "actual_cost": 0.0, "routed_cost": 0.0,
+            "actual_latency": 0.0, "routed_latency": 0.0,
+            "downgrades": 0, "upgrades": 0,
+            "downgraded_liked": 0, "upgraded_disliked": 0, "unchanged_disliked": 0,
+        })
+        stats["turns"] += 1
+        stats["actual_cost"] += actual_cost
+        stats["routed_cost"] += routed_cost
+        stats["actual_latency"] += actual_latency
+        stats["routed_latency"] += routed_latency
+
+        delta = PIPELINE_RANK[routed] - PIPELINE_RANK[turn["actual_pipeline"]]
+        if delta < 0:
+            stats["downgrades"] += 1
+            # Regression risk: the heavier pipeline produced an answer the user liked
+            if turn["rating"] == 1:
+                stats["downgraded_liked"] += 1
+        elif delta > 0:
+            stats["upgrades"] += 1
+            # Potential fix: the answer was disliked and the router would spend more
+            if turn["rating"] == -1:
+                stats["upgraded_disliked"] += 1
+        elif turn["rating"] == -1:
+            stats["unchanged_disliked"] += 1
+
+    for stats in domains.values():
+        stats["savings"] = stats["actual_cost"] - stats["routed_cost"]
+        stats["latency_saved"] = stats["actual_latency"] - stats["routed_latency"]
+
+    summary = {
+        "turns": len(turns),
+        "skipped": skipped,
+        "classification_sources": sources,
+        "measured_latency": measured,
+        "actual_cost": sum(s["actual_cost"] for s in domains.values()),
+        "routed_cost": sum(s["routed_cost"] for s in domains.values()),
+        "downgraded_liked": sum(s["downgraded_liked"] for s in domains.values()),
+        "upgraded_disliked": sum(s["upgraded_disliked"] for s in domains.values()),
+    }
+    summary["savings"] = summary["actual_cost"] - summary["routed_cost"]
+    return {"summary": summary, "domains": domains, "turns": turns}
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """Plain-text table for the terminal."""
+    summary = report["summary"]
+    lines = [
+        f"Turns: {summary['turns']} (skipped without Deep Log: {summary['skipped']})",
+        f"Classification: {summary['classification_sources']}",
+        f"Measured pipeline latency (median s): {({k: round(v, 1) for k, v in summary['measured_latency'].items()})}",
+        "",
+        f"{'domain':<12}{'turns':>6}{'actual $':>11}{'routed $':>11}{'saved $':>10}{'saved s':>10}"
+        f"{'down':>6}{'up':>5}{'down👍':>8}{'up👎':>7}{'same👎':>8}",
+    ]
+    for domain, s in sorted(report["domains"].items(), key=lambda item: -item[1]["savings"]):
+        lines.append(
+            f"{domain:<12}{s['turns']:>6}{s['actual_cost']:>11.4f}{s['routed_cost']:>11.4f}"
+            f"{s['savings']:>10.4f}{s['latency_saved']:>10.1f}{s['downgrades']:>6}{s['upgrades']:>5}"
+            f"{s['downgraded_liked']:>8}{s['upgraded_disliked']:>7}{s['unchanged_disliked']:>8}"
+        )
+    lines += [
+        "",
+        f"Total: actual ${summary['actual_cost']:.4f} → routed ${summary['routed_cost']:.4f} "
+        f"(saved ${summary['savings']:.4f})",
+        f"Regression risk (👍 answers the router would downgrade): {summary['downgraded_liked']}",
+        f"Potential fixes (👎 answers the router would upgrade): {summary['upgraded_disliked']}",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline router benchmark over chat_sessions.json")
+    parser.add_argument("--sessions", default=SESSIONS_FILE, help="Path to chat_sessions.json")
+    parser.add_argument("--latency-file", help="JSON {phase: seconds} with measured per-phase latency")
+    parser.add_argument("--json", dest="json_path", help="Write the full report (including per-turn rows) as JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.sessions):
+        parser.error(f"{args.sessions} not found")
+    with open(args.sessions, "r", encoding="utf-8") as f:
+        sessions = json.load(f).get("sessions", [])
+
+    phase_latency = None
+    if args.latency_file:
+        with open(args.latency_file, "r", encoding="utf-8") as f:
+            phase_latency = json.load(f)
+
+    report = run_benchmark(sessions, phase_latency)
+    print(format_report(report))
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"✅ Report written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Phase I: Priority Scheduler for Model Calls
+Sits in front of every model call (Gemini via quota.QuotaLimitedClient, the
+other providers via @scheduled) and hands out
+a bounded number of concurrent call slots with weighted fair queuing across
+priority classes:
+
+    interactive (β1 / light answers) > synthesis (pipeline phases) > background
+    (profile updates, follow-up suggestions, recommendations)
+
+A model call cannot be interrupted once it is on the wire, so background work
+is preempted at call boundaries: queued background calls are held back while
+higher-priority calls wait, only a share of the slots may run background work,
+and a background call that cannot get a slot in time is dropped.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import time
+import functools
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, Optional
+
+
+INTERACTIVE = "interactive"
+SYNTHESIS = "synthesis"
+BACKGROUND = "background"
+
+# WFQ weights: share of slots each class gets when all classes are backlogged
+CLASS_WEIGHTS = {INTERACTIVE: 8.0, SYNTHESIS: 3.0, BACKGROUND: 1.0}
+
+MAX_CONCURRENT_CALLS = int(os.getenv("MAX_CONCURRENT_MODEL_CALLS", "8"))
+
+# Slots background work may occupy at most (the rest stay free for user-facing calls)
+MAX_BACKGROUND_CALLS = max(1, MAX_CONCURRENT_CALLS // 4)
+
+# Background calls give up (and are skipped by the caller) after this wait
+BACKGROUND_WAIT_TIMEOUT = 20.0
+
+_current_priority: contextvars.ContextVar = contextvars.ContextVar("model_call_priority", default=SYNTHESIS)
+
+
+class SchedulerBusyError(Exception):
+    """Raised when a background call could not get a slot in time."""
+
+
+def set_priority(priority: str) -> contextvars.Token:
+    """Set the priority class for model calls made from the current thread / context."""
+    return _current_priority.set(priority)
+
+
+def reset_priority(token: contextvars.Token) -> None:
+    _current_priority.reset(token)
+
+
+def current_priority() -> str:
+    return _current_priority.get()
+
+
+@contextmanager
+def call_priority(priority: str):
+    """Run a block of model calls under a priority class."""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+@dataclass
+class _Request:
+    priority: str
+    start_tag: float
+    finish_tag: float
+    seq: int
+    granted: bool = False
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class PriorityScheduler:
+    """
+    Weighted fair queuing over a fixed number of call slots.
+
+    Each request gets a virtual finish tag (start + cost / weight); the waiting
+    request with the smallest tag runs next, so a class with weight 8 gets about
+    8x the throughput of a weight-1 class under contention, and an idle class
+    does not bank credit.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_CALLS, max_background: int = MAX_BACKGROUND_CALLS):
+        self.max_concurrent = max_concurrent
+        self.max_background = max_background
+        self._cond = threading.Condition()
+        self._waiting: list = []
+        self._running: Dict[str, int] = {INTERACTIVE: 0, SYNTHESIS: 0, BACKGROUND: 0}
+        self._last_finish: Dict[str, float] = {INTERACTIVE: 0.0, SYNTHESIS: 0.0, BACKGROUND: 0.0}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._completed: Dict[str, int] = {INTERACTIVE: 0, SYNTHESIS: 0, BACKGROUND: 0}
+        self._wait_seconds: Dict[str, float] = {INTERACTIVE: 0.0, SYNTHESIS: 0.0, BACKGROUND: 0.0}
+        self._dropped = 0
+
+    def _eligible(self, request: _Request) -> bool:
+        if request.priority != BACKGROUND:
+            return True
+        # Background yields to any waiting user-facing call and never fills every slot
+        if any(r.priority != BACKGROUND for r in self._waiting):
+            return False
+        return self._running[BACKGROUND] < self.max_background
+
+    def _dispatch(self) -> None:
+        """Grant free slots to the eligible waiters with the smallest finish tags."""
+        while sum(self._running.values()) < self.max_concurrent:
+            candidates = [r for r in self._waiting if not r.granted and self._eligible(r)]
+            if not candidates:
+                return
+            request = min(candidates, key=lambda r: (r.finish_tag, r.seq))
+            request.granted = True
+            self._waiting.remove(request)
+            self._running[request.priority] += 1
+            # Start-time fair queuing: virtual time follows the start tag of the request in service
+            self._virtual_time = max(self._virtual_time, request.start_tag)
+            self._cond.notify_all()
+
+    def acquire(self, priority: Optional[str] = None, cost: float = 1.0, timeout: Optional[float] = None) -> _Request:
+        """
+        Wait for a call slot.
+
+        Args:
+            priority: Priority class (defaults to the context's current_priority())
+            cost: Work estimate (e.g. tokens / 1000) used for the fair share
+            timeout: Max wait; background calls default to BACKGROUND_WAIT_TIMEOUT
+
+        Raises:
+            SchedulerBusyError: if no slot was granted within timeout
+        """
+        priority = priority or current_priority()
+        if priority not in CLASS_WEIGHTS:
+            priority = SYNTHESIS
+        if timeout is None and priority == BACKGROUND:
+            timeout = BACKGROUND_WAIT_TIMEOUT
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            start = max(self._virtual_time, self._last_finish[priority])
+            finish_tag = start + max(cost, 0.001) / CLASS_WEIGHTS[priority]
+            self._last_finish[priority] = finish_tag
+            request = _Request(priority, start, finish_tag, next(self._seq))
+            self._waiting.append(request)
+            self._dispatch()
+
+            while not request.granted:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiting.remove(request)
+                    self._dropped += 1
+                    self._dispatch()
+                    raise SchedulerBusyError(f"scheduler: no slot for {priority} call within {timeout:g}s")
+                self._cond.wait(remaining)
+
+            self._wait_seconds[priority] += time.monotonic() - request.enqueued_at
+            return request
+
+    def release(self, request: _Request) -> None:
+        with self._cond:
+            self._running[request.priority] -= 1
+            self._completed[request.priority] += 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority: Optional[str] = None, cost: float = 1.0, timeout: Optional[float] = None):
+        request = self.acquire(priority, cost, timeout)
+        try:
+            yield request
+        finally:
+            self.release(request)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Running / waiting counts and mean queue wait per class."""
+        with self._cond:
+            waiting = {p: 0 for p in CLASS_WEIGHTS}
+            for request in self._waiting:
+                waiting[request.priority] += 1
+            return {
+                "running": dict(self._running),
+                "waiting": waiting,
+                "completed": dict(self._completed),
+                "mean_wait_seconds": {
+                    p: (self._wait_seconds[p] / self._completed[p]) if self._completed[p] else 0.0
+                    for p in CLASS_WEIGHTS
+                },
+                "dropped_background": self._dropped,
+            }
+
+
+_scheduler: Optional[PriorityScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> PriorityScheduler:
+    """Process-wide scheduler shared by every browser session."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PriorityScheduler()
+        return _scheduler
+
+
+def scheduled(fn: Callable) -> Callable:
+    """
+    Decorator for provider calls outside QuotaLimitedClient (OpenRouter / Bedrock /
+    GitHub Models): run each call in a slot of the caller's priority class.
+
+    The slot cost is the prompt size in the same units quota.estimate_tokens
+    uses (two characters per token, per 1000 tokens).
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        chars = sum(len(value) for value in (*args, *kwargs.values()) if isinstance(value, str))
+        with get_scheduler().slot(cost=max(chars // 2, 1) / 1000):
+            return fn(*args, **kwargs)
+    return wrapper
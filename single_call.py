@@ -5,24 +5,27 @@ from typing import List, Tuple
 from google import genai
 from google.genai import types
 
-MODEL_ID = "gemini-3-pro-preview"
+from pricing import gemini_usage, usage_cost
 
-# Vertex のだいたいの料金（短コンテキスト用）
-INPUT_PRICE_PER_M = 2.0   # USD / 1M tokens
-OUTPUT_PRICE_PER_M = 12.0 # USD / 1M tokens
+MODEL_ID = "gemini-3-pro-preview"
 
 
 @dataclass
 class Usage:
     prompt_tokens: int = 0
     output_tokens: int = 0
+    thinking_tokens: int = 0
+    cached_tokens: int = 0
 
     @property
     def cost_usd(self) -> float:
-        return (
-            self.prompt_tokens / 1_000_000 * INPUT_PRICE_PER_M
-            + self.output_tokens / 1_000_000 * OUTPUT_PRICE_PER_M
-        )
+        # 料金は pricing.py の料金表（思考トークンは出力単価、キャッシュヒットは割引単価）
+        return usage_cost(MODEL_ID, {
+            "input_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "thinking_tokens": self.thinking_tokens,
+            "cached_tokens": self.cached_tokens,
+        })
 
 
 class Gemini3Client:
@@ -36,15 +39,17 @@ class Gemini3Client:
         self.total_usage = Usage()
 
     def _update_usage(self, response) -> Usage:
-        um = response.usage_metadata
-        if not um:
-            return Usage()
+        counts = gemini_usage(response)
         usage = Usage(
-            prompt_tokens=um.prompt_token_count or 0,
-            output_tokens=um.candidates_token_count or 0,
+            prompt_tokens=counts["input_tokens"],
+            output_tokens=counts["output_tokens"],
+            thinking_tokens=counts["thinking_tokens"],
+            cached_tokens=counts["cached_tokens"],
         )
         self.total_usage.prompt_tokens += usage.prompt_tokens
         self.total_usage.output_tokens += usage.output_tokens
+        self.total_usage.thinking_tokens += usage.thinking_tokens
+        self.total_usage.cached_tokens += usage.cached_tokens
         return usage
 
     def generate_candidates(
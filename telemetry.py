@@ -0,0 +1,203 @@
+"""
+Phase P: Telemetry Spans
+Per-phase and per-call timing for one answer: start / end (seconds from the
+start of the turn), tokens, retries, provider and status. run_pipeline()
+records a span for every phase and model call, the trace is stored with the
+message in reasoning_logs["telemetry"], and the Deep Log draws it as a
+waterfall so it is visible where the minutes of a 本気MAX run go.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List
+
+import metrics
+from applog import bind_context
+from usage_ledger import provider_for_model
+
+
+PHASE = "phase"
+CALL = "call"
+
+
+class Trace:
+    """
+    Spans of one turn, appended from the pipeline thread and the Phase 1.5 workers.
+
+    Usage:
+        trace = Trace()
+        span = trace.start("phase2", model="gemini-3-pro-preview")
+        ...
+        trace.end(span, retries=1)
+
+        with trace.span("suggestions", kind=CALL, model="gemini-2.5-flash") as span:
+            span["output_tokens"] = ...
+    """
+
+    def __init__(self, started_at: Optional[float] = None, spans: Optional[List[Dict[str, Any]]] = None):
+        self.started_at = started_at or time.time()
+        self.spans: List[Dict[str, Any]] = list(spans or [])
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "Trace":
+        """Continue a stored trace (e.g. across a cascade escalation); None starts a new one."""
+        if not data:
+            return cls()
+        return cls(data.get("started_at"), data.get("spans"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"started_at": self.started_at, "spans": [dict(span) for span in self.spans]}
+
+    def _offset(self, timestamp: float) -> float:
+        return round(timestamp - self.started_at, 3)
+
+    def start(self, name: str, kind: str = PHASE, model: Optional[str] = None, provider: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Open a span; it is listed immediately and closed by end().
+
+        Args:
+            name: Phase or call name (e.g. "phase1", "phase1_5d", "suggestions")
+            kind: PHASE (wall time of a pipeline step) or CALL (one model call)
+            model: Model id (optional)
+            provider: Provider (default: derived from the model id)
+
+        Returns:
+            The span dict (tokens / retries may be filled in before end())
+        """
+        span = {
+            "name": name,
+            "kind": kind,
+            "model": model,
+            "provider": provider or (provider_for_model(model) if model else None),
+            "start": self._offset(time.time()),
+            "end": None,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "retries": 0,
+            "status": "running",
+        }
+        with self._lock:
+            self.spans.append(span)
+        if kind == PHASE:
+            # Log records carry the phase, so they join with this span
+            bind_context(phase=name)
+        return span
+
+    def end(self, span: Dict[str, Any], status: str = "ok", **fields) -> None:
+        """Close a span; fields (input_tokens, output_tokens, retries, error) overwrite its values."""
+        with self._lock:
+            span.update(fields)
+            span["end"] = self._offset(time.time())
+            span["status"] = status
+        if span["kind"] == PHASE:
+            _export_phase(span)
+
+    @contextmanager
+    def span(self, name: str, kind: str = PHASE, model: Optional[str] = None, provider: Optional[str] = None):
+        """start() / end() around a block; an exception closes the span as "error" and propagates."""
+        span = self.start(name, kind, model, provider)
+        try:
+            yield span
+        except Exception as e:
+            self.end(span, "error", error=str(e)[:200])
+            raise
+        self.end(span, span["status"] if span["status"] != "running" else "ok")
+
+    def add_call(
+        self,
+        name: str,
+        model: str,
+        input_tokens: Optional[int],
+        output_tokens: Optional[int],
+        window: Optional[tuple],
+        provider: Optional[str] = None
+    ) -> None:
+        """
+        Record a finished model call.
+
+        Args:
+            name: Phase the call billed to
+            model: Model id
+            input_tokens / output_tokens: Token counts (None = 0)
+            window: (start, end) epoch seconds of the call (quota.last_call_window()); None = not recorded
+            provider: Provider (default: derived from the model id)
+        """
+        if not window:
+            return
+        span = {
+            "name": name,
+            "kind": CALL,
+            "model": model,
+            "provider": provider or provider_for_model(model),
+            "start": self._offset(window[0]),
+            "end": self._offset(window[1]),
+            "input_tokens": input_tokens or 0,
+            "output_tokens": output_tokens or 0,
+            "retries": 0,
+            "status": "ok",
+        }
+        with self._lock:
+            self.spans.append(span)
+
+    def close_open(self, status: str = "abandoned") -> None:
+        """Close spans still running when the turn ends (e.g. a Phase 1.5 model past the fan-out timeout)."""
+        now = self._offset(time.time())
+        with self._lock:
+            for span in self.spans:
+                if span["end"] is None:
+                    span["end"] = now
+                    span["status"] = status
+
+
+def _export_phase(span: Dict[str, Any]) -> None:
+    """Phase latency and quota retries for the metrics endpoint (model calls are counted by quota.py / providers.py)."""
+    metrics.observe("phase_seconds", span["end"] - span["start"], {"phase": span["name"]})
+    if span.get("retries"):
+        metrics.inc("quota_retries_total", {"phase": span["name"]}, span["retries"])
+    if span["status"] == "quota_aborted":
+        metrics.inc("quota_aborts_total", {"phase": span["name"]})
+
+
+def waterfall_rows(telemetry: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Spans as chart rows, in start order, with a duration and a label per row.
+
+    Args:
+        telemetry: Trace.to_dict() as stored in reasoning_logs["telemetry"]
+
+    Returns:
+        [{"label", "name", "kind", "provider", "model", "start", "end", "duration", "tokens", "retries", "status"}]
+    """
+    rows = []
+    for index, span in enumerate(sorted((telemetry or {}).get("spans", []), key=lambda s: s["start"])):
+        end = span["end"] if span["end"] is not None else span["start"]
+        label = span["name"] if span["kind"] == PHASE else f"  └ {span['name']} ({span.get('model') or span.get('provider') or '-'})"
+        rows.append({
+            # Index keeps repeated names (retried calls) on separate rows
+            "label": f"{index + 1:02d} {label}",
+            "name": span["name"],
+            "kind": span["kind"],
+            "provider": span.get("provider") or "-",
+            "model": span.get("model") or "-",
+            "start": span["start"],
+            "end": end,
+            "duration": round(end - span["start"], 3),
+            "tokens": (span.get("input_tokens") or 0) + (span.get("output_tokens") or 0),
+            "retries": span.get("retries", 0),
+            "status": span.get("status", "ok"),
+        })
+    return rows
+
+
+def phase_totals(telemetry: Optional[Dict[str, Any]]) -> Dict[str, float]:
+    """Wall seconds per phase span (phase name → seconds), for summaries and benchmarks."""
+    totals: Dict[str, float] = {}
+    for row in waterfall_rows(telemetry):
+        if row["kind"] == PHASE:
+            totals[row["name"]] = round(totals.get(row["name"], 0.0) + row["duration"], 3)
+    return totals
@@ -0,0 +1,296 @@
+"""
+Phase O: Usage Ledger
+Append-only record of every billed model call (timestamp, session, run,
+phase, model, provider, tokens, latency, cost) in SQLite, replacing the
+load-modify-save cycle on usage_stats.json that lost updates when several
+browser sessions, job workers or batch runs saved at the same time.
+
+Running totals (overall / per model / per provider / per day / per session)
+are updated in the same transaction as the insert, so reading the sidebar
+totals is a single-row lookup and concurrent writers never overwrite each
+other.
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import datetime
+import threading
+from typing import Dict, Any, Optional, List
+
+import metrics
+from applog import get_logger
+
+log = get_logger(__name__)
+
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "usage_ledger.db")
+
+# Pre-ledger totals, imported once when the ledger is created
+LEGACY_USAGE_FILE = "usage_stats.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    session_id TEXT,
+    run_id TEXT,
+    phase TEXT NOT NULL,
+    model TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    latency_ms INTEGER,
+    cost REAL NOT NULL,
+    thinking_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS usage_calls_ts ON usage_calls (ts);
+CREATE TABLE IF NOT EXISTS usage_totals (
+    key TEXT PRIMARY KEY,
+    calls INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL
+);
+"""
+
+# Columns added after the first release (ALTER TABLE on ledgers created before them)
+_ADDED_COLUMNS = {
+    "thinking_tokens": "INTEGER NOT NULL DEFAULT 0",
+    "cached_tokens": "INTEGER NOT NULL DEFAULT 0",
+}
+
+_EMPTY_TOTALS = {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0}
+
+
+def provider_for_model(model: str) -> str:
+    """Billing provider of a model id (pricing.MODEL_PRICES first, then the id prefix)."""
+    from pricing import price_for
+    provider = price_for(model).get("provider")
+    if provider:
+        return provider
+    model = (model or "").lower()
+    if model.startswith("gemini"):
+        return "vertex"
+    if "claude" in model or "anthropic" in model:
+        return "bedrock"
+    if model.startswith(("o4", "gpt", "openai/")):
+        return "github_models"
+    return "openrouter"
+
+
+class UsageLedger:
+    """
+    Usage ledger shared by every process that opens the same SQLite file.
+
+    Usage:
+        get_usage_ledger().record("phase2", "gemini-3-pro-preview", 1200, 800, cost, session_id=sid)
+        get_usage_ledger().totals()["cost"]
+    """
+
+    def __init__(self, db_path: str = USAGE_DB_PATH, legacy_file: Optional[str] = LEGACY_USAGE_FILE):
+        self.db_path = db_path
+        self._local = threading.local()
+        metrics.watch_file("usage_db", db_path)
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        self._migrate(conn)
+        if legacy_file:
+            self._import_legacy(legacy_file)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(usage_calls)")}
+        for name, spec in _ADDED_COLUMNS.items():
+            if name not in columns:
+                try:
+                    conn.execute(f"ALTER TABLE usage_calls ADD COLUMN {name} {spec}")
+                except sqlite3.OperationalError:
+                    pass  # Added by another process in the meantime
+
+    def _import_legacy(self, legacy_file: str) -> None:
+        """Carry the usage_stats.json totals over as one record, so the budget check keeps its history."""
+        if not os.path.exists(legacy_file):
+            return
+        # Read first: a failed read must not consume the one-time import
+        try:
+            with open(legacy_file, "r") as f:
+                stats = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning("legacy usage file not imported (will retry on next start)", path=legacy_file, error=str(e))
+            return
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Marker row: exactly one process imports the file, even when several start at once
+            claimed = conn.execute(
+                "INSERT OR IGNORE INTO usage_totals (key, calls, input_tokens, output_tokens, cost) VALUES ('legacy_imported', 0, 0, 0, 0)"
+            ).rowcount
+            if claimed:
+                self._insert_call(
+                    conn, time.time(), None, None, "legacy_usage_stats", "", "legacy",
+                    stats.get("total_input_tokens", 0) or 0, stats.get("total_output_tokens", 0) or 0,
+                    None, stats.get("total_cost_usd", 0.0) or 0.0, 0, 0,
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _insert_call(
+        self, conn: sqlite3.Connection, now: float, session_id: Optional[str], run_id: Optional[str],
+        phase: str, model: str, provider: str, input_tokens: int, output_tokens: int,
+        latency: Optional[float], cost: float, thinking_tokens: int, cached_tokens: int
+    ) -> None:
+        """Insert the call row and bump its running totals (caller owns the transaction)."""
+        day = datetime.date.fromtimestamp(now).isoformat()
+        keys = ["all", f"model:{model}", f"provider:{provider}", f"day:{day}"]
+        if session_id:
+            keys.append(f"session:{session_id}")
+        conn.execute(
+            "INSERT INTO usage_calls (ts, session_id, run_id, phase, model, provider, input_tokens, output_tokens, "
+            "latency_ms, cost, thinking_tokens, cached_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (now, session_id, run_id, phase, model, provider, input_tokens, output_tokens,
+             int(latency * 1000) if latency is not None else None, cost, thinking_tokens, cached_tokens),
+        )
+        conn.executemany(
+            "INSERT INTO usage_totals (key, calls, input_tokens, output_tokens, cost) VALUES (?, 1, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET calls = calls + 1, input_tokens = input_tokens + excluded.input_tokens, "
+            "output_tokens = output_tokens + excluded.output_tokens, cost = cost + excluded.cost",
+            [(key, input_tokens, output_tokens, cost) for key in keys],
+        )
+
+    def record(
+        self,
+        phase: str,
+        model: str,
+        input_tokens: Optional[int],
+        output_tokens: Optional[int],
+        cost: float,
+        session_id: Optional[str] = None,
+        run_id: Optional[str] = None,
+        provider: Optional[str] = None,
+        latency: Optional[float] = None,
+        thinking_tokens: Optional[int] = None,
+        cached_tokens: Optional[int] = None
+    ) -> None:
+        """
+        Append one model call and update the running totals atomically.
+
+        Args:
+            phase: Pipeline phase or app feature (e.g. "phase2", "recommendations")
+            model: Model id
+            input_tokens / output_tokens: Token counts (None = 0)
+            cost: Cost in USD
+            session_id / run_id: Attribution (optional)
+            provider: Billing provider (default: derived from the model id)
+            latency: Call latency in seconds (optional)
+            thinking_tokens / cached_tokens: Thinking output and cache-hit input (call record only)
+        """
+        input_tokens = input_tokens or 0
+        output_tokens = output_tokens or 0
+        provider = provider or provider_for_model(model)
+
+        metrics.inc("tokens_total", {"provider": provider, "kind": "input"}, input_tokens)
+        metrics.inc("tokens_total", {"provider": provider, "kind": "cached"}, cached_tokens or 0)
+        metrics.inc("tokens_total", {"provider": provider, "kind": "output"}, output_tokens)
+        metrics.inc("tokens_total", {"provider": provider, "kind": "thinking"}, thinking_tokens or 0)
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert_call(
+                conn, time.time(), session_id, run_id, phase, model, provider, input_tokens, output_tokens,
+                latency, cost, thinking_tokens or 0, cached_tokens or 0,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def totals(self, key: str = "all") -> Dict[str, Any]:
+        """
+        Running totals for "all", "model:<id>", "provider:<name>", "day:<YYYY-MM-DD>" or "session:<id>".
+
+        Returns:
+            {"calls", "input_tokens", "output_tokens", "cost"}
+        """
+        row = self._connect().execute(
+            "SELECT calls, input_tokens, output_tokens, cost FROM usage_totals WHERE key = ?", (key,)
+        ).fetchone()
+        return dict(row) if row else dict(_EMPTY_TOTALS)
+
+    def breakdown(self, kind: str) -> Dict[str, Dict[str, Any]]:
+        """Totals per model / provider / day / session (kind = "model", "provider", ...)."""
+        rows = self._connect().execute(
+            "SELECT key, calls, input_tokens, output_tokens, cost FROM usage_totals WHERE key LIKE ?", (f"{kind}:%",)
+        ).fetchall()
+        return {row["key"][len(kind) + 1:]: {k: row[k] for k in ("calls", "input_tokens", "output_tokens", "cost")} for row in rows}
+
+    def phase_stats(self, since: Optional[float] = None) -> Dict[tuple, Dict[str, Any]]:
+        """
+        Per (phase, model) averages over the recorded calls, for pre-run estimates.
+
+        Returns:
+            {(phase, model): {"calls", "input_tokens", "output_tokens", "cost", "latency"}}
+            (averages per call; output_tokens includes thinking tokens, which bill as output;
+            latency in seconds, None when no call recorded one)
+        """
+        rows = self._connect().execute(
+            "SELECT phase, model, COUNT(*) AS calls, AVG(input_tokens) AS input_tokens, "
+            "AVG(output_tokens + thinking_tokens) AS output_tokens, "
+            "AVG(cost) AS cost, AVG(latency_ms) AS latency_ms FROM usage_calls WHERE ts >= ? GROUP BY phase, model",
+            (since or 0.0,),
+        ).fetchall()
+        return {
+            (row["phase"], row["model"]): {
+                "calls": row["calls"],
+                "input_tokens": row["input_tokens"],
+                "output_tokens": row["output_tokens"],
+                "cost": row["cost"],
+                "latency": row["latency_ms"] / 1000 if row["latency_ms"] is not None else None,
+            }
+            for row in rows
+        }
+
+    def run_breakdown(self, run_id: str) -> Dict[str, Dict[str, Any]]:
+        """Totals per model of one pipeline run (run_id), for the per-answer cost summary."""
+        rows = self._connect().execute(
+            "SELECT model, provider, COUNT(*) AS calls, SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens, "
+            "SUM(thinking_tokens) AS thinking_tokens, SUM(cached_tokens) AS cached_tokens, SUM(cost) AS cost "
+            "FROM usage_calls WHERE run_id = ? GROUP BY model, provider ORDER BY cost DESC",
+            (run_id,),
+        ).fetchall()
+        return {row["model"]: {k: row[k] for k in row.keys() if k != "model"} for row in rows}
+
+    def calls(self, since: Optional[float] = None, limit: int = 1000) -> List[Dict[str, Any]]:
+        """Most recent call records (newest first)."""
+        rows = self._connect().execute(
+            "SELECT * FROM usage_calls WHERE ts >= ? ORDER BY id DESC LIMIT ?", (since or 0.0, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+_usage_ledger: Optional[UsageLedger] = None
+_usage_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """Process-wide ledger (all processes using USAGE_DB_PATH share the same totals)."""
+    global _usage_ledger
+    with _usage_ledger_lock:
+        if _usage_ledger is None:
+            _usage_ledger = UsageLedger()
+        return _usage_ledger
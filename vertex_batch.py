@@ -0,0 +1,478 @@
+"""
+Phase N: Vertex Batch Prediction
+Offline bulk workloads (batch answering, bulk IR extraction over archived
+research) are submitted as one Vertex AI batch prediction job instead of a
+loop of online generate_content calls: write the requests as JSONL to GCS,
+create the job, poll it, and map the predictions back by key. Batch
+requests are billed at a discount and do not consume the online quota.
+
+LocalBatchEmulator implements the same backend interface on the local
+filesystem (answers come from the online client or a responder function),
+so the batch path can be exercised without GCS.
+
+Usage:
+    python vertex_batch.py extract-ir --limit 200     # add JSON IR to archived research
+
+⚠️ Like logic.py, this module must not import streamlit.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from typing import Dict, Any, Optional, List, Callable, Iterator
+
+from google import genai
+from google.genai import types
+
+from applog import get_logger
+from pricing import BATCH_PRICE_FACTOR, gemini_usage, usage_cost
+from logic import (
+    SESSIONS_FILE, VERTEX_PROJECT, extract_text_from_response,
+    get_client, load_sessions, save_sessions, record_usage
+)
+
+try:
+    from google.cloud import storage
+    HAS_GCS = True
+except ImportError:
+    storage = None
+    HAS_GCS = False
+
+log = get_logger(__name__)
+
+
+# gs:// prefix for batch input / output files (required for the Vertex backend)
+BATCH_GCS_URI = os.getenv("GEMINI_BATCH_GCS_URI", "")
+
+# Batch prediction runs on a regional endpoint (the online client uses "global")
+BATCH_LOCATION = os.getenv("GEMINI_BATCH_LOCATION", "us-central1")
+
+# "vertex" or "local" (emulator)
+BATCH_BACKEND = os.getenv("GEMINI_BATCH_BACKEND", "vertex")
+
+EMULATOR_DIR = os.getenv("BATCH_EMULATOR_DIR", "batch_emulator")
+
+# Seconds between job state checks (Vertex jobs take minutes to hours)
+POLL_INTERVAL = 30.0
+
+SUCCEEDED = "JOB_STATE_SUCCEEDED"
+PARTIALLY_SUCCEEDED = "JOB_STATE_PARTIALLY_SUCCEEDED"
+TERMINAL_STATES = {
+    SUCCEEDED, PARTIALLY_SUCCEEDED,
+    "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED",
+}
+
+# Request label carrying the key used to map predictions back
+KEY_LABEL = "batch_key"
+
+
+class BatchJobError(Exception):
+    """Raised when a batch job ends in a failed / cancelled / expired state or times out."""
+
+
+def build_request(
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    temperature: Optional[float] = None,
+    max_output_tokens: Optional[int] = None,
+    response_mime_type: Optional[str] = None,
+    use_search: bool = False
+) -> Dict[str, Any]:
+    """
+    Build one GenerateContentRequest in the REST (JSONL) shape used by batch prediction.
+
+    Args:
+        prompt: User turn text
+        system_instruction: Optional system instruction
+        temperature / max_output_tokens / response_mime_type: generationConfig fields
+        use_search: Enable Google Search grounding
+
+    Returns:
+        Request dict
+    """
+    request: Dict[str, Any] = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    if system_instruction:
+        request["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    generation_config = {}
+    if temperature is not None:
+        generation_config["temperature"] = temperature
+    if max_output_tokens is not None:
+        generation_config["maxOutputTokens"] = max_output_tokens
+    if response_mime_type:
+        generation_config["responseMimeType"] = response_mime_type
+    if generation_config:
+        request["generationConfig"] = generation_config
+    if use_search:
+        request["tools"] = [{"googleSearch": {}}]
+    return request
+
+
+def batch_key(key: str) -> str:
+    """Label-safe key (labels allow only lowercase letters, digits, - and _)."""
+    return "k" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+
+
+def parse_prediction(line: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convert one predictions.jsonl line to {"text", "input_tokens", "output_tokens",
+    "thinking_tokens", "cached_tokens", "error"}.
+    """
+    if line.get("status"):
+        return {"text": "", "input_tokens": 0, "output_tokens": 0, "thinking_tokens": 0, "cached_tokens": 0,
+                "error": str(line["status"])[:500]}
+    response = line.get("response") or {}
+    texts = []
+    for candidate in (response.get("candidates") or [])[:1]:
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            if part.get("text") and not part.get("thought"):
+                texts.append(part["text"])
+    usage = gemini_usage(response)
+    return {
+        "text": "".join(texts),
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"],
+        "thinking_tokens": usage["thinking_tokens"],
+        "cached_tokens": usage["cached_tokens"],
+        "error": None if texts else "empty response",
+    }
+
+
+def _prediction_key(line: Dict[str, Any]) -> Optional[str]:
+    return ((line.get("request") or {}).get("labels") or {}).get(KEY_LABEL) or line.get("key")
+
+
+class VertexBatchBackend:
+    """Vertex AI batch prediction with GCS JSONL input / output."""
+
+    price_factor = BATCH_PRICE_FACTOR
+    poll_interval = POLL_INTERVAL
+
+    def __init__(self, gcs_uri: str = BATCH_GCS_URI, client=None):
+        if not HAS_GCS:
+            raise RuntimeError("google-cloud-storage is not installed (pip install google-cloud-storage)")
+        if not gcs_uri.startswith("gs://"):
+            raise RuntimeError("GEMINI_BATCH_GCS_URI (gs://bucket/prefix) is not set")
+        self.gcs_uri = gcs_uri.rstrip("/")
+        self.client = client or genai.Client(vertexai=True, project=VERTEX_PROJECT, location=BATCH_LOCATION)
+        self._storage = storage.Client(project=VERTEX_PROJECT)
+
+    def _split(self, uri: str) -> tuple:
+        bucket, _, path = uri[len("gs://"):].partition("/")
+        return self._storage.bucket(bucket), path
+
+    def submit(self, model: str, lines: List[Dict[str, Any]], display_name: str) -> str:
+        tag = f"{display_name}-{uuid.uuid4().hex[:8]}"
+        bucket, prefix = self._split(f"{self.gcs_uri}/{tag}")
+        body = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines)
+        bucket.blob(f"{prefix}/input.jsonl").upload_from_string(body, content_type="application/jsonl")
+        job = self.client.batches.create(
+            model=model,
+            src=f"{self.gcs_uri}/{tag}/input.jsonl",
+            config=types.CreateBatchJobConfig(dest=f"{self.gcs_uri}/{tag}/output", display_name=display_name),
+        )
+        return job.name
+
+    def state(self, job_name: str) -> str:
+        job = self.client.batches.get(name=job_name)
+        return getattr(job.state, "value", str(job.state))
+
+    def results(self, job_name: str) -> Iterator[Dict[str, Any]]:
+        job = self.client.batches.get(name=job_name)
+        bucket, prefix = self._split(job.dest.gcs_uri)
+        for blob in bucket.list_blobs(prefix=prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for raw in blob.download_as_text().splitlines():
+                if raw.strip():
+                    yield json.loads(raw)
+
+
+class LocalBatchEmulator:
+    """
+    Stand-in for VertexBatchBackend: jobs live in EMULATOR_DIR and are processed
+    by a background thread with the online client (or a responder function),
+    writing predictions in the Vertex output format.
+
+    Args:
+        client: Online Gemini client (used when no responder is given)
+        responder: fn(model, request dict) -> Vertex response dict
+        delay: Seconds to stay in JOB_STATE_PENDING (to exercise polling)
+    """
+
+    def __init__(self, client=None, responder: Optional[Callable] = None, delay: float = 0.0, root: str = EMULATOR_DIR):
+        self.client = client
+        self.responder = responder or self._online_response
+        self.delay = delay
+        self.root = root
+        self.poll_interval = 0.5
+        # Online calls are billed at full price; a custom responder costs nothing
+        self.price_factor = 1.0 if responder is None else 0.0
+        self._threads: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+
+    def _job_dir(self, job_name: str) -> str:
+        return os.path.join(self.root, job_name)
+
+    def _write_state(self, job_name: str, state: str, model: str) -> None:
+        path = os.path.join(self._job_dir(job_name), "state.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"state": state, "model": model, "updated_at": time.time()}, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _read_state(self, job_name: str) -> Dict[str, Any]:
+        with open(os.path.join(self._job_dir(job_name), "state.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _online_response(self, model: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        if self.client is None:
+            self.client = get_client()
+        generation_config = request.get("generationConfig", {})
+        config = types.GenerateContentConfig(
+            system_instruction=(request.get("systemInstruction") or {}).get("parts", [{}])[0].get("text"),
+            temperature=generation_config.get("temperature"),
+            max_output_tokens=generation_config.get("maxOutputTokens"),
+            response_mime_type=generation_config.get("responseMimeType"),
+            tools=[types.Tool(google_search=types.GoogleSearch())] if request.get("tools") else None,
+        )
+        response = self.client.models.generate_content(model=model, contents=request["contents"], config=config)
+        usage = gemini_usage(response)
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": extract_text_from_response(response)}]}}],
+            "usageMetadata": {
+                "promptTokenCount": usage["input_tokens"],
+                "candidatesTokenCount": usage["output_tokens"],
+                "thoughtsTokenCount": usage["thinking_tokens"],
+                "cachedContentTokenCount": usage["cached_tokens"],
+            },
+        }
+
+    def _process(self, job_name: str, model: str) -> None:
+        job_dir = self._job_dir(job_name)
+        if self.delay:
+            time.sleep(self.delay)
+        self._write_state(job_name, "JOB_STATE_RUNNING", model)
+        output_path = os.path.join(job_dir, "predictions.jsonl")
+        done = set()
+        if os.path.exists(output_path):
+            with open(output_path, "r", encoding="utf-8") as f:
+                done = {_prediction_key(json.loads(raw)) for raw in f if raw.strip()}
+
+        failed = 0
+        with open(os.path.join(job_dir, "input.jsonl"), "r", encoding="utf-8") as f_in, \
+                open(output_path, "a", encoding="utf-8") as f_out:
+            for raw in f_in:
+                line = json.loads(raw)
+                if _prediction_key(line) in done:
+                    continue
+                prediction = {"status": "", "processed_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "request": line["request"]}
+                try:
+                    prediction["response"] = self.responder(model, line["request"])
+                except Exception as e:
+                    failed += 1
+                    prediction["status"] = f"{type(e).__name__}: {e}"
+                f_out.write(json.dumps(prediction, ensure_ascii=False) + "\n")
+                f_out.flush()
+        self._write_state(job_name, PARTIALLY_SUCCEEDED if failed else SUCCEEDED, model)
+
+    def _ensure_running(self, job_name: str, model: str) -> None:
+        with self._lock:
+            thread = self._threads.get(job_name)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._process, args=(job_name, model), daemon=True, name=f"batch-emu-{job_name}")
+                self._threads[job_name] = thread
+                thread.start()
+
+    def submit(self, model: str, lines: List[Dict[str, Any]], display_name: str) -> str:
+        job_name = f"{display_name}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self._job_dir(job_name), exist_ok=True)
+        with open(os.path.join(self._job_dir(job_name), "input.jsonl"), "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self._write_state(job_name, "JOB_STATE_PENDING", model)
+        self._ensure_running(job_name, model)
+        return job_name
+
+    def state(self, job_name: str) -> str:
+        state = self._read_state(job_name)
+        if state["state"] not in TERMINAL_STATES:
+            # Job submitted by an earlier process: continue where it stopped
+            self._ensure_running(job_name, state["model"])
+        return state["state"]
+
+    def results(self, job_name: str) -> Iterator[Dict[str, Any]]:
+        with open(os.path.join(self._job_dir(job_name), "predictions.jsonl"), "r", encoding="utf-8") as f:
+            for raw in f:
+                if raw.strip():
+                    yield json.loads(raw)
+
+
+def get_batch_backend(client=None):
+    """
+    Vertex backend when GEMINI_BATCH_GCS_URI is configured, otherwise the local emulator.
+    """
+    if BATCH_BACKEND != "local" and BATCH_GCS_URI and HAS_GCS:
+        return VertexBatchBackend()
+    if BATCH_BACKEND != "local":
+        log.warning(
+            "Vertex batch prediction is not configured (GEMINI_BATCH_GCS_URI / google-cloud-storage); "
+            "using the local emulator with online calls"
+        )
+    return LocalBatchEmulator(client=client)
+
+
+def run_batch(
+    requests: Dict[str, Dict[str, Any]],
+    model: str,
+    backend=None,
+    display_name: str = "gemini-batch",
+    job_name: Optional[str] = None,
+    on_submit: Optional[Callable[[str], None]] = None,
+    poll_interval: Optional[float] = None,
+    timeout: Optional[float] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Submit requests as one batch job, wait for it and map the predictions back.
+
+    Args:
+        requests: {caller key: build_request(...)}
+        model: Gemini model id
+        backend: VertexBatchBackend / LocalBatchEmulator (default: get_batch_backend())
+        display_name: Job display name
+        job_name: Attach to an already submitted job instead of submitting
+        on_submit: Called with the job name right after submission (persist it to resume polling)
+        poll_interval: Seconds between state checks (default: the backend's)
+        timeout: Max seconds to wait (None = no limit)
+
+    Returns:
+        {caller key: {"text", "input_tokens", "output_tokens", "thinking_tokens", "cached_tokens", "cost", "error"}}; keys
+        without a prediction get error "missing"
+
+    Raises:
+        BatchJobError: job failed / cancelled / expired, or timeout
+    """
+    backend = backend or get_batch_backend()
+    poll_interval = poll_interval or backend.poll_interval
+    keys = {batch_key(key): key for key in requests}
+
+    if job_name is None:
+        lines = []
+        for key, request in requests.items():
+            request = dict(request)
+            request["labels"] = {**request.get("labels", {}), KEY_LABEL: batch_key(key)}
+            lines.append({"request": request})
+        job_name = backend.submit(model, lines, display_name)
+        if on_submit:
+            on_submit(job_name)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        state = backend.state(job_name)
+        if state in TERMINAL_STATES:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise BatchJobError(f"batch job {job_name} still {state} after {timeout:g}s")
+        time.sleep(poll_interval)
+
+    if state not in (SUCCEEDED, PARTIALLY_SUCCEEDED):
+        raise BatchJobError(f"batch job {job_name} ended in {state}")
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for line in backend.results(job_name):
+        key = keys.get(_prediction_key(line))
+        if key is None:
+            continue
+        result = parse_prediction(line)
+        result["cost"] = usage_cost(model, result, backend.price_factor)
+        results[key] = result
+    for key in requests:
+        results.setdefault(key, {"text": "", "input_tokens": 0, "output_tokens": 0, "thinking_tokens": 0, "cached_tokens": 0,
+                                 "cost": 0.0, "error": "missing"})
+    return results
+
+
+def extract_ir_for_archive(
+    model: str = "gemini-2.5-flash",
+    limit: Optional[int] = None,
+    backend=None
+) -> int:
+    """
+    Add Phase 1.3 JSON IR to archived answers that have research notes but no IR
+    (so follow-up questions can reuse it), using one batch job.
+
+    Args:
+        model: Model for the extraction
+        limit: Max answers to process
+        backend: Batch backend (default: get_batch_backend())
+
+    Returns:
+        Number of answers updated
+    """
+    from pipeline import build_ir_extraction_prompt, parse_ir_json
+
+    sessions = load_sessions()
+    requests = {}
+    for session in sessions:
+        messages = session.get("messages", [])
+        for i, message in enumerate(messages):
+            logs = message.get("reasoning_logs") or {}
+            if message.get("role") != "model" or not logs.get("phase1_research") or logs.get("phase1_3_ir"):
+                continue
+            question = messages[i - 1]["content"] if i > 0 and messages[i - 1]["role"] == "user" else ""
+            requests[f"{session['id']}:{i}"] = build_request(
+                build_ir_extraction_prompt(model, question, logs["phase1_research"]),
+                temperature=0.1,
+                response_mime_type="application/json",
+            )
+            if limit and len(requests) >= limit:
+                break
+        if limit and len(requests) >= limit:
+            break
+
+    if not requests:
+        print("No archived research without IR")
+        return 0
+    print(f"Submitting {len(requests)} IR extraction requests")
+    results = run_batch(requests, model, backend=backend, display_name="ir-extraction")
+    record_usage([
+        {"phase": "ir_extraction", "model": model, "input_tokens": r["input_tokens"], "output_tokens": r["output_tokens"],
+         "thinking_tokens": r["thinking_tokens"], "cached_tokens": r["cached_tokens"], "cost": r["cost"]}
+        for r in results.values()
+    ])
+
+    # Re-read the sessions: the app may have saved new messages while the job was running
+    sessions = load_sessions()
+    by_id = {session["id"]: session for session in sessions}
+    updated = 0
+    for key, result in results.items():
+        session_id, _, index = key.rpartition(":")
+        session = by_id.get(session_id)
+        ir = parse_ir_json(result["text"]) if not result["error"] else None
+        if session is None or ir is None or int(index) >= len(session["messages"]):
+            continue
+        session["messages"][int(index)].setdefault("reasoning_logs", {})["phase1_3_ir"] = ir
+        updated += 1
+    save_sessions(sessions)
+    print(f"Updated {updated}/{len(requests)} answers (${sum(r['cost'] for r in results.values()):.4f})")
+    return updated
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline bulk jobs via Vertex batch prediction")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ir_parser = subparsers.add_parser("extract-ir", help=f"Add JSON IR to archived research in {SESSIONS_FILE}")
+    ir_parser.add_argument("--model", default="gemini-2.5-flash")
+    ir_parser.add_argument("--limit", type=int, default=None)
+    ir_parser.add_argument("--local", action="store_true", help="Use the local emulator (online calls)")
+    args = parser.parse_args()
+
+    if args.command == "extract-ir":
+        extract_ir_for_archive(
+            model=args.model,
+            limit=args.limit,
+            backend=LocalBatchEmulator() if args.local else None,
+        )